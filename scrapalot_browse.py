@@ -2,10 +2,9 @@ import math
 import os
 import textwrap
 
-from deep_translator import GoogleTranslator
-
-from scripts.app_environment import translate_src, translate_dst, translate_docs, ingest_chunk_size
-from scripts.app_utils import load_single_document
+from scripts.app_document_reader import LazyDocumentReader
+from scripts.app_environment import translate_src, translate_dst, translate_docs, ingest_chunk_size, browse_read_ahead_chunks
+from scripts.app_translation import translation_service
 
 
 def get_directories(directory):
@@ -28,6 +27,10 @@ def print_in_grid(items, num_columns, column_width, indexed=True):
         print()
 
 
+def translate_chunk(content):
+    return translation_service.translate(content, translate_src, translate_dst)
+
+
 def print_files_in_source_directory(files):
     visible_files = [file for file in files if not file.startswith('.')]
     print()
@@ -91,26 +94,19 @@ def run_program():
                 break
             elif user_input.isnumeric():
                 if 0 < int(user_input) <= len(files):
-                    print(f"\n\033[32m[!]\033[0m Opening document. May take some minutes! \033[32m[!]\033[0m")
+                    print(f"\n\033[32m[!]\033[0m Opening document \033[32m[!]\033[0m")
                     file_path = os.path.join(current_directory, files[int(user_input) - 1])
-                    document = load_single_document(file_path)[0]
-
-                    # Convert document content into a single string for processing
-                    doc_content = "".join(document.page_content)
-
-                    # Start and end indices for printing
-                    start_index = 0
+                    # chunks are parsed (and translated) on demand, a few ahead of the one on screen
+                    reader = LazyDocumentReader(file_path, ingest_chunk_size, browse_read_ahead_chunks,
+                                                transform=translate_chunk if translate_docs else None)
 
                     while True:
-                        # Ensure that the end_index doesn't exceed the length of doc_content
-                        end_index = min(len(doc_content), start_index + ingest_chunk_size)
+                        content = reader.next_chunk()
 
-                        # If start_index and end_index are the same, it means that there are no more characters to read
-                        if start_index == end_index:
+                        # no more characters to read
+                        if content is None:
                             break
 
-                        content = doc_content[start_index:end_index]
-
                         try:
                             console_width = os.get_terminal_size().columns  # Get console width
                         except OSError:
@@ -120,10 +116,6 @@ def run_program():
                         paragraphs = content.split('\n')
                         justified_content = '\n'.join(textwrap.fill(p, width=console_width) for p in paragraphs)
 
-                        if translate_docs:
-                            justified_content = GoogleTranslator(source=translate_src, target=translate_dst).translate(
-                                justified_content)
-
                         wrapper = textwrap.TextWrapper(initial_indent='\033[37m', subsequent_indent='\033[37m',
                                                        width=120)
                         print(f"{wrapper.fill(justified_content)}\033[0m\n")
@@ -134,13 +126,13 @@ def run_program():
                         user_input = input()
 
                         if user_input.lower() == 'n':
-                            start_index = end_index
                             continue
                         elif user_input.lower() == 'b':
                             break
                         else:
                             current_directory = source_dir
                             break
+                    reader.close()
 
                     print(
                         f'\n\033[94mPress "b" to go back to the book list or any other key to go back to the main directory: \033[0m')
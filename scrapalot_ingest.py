@@ -2,13 +2,14 @@
 import glob
 import os
 import sys
-from collections import defaultdict
+import uuid
+from collections import deque
+from itertools import islice
 from multiprocessing import Pool
-from typing import List, Optional, Dict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from dotenv import set_key
 from langchain.docstore.document import Document
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter, Language
 from langchain.vectorstores import Chroma
 from tqdm import tqdm
@@ -21,17 +22,28 @@ from scripts.app_environment import (
     ingest_source_directory,
     args,
     chromaDB_manager,
-    gpu_is_enabled)
+    gpu_is_enabled,
+    ingest_batch_size,
+    ingest_persist_every_n_batches,
+    ingest_max_files_in_flight,
+    ingest_embeddings_batch_size,
+    ingest_embeddings_processes,
+    ingest_translate_chunks,
+    translate_src,
+    translate_dst)
+from scripts.app_embeddings import BatchedEmbeddings
+from scripts.app_ingest_checkpoint import IngestCheckpoint
+from scripts.app_ingest_manifest import IngestManifest, ManifestChanges
+from scripts.app_translation import translation_service
 from scripts.app_utils import display_directories, LOADER_MAPPING, load_single_document
 
 
-def load_documents(source_dir: str, collection_name: Optional[str], ignored_files: List[str] = []) -> List[Document]:
+def list_source_files(source_dir: str, collection_name: Optional[str]) -> List[str]:
     """
-    Loads all documents from the source documents directory, ignoring specified files.
+    Lists all files with a supported extension in the collection directory.
     :param source_dir: The path of the source documents directory.
-    :param collection_name: The name of the collection to exclude files from.
-    :param ignored_files: A list of filenames to be ignored.
-    :return: A list of Document objects loaded from the source documents.
+    :param collection_name: The name of the sub-collection directory, None if the collection is the database itself.
+    :return: A list of file paths.
     """
     collection_dir = os.path.join(source_dir, collection_name) if collection_name else source_dir
     print(f"Loading documents from {collection_dir}")
@@ -40,21 +52,40 @@ def load_documents(source_dir: str, collection_name: Optional[str], ignored_file
         all_files.extend(
             glob.glob(os.path.join(collection_dir, f"*{ext}"), recursive=False)
         )
-    filtered_files = [file_path for file_path in all_files if os.path.isfile(file_path) and file_path not in ignored_files]
+    return [os.path.normpath(file_path) for file_path in all_files if os.path.isfile(file_path)]
 
+
+def iter_loaded_documents(file_paths: List[str]) -> Iterator[Tuple[str, List[Document]]]:
+    """
+    Loads documents in parallel and yields them file by file.
+    At most ingest_max_files_in_flight files are loaded ahead of the consumer, so a slow embedder holds back the loaders.
+    :param file_paths: The paths of the files to load.
+    :return: A generator of (file path, Document objects loaded from the file).
+    """
+    files = iter(file_paths)
     with Pool(processes=min(8, os.cpu_count())) as pool:
-        results = []
-        with tqdm(total=len(filtered_files), desc='Loading new documents', ncols=80) as pbar:
-            for i, docs in enumerate(pool.imap_unordered(load_single_document, filtered_files)):
-                if isinstance(docs, dict):
-                    print(" - " + docs['file'] + ": error: " + str(docs['exception']))
-                    continue
+        in_flight = deque()
+        for file_path in islice(files, max(1, ingest_max_files_in_flight)):
+            in_flight.append((file_path, pool.apply_async(load_single_document, (file_path,))))
+
+        with tqdm(total=len(file_paths), desc='Loading new documents', ncols=80) as pbar:
+            while in_flight:
+                file_path, result = in_flight.popleft()
+                next_file_path = next(files, None)
+                if next_file_path is not None:
+                    in_flight.append((next_file_path, pool.apply_async(load_single_document, (next_file_path,))))
 
-                print(f"\n\033[32m\033[2m\033[38;2;0;128;0m{docs[0].metadata.get('source', '')} \033[0m")
-                results.extend(docs)
                 pbar.update()
+                try:
+                    docs = result.get()
+                except Exception as e:
+                    print(f" - {file_path}: error: {e}")
+                    continue
 
-    return results
+                if docs:
+                    print(f"\n\033[32m\033[2m\033[38;2;0;128;0m{docs[0].metadata.get('source', '')} \033[0m")
+                # a file without any text is yielded as well, it is recorded without chunks and not loaded again while unchanged
+                yield file_path, docs
 
 
 def get_language(file_extension: str) -> Language:
@@ -68,46 +99,108 @@ def get_language(file_extension: str) -> Language:
     return ext_to_lang.get(file_extension)
 
 
-def split_documents(documents: list[Document]) -> Dict[Optional[Language], list[Document]]:
-    lang_to_docs = defaultdict(list)
-    for doc in documents:
-        file_extension = os.path.splitext(doc.metadata["source"])[1]
-        lang = get_language(file_extension)
-        lang_to_docs[lang].append(doc)  # Default to None if the file extension does not match any language
+def get_text_splitter(lang: Optional[Language]) -> RecursiveCharacterTextSplitter:
+    chunk_size = ingest_chunk_size if ingest_chunk_size else args.ingest_chunk_size
+    chunk_overlap = ingest_chunk_overlap if ingest_chunk_overlap else args.ingest_chunk_overlap
+    if lang is None:
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return RecursiveCharacterTextSplitter.from_language(language=lang, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
 
-    return lang_to_docs
 
-
-def process_documents(collection_name: Optional[str] = None, ignored_files: List[str] = []) -> List[Document]:
+def iter_document_chunks(loaded_documents: Iterable[Tuple[str, List[Document]]]) -> Iterator[Tuple[str, List[Document]]]:
     """
-    Load documents and split them into chunks.
+    Splits documents into chunks on the fly, as they come out of the loaders.
+    :return: A generator of (file path, chunks of the file).
     """
-    # db_name = args.ingest_dbname or os.path.basename(source_directory)
-    documents = load_documents(source_directory, collection_name if db_name != collection_name else None, ignored_files)
-    if not documents:
-        print("No new documents to load")
-        exit(0)
-    print(f"Loaded {len(documents)} new documents from {source_directory}")
-
-    texts = []
-    for lang, docs in split_documents(documents).items():
-        if lang is None:
-            splitten_docs = RecursiveCharacterTextSplitter(
-                chunk_size=ingest_chunk_size if ingest_chunk_size else args.ingest_chunk_size,
-                chunk_overlap=ingest_chunk_overlap if ingest_chunk_overlap else args.ingest_chunk_overlap
-            ).split_documents(docs)
-        else:
-            print(f"Ingesting {lang} file:")
-            splitten_docs = RecursiveCharacterTextSplitter.from_language(
-                language=lang,
-                chunk_size=ingest_chunk_size if ingest_chunk_size else args.ingest_chunk_size,
-                chunk_overlap=ingest_chunk_overlap if ingest_chunk_overlap else args.ingest_chunk_overlap
-            ).split_documents(docs)
+    splitters = {}
+    for file_path, docs in loaded_documents:
+        lang = get_language(os.path.splitext(file_path)[1])  # None if the file extension does not match any language
+        if lang not in splitters:
+            splitters[lang] = get_text_splitter(lang)
+        yield file_path, splitters[lang].split_documents(docs)
 
-        texts.extend(splitten_docs)
 
-    print(f"Split into {len(texts)} chunks of text (max. {ingest_chunk_size} tokens each)")
-    return texts
+class BatchWriter:
+    """
+    Embeds chunks and writes them to Chroma in fixed-size batches, so memory use tracks the batch size and not the corpus size.
+    The collection is persisted every few batches together with the checkpoint and the manifest,
+    a file is recorded in the manifest only once all of its chunks have been written.
+    """
+
+    def __init__(self, chroma_db, manifest: IngestManifest, checkpoint: IngestCheckpoint, batch_size: int, persist_every_n_batches: int,
+                 resumed_partial: Optional[Dict[str, List[str]]] = None):
+        self.chroma_db = chroma_db
+        self.manifest = manifest
+        self.checkpoint = checkpoint
+        self.batch_size = max(1, batch_size)
+        self.persist_every_n_batches = max(1, persist_every_n_batches)
+        self.batch_number = checkpoint.batch_number
+        # chunks of this run, the interrupted runs it resumes wrote the ones counted by the checkpoint
+        self.chunks_written = 0
+        self.chunks_written_before = checkpoint.chunks_written
+        self._texts: List[Document] = []
+        self._ids: List[str] = []
+        # chunk ids already written by an interrupted run, per partially ingested file
+        self._resumed_partial = dict(resumed_partial or {})
+        # (file path, resumed chunk ids, new chunk ids, position of the first new chunk, position after the last new chunk)
+        self._pending_files = deque()
+        self._files_done: Dict[str, List[str]] = {}
+
+    def add(self, file_path: str, chunks: List[Document]):
+        resumed_ids = self._resumed_partial.pop(file_path, [])
+        if resumed_ids:
+            print(f"Resuming {file_path} after {len(resumed_ids)} chunks already written")
+        chunks = chunks[len(resumed_ids):]
+        ids = [str(uuid.uuid4()) for _ in chunks]
+        start = self.chunks_written + len(self._texts)
+        self._texts.extend(chunks)
+        self._ids.extend(ids)
+        self._pending_files.append((file_path, resumed_ids, ids, start, start + len(chunks)))
+        self._record_complete_files()
+        while len(self._texts) >= self.batch_size:
+            self._write_batch()
+
+    def close(self):
+        while self._texts:
+            self._write_batch()
+        self._record_complete_files()
+        # partially ingested files which couldn't be loaded again
+        leftover_ids = [chunk_id for ids in self._resumed_partial.values() for chunk_id in ids]
+        if leftover_ids:
+            self.chroma_db._collection.delete(ids=leftover_ids)
+            self._resumed_partial = {}
+        self.persist()
+
+    def persist(self):
+        self.chroma_db.persist()
+        self.checkpoint.commit(self.batch_number, self.chunks_written_before + self.chunks_written, self._files_done, self._partial_files())
+        self._files_done = {}
+        self.manifest.save()
+
+    def _partial_files(self) -> Dict[str, List[str]]:
+        partial = dict(self._resumed_partial)
+        for file_path, resumed_ids, ids, start, end in self._pending_files:
+            written = max(0, min(self.chunks_written, end) - start)
+            if resumed_ids or written:
+                partial[file_path] = resumed_ids + ids[:written]
+        return partial
+
+    def _write_batch(self):
+        texts, self._texts = self._texts[:self.batch_size], self._texts[self.batch_size:]
+        ids, self._ids = self._ids[:self.batch_size], self._ids[self.batch_size:]
+        self.checkpoint.begin_batch(ids)
+        self.chroma_db.add_documents(texts, ids=ids)
+        self.chunks_written += len(texts)
+        self.batch_number += 1
+        self._record_complete_files()
+        if self.batch_number % self.persist_every_n_batches == 0:
+            self.persist()
+
+    def _record_complete_files(self):
+        while self._pending_files and self._pending_files[0][4] <= self.chunks_written:
+            file_path, resumed_ids, ids, _, _ = self._pending_files.popleft()
+            self.manifest.record(file_path, resumed_ids + ids)
+            self._files_done[file_path] = resumed_ids + ids
 
 
 def does_vectorstore_exist(persist_directory: str) -> bool:
@@ -197,11 +290,14 @@ def prompt_user():
             print("\n\033[91m\033[1m[!] \033[0mInvalid choice. Please try again.\033[91m\033[1m[!] \033[0m\n")
 
 
-def create_embeddings():
-    embeddings_kwargs = {'device': 'cuda'} if gpu_is_enabled else {}
-    return HuggingFaceEmbeddings(
+def create_embeddings() -> BatchedEmbeddings:
+    processes = ingest_embeddings_processes if ingest_embeddings_processes > 0 else max(1, os.cpu_count() // 2)
+    return BatchedEmbeddings(
         model_name=ingest_embeddings_model if ingest_embeddings_model else args.ingest_embeddings_model,
-        model_kwargs=embeddings_kwargs
+        device='cuda' if gpu_is_enabled else 'cpu',
+        batch_size=ingest_embeddings_batch_size,
+        processes=processes,
+        verbose=True
     )
 
 
@@ -214,48 +310,92 @@ def get_chroma(collection_name: str, embeddings, persist_dir):
     )
 
 
-def process_and_add_documents(collection, chroma_db, collection_name):
-    ignored_files = [metadata['source'] for metadata in collection['metadatas']]
-    texts = process_documents(collection_name=collection_name, ignored_files=ignored_files)
-    num_elements = len(texts)
-    index_metadata = {"elements": num_elements}
-    print(f"Creating embeddings. May take some minutes...")
-    chroma_db.add_documents(texts, index_metadata=index_metadata)
+def purge_documents(chroma_db, manifest: IngestManifest, file_paths: List[str]):
+    """
+    Deletes the chunks of changed or removed files from the collection, by the ids stored in the manifest.
+    """
+    ids = manifest.chunk_ids(file_paths)
+    if ids:
+        print(f"Deleting {len(ids)} chunks of {len(file_paths)} changed or removed files")
+        chroma_db._collection.delete(ids=ids)
+    for file_path in file_paths:
+        manifest.remove(file_path)
 
 
-def process_and_persist_db(database, collection_name):
+def process_and_persist_db(database, manifest: IngestManifest, checkpoint: IngestCheckpoint, changes: ManifestChanges, collection_name,
+                           resumed_partial: Optional[Dict[str, List[str]]] = None, on_progress: Optional[Callable[[int, int], None]] = None):
     print(f"Collection: {collection_name}")
-    process_and_add_documents(database.get(), database, collection_name)
-    database.persist()
-
-
-def create_and_persist_db(embeddings, texts, persist_dir, collection_name):
-    num_elements = len(texts)
-    index_metadata = {"elements": num_elements}
-    db = Chroma.from_documents(
-        texts,
-        embeddings,
-        persist_directory=persist_dir,
-        collection_name=collection_name,
-        client_settings=chromaDB_manager.get_chroma_setting(persist_dir),
-        index_metadata=index_metadata
-    )
-    db.persist()
-
+    print(f"{len(changes.new)} new, {len(changes.changed)} changed, {len(changes.removed)} removed and {len(changes.unchanged)} unchanged files")
+    purge_documents(database, manifest, changes.to_purge)
 
-def main(source_dir: str, persist_dir: str, db_name: str, sub_collection_name: Optional[str] = None):
-    embeddings = create_embeddings()
+    if not changes.to_load:
+        print("No new documents to load")
+        database.persist()
+        manifest.save()
+        checkpoint.finish()
+        return
+
+    print(f"Creating embeddings of {len(changes.to_load)} documents in batches of {ingest_batch_size} chunks. May take some minutes...")
+    writer = BatchWriter(database, manifest, checkpoint, ingest_batch_size, ingest_persist_every_n_batches, resumed_partial)
+    for files_done, (file_path, chunks) in enumerate(iter_document_chunks(iter_loaded_documents(changes.to_load)), start=1):
+        writer.add(file_path, chunks)
+        if on_progress:
+            on_progress(files_done, len(changes.to_load))
+        if ingest_translate_chunks:
+            # warms the translation cache, source documents of answers are then served without network calls
+            translation_service.translate_batch([chunk.page_content.replace('\n', ' ') for chunk in chunks], translate_src, translate_dst)
+    writer.close()
+    checkpoint.finish()
+    print(f"Written {writer.chunks_written} chunks of text (max. {ingest_chunk_size} tokens each) in {writer.batch_number} batches")
+    throughput = database._embedding_function.throughput()
+    print(f"Embedding throughput: {throughput['chunks_per_second']} chunks/s, {throughput['tokens_per_second']} tokens/s")
+
+
+def main(source_dir: str, persist_dir: str, db_name: str, sub_collection_name: Optional[str] = None,
+         embeddings: Optional[BatchedEmbeddings] = None, resume: Optional[bool] = None, on_progress: Optional[Callable[[int, int], None]] = None):
+    """
+    Ingests new and changed documents of a collection.
+    A long-lived caller (like the API ingest worker) passes its own embeddings, so the model stays loaded between runs.
+    """
+    embeddings = embeddings or create_embeddings()
+    resume = args.resume if resume is None else resume
     collection_name = sub_collection_name or db_name
 
-    if does_vectorstore_exist(persist_dir):
+    file_paths = list_source_files(source_dir, collection_name if db_name != collection_name else None)
+    manifest = IngestManifest.load(persist_dir, collection_name)
+    checkpoint = IngestCheckpoint.load(persist_dir, collection_name)
+    resumed_partial = {}
+
+    if checkpoint.is_interrupted():
+        # the store may look complete, but the previous ingest didn't finish
+        db = get_chroma(collection_name, embeddings, persist_dir)
+        if resume:
+            print(f"Resuming interrupted ingest of {persist_dir} after batch {checkpoint.batch_number}")
+        else:
+            print(f"\033[91m\033[1m[!]\033[0m Previous ingest of {persist_dir} was interrupted, use --resume to continue it. Cleaning up and starting over.")
+        resumed_partial = checkpoint.recover(db, manifest, resume=resume)
+        if not resume:
+            # the fresh run starts a new journal
+            checkpoint.finish()
+            checkpoint = IngestCheckpoint(checkpoint.checkpoint_path)
+    elif does_vectorstore_exist(persist_dir):
         print(f"Appending to existing vectorstore at {persist_dir}")
         db = get_chroma(collection_name, embeddings, persist_dir)
-        process_and_persist_db(db, collection_name)
+        if manifest.is_empty():
+            # collection was ingested before manifests existed, read ids and sources once
+            collection = db.get()
+            manifest.bootstrap(collection['ids'], collection['metadatas'])
     else:
         print(f"Creating new vectorstore from {source_dir}")
-        texts = process_documents(collection_name=collection_name, ignored_files=[])
-        create_and_persist_db(embeddings, texts, persist_dir, collection_name)
+        # a manifest without a vectorstore is stale, everything has to be ingested again
+        manifest = IngestManifest(manifest.manifest_path)
+        db = get_chroma(collection_name, embeddings, persist_dir)
 
+    changes = manifest.diff(file_paths)
+    for file_path in set(resumed_partial) - set(changes.to_load):
+        # not to be loaded anymore, chunks written so far are not needed
+        db._collection.delete(ids=resumed_partial.pop(file_path))
+    process_and_persist_db(db, manifest, checkpoint, changes, collection_name, resumed_partial, on_progress)
     print("Ingestion complete! You can now run scrapalot_main.py to query your documents")
 
 
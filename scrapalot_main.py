@@ -3,6 +3,7 @@ import asyncio
 import logging
 import os
 from time import monotonic
+from typing import Optional
 
 import torch
 from auto_gptq import AutoGPTQForCausalLM
@@ -10,15 +11,21 @@ from dotenv import load_dotenv
 from langchain import HuggingFacePipeline
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.llms import LlamaCpp, GPT4All, OpenAI
+from langchain.llms import GPT4All, OpenAI
 from langchain.schema import Document
-from torch import cuda as torch_cuda
 from transformers import AutoTokenizer, AutoModelForCausalLM, LlamaTokenizer, LlamaForCausalLM, GenerationConfig, pipeline
 
 from scripts import app_logs
 from scripts.app_environment import model_type, openai_api_key, model_n_ctx, model_temperature, model_top_p, model_n_batch, model_use_mlock, model_verbose, \
-    args, db_get_only_relevant_docs, gpt4all_backend, model_path_or_id, gpu_is_enabled, cpu_model_n_threads, gpu_model_n_threads, model_n_answer_words, huggingface_model_base_name
-from scripts.app_qa_builder import print_document_chunk, print_hyperlink, process_database_question, process_query
+    args, db_get_only_relevant_docs, gpt4all_backend, model_path_or_id, gpu_is_enabled, cpu_model_n_threads, gpu_model_n_threads, model_n_answer_words, huggingface_model_base_name, \
+    translate_docs, translate_src, translate_dst, hf_batch_max_size, hf_batch_wait_ms, hf_max_new_tokens, \
+    prompt_cache_enabled, prompt_cache_max_states, prompt_cache_max_mb, offload_gpu_reserve_mb, offload_gpu_budget_mb
+from scripts.app_hf_batching import BatchedHuggingFacePipeline, HFBatchScheduler
+from scripts.app_offload_planner import MB, OffloadPlan, free_gpu_memory_bytes, gpu_budget, load_metadata, plan_offload
+from scripts.app_prompt_cache import PromptCachingLlamaCpp, PromptStateCache, skipped_prompt_tokens
+from scripts.app_qa_builder import print_document_chunk, print_hyperlink, process_databases_question, process_query
+from scripts.app_registry import get_embeddings, registry_stats
+from scripts.app_translation import translation_service
 from scripts.app_user_prompt import prompt
 
 # Ensure TOKENIZERS_PARALLELISM is set before importing any HuggingFace module.
@@ -31,34 +38,25 @@ except Exception as e:
     logging.error("Error loading .env file, create one from example.env:", str(e))
 
 
-def get_gpu_memory() -> int:
+def plan_llamacpp_offload(n_threads: Optional[int] = None, gpu_memory_mb: Optional[int] = None) -> OffloadPlan:
     """
-    Returns the amount of free memory in MB for each GPU.
+    Fits the layers of the llama.cpp model into the GPU memory budget, from the sizes read from the model file and the KV cache at MODEL_N_CTX.
+    :param n_threads: CPU threads of the model, overrides the default when the cores are shared by several model replicas.
+    :param gpu_memory_mb: Free GPU memory to plan with instead of the actual one, so a plan can be tried on a machine without a GPU.
     """
-    return int(torch_cuda.mem_get_info()[0] / (1024 ** 2))
+    if gpu_memory_mb is not None:
+        budget = gpu_budget(gpu_memory_mb * MB, offload_gpu_reserve_mb, offload_gpu_budget_mb)
+    elif gpu_is_enabled:
+        budget = gpu_budget(free_gpu_memory_bytes(), offload_gpu_reserve_mb, offload_gpu_budget_mb)
+    else:
+        budget = 0
+    return plan_offload(load_metadata(model_path_or_id), int(model_n_ctx), model_n_batch, budget, n_threads or cpu_model_n_threads, gpu_model_n_threads)
 
 
-# noinspection PyPep8Naming
-def calculate_layer_count() -> None | int | float:
+def get_llm_instance(*callback_handler: BaseCallbackHandler, n_threads: Optional[int] = None):
     """
-    How many layers of a neural network model you can fit into the GPU memory,
-    rather than determining the number of threads.
-    The layer size is specified as a constant (120.6 MB), and the available GPU memory is divided by this to determine the maximum number of layers that can be fit onto the GPU.
-    Some additional memory (the size of 6 layers) is reserved for other uses.
-    The maximum layer count is capped at 32.
+    :param n_threads: CPU threads of the model, overrides the default when the cores are shared by several model replicas.
     """
-    if not gpu_is_enabled:
-        return None
-    LAYER_SIZE_MB = 120.6  # This is the size of a single layer on VRAM, and is an approximation.
-    # The current set value is for 7B models. For other models, this value should be changed.
-    LAYERS_TO_REDUCE = 6  # About 700 MB is needed for the LLM to run, so we reduce the layer count by 6 to be safe.
-    if (get_gpu_memory() // LAYER_SIZE_MB) - LAYERS_TO_REDUCE > 32:
-        return 32
-    else:
-        return get_gpu_memory() // LAYER_SIZE_MB - LAYERS_TO_REDUCE
-
-
-def get_llm_instance(*callback_handler: BaseCallbackHandler):
     logging.debug(f"Initializing model...")
 
     callbacks = [] if args.mute_stream else callback_handler
@@ -73,7 +71,7 @@ def get_llm_instance(*callback_handler: BaseCallbackHandler):
             backend=gpt4all_backend,
             callbacks=callbacks,
             use_mlock=model_use_mlock,
-            n_threads=gpu_model_n_threads if gpu_is_enabled else cpu_model_n_threads,
+            n_threads=gpu_model_n_threads if gpu_is_enabled else n_threads or cpu_model_n_threads,
             n_predict=1000,
             n_batch=model_n_batch,
             top_p=model_top_p,
@@ -82,18 +80,24 @@ def get_llm_instance(*callback_handler: BaseCallbackHandler):
             verbose=False
         )
     elif model_type == "llamacpp":
-        return LlamaCpp(
+        plan = plan_llamacpp_offload(n_threads)
+        for line in plan.describe():
+            logging.info(line)
+        llm = PromptCachingLlamaCpp(
             model_path=model_path_or_id,
             temperature=model_temperature,
             n_ctx=model_n_ctx,
             top_p=model_top_p,
-            n_batch=model_n_batch,
+            n_batch=plan.n_batch,
             use_mlock=model_use_mlock,
-            n_threads=gpu_model_n_threads if gpu_is_enabled else cpu_model_n_threads,
+            n_threads=plan.n_threads,
             verbose=model_verbose,
-            n_gpu_layers=calculate_layer_count() if gpu_is_enabled else None,
+            n_gpu_layers=plan.n_gpu_layers if gpu_is_enabled else None,
             callbacks=callbacks,
         )
+        if prompt_cache_enabled:
+            llm.client.set_cache(PromptStateCache(prompt_cache_max_mb * 1024 * 1024, prompt_cache_max_states))
+        return llm
     elif model_type == "huggingface":
         if gpu_is_enabled and huggingface_model_base_name is not None:
             logging.info("Tokenizer loaded")
@@ -124,6 +128,16 @@ def get_llm_instance(*callback_handler: BaseCallbackHandler):
             tokenizer = LlamaTokenizer.from_pretrained(model_path_or_id)
             model = LlamaForCausalLM.from_pretrained(model_path_or_id)
 
+        if hf_batch_max_size > 1:
+            # concurrent questions are generated together, the instance may be used by several requests at once
+            scheduler = HFBatchScheduler(model, tokenizer, hf_batch_max_size, hf_batch_wait_ms,
+                                         max_new_tokens=hf_max_new_tokens,
+                                         do_sample=False,
+                                         top_p=model_top_p,
+                                         repetition_penalty=1.15,
+                                         generation_config=GenerationConfig.from_pretrained(model_path_or_id))
+            return BatchedHuggingFacePipeline(scheduler=scheduler, callbacks=callbacks)
+
         return HuggingFacePipeline(pipeline=pipeline(
             "text-generation",
             model=model,
@@ -143,6 +157,13 @@ def get_llm_instance(*callback_handler: BaseCallbackHandler):
 
 
 async def main():
+    if args.plan_offload:
+        # dry run, the model is not loaded
+        plan = plan_llamacpp_offload(gpu_memory_mb=args.gpu_memory_mb)
+        for line in plan.describe():
+            print(f"\033[94m{line}\033[0m")
+        return
+
     llm = get_llm_instance(StreamingStdOutCallbackHandler())
 
     if llm is None:
@@ -150,6 +171,8 @@ async def main():
         return
 
     logging.info(f"Running on: {'cuda' if gpu_is_enabled else 'cpu'}")
+    # Load the embeddings model once, it is shared by every question asked afterwards
+    get_embeddings()
     selected_directory_list = prompt()
 
     # Initialize a chat history list
@@ -166,7 +189,7 @@ async def main():
             print("\nProgram Terminated. Exiting...")
             break
 
-        qa_list = []
+        targets = []
         for dir_name in selected_directory_list:
             # Check if the directory name contains a slash, indicating a sub-collection
             if "/" in dir_name:
@@ -175,33 +198,31 @@ async def main():
             else:
                 # If not, the database name and the collection name are the same
                 database_name, collection_name = dir_name, dir_name
-
-            processed_answer = await process_database_question(database_name=database_name, llm=llm, collection_name=collection_name)
-            qa_list.append(processed_answer)
-
-        # Doesn't work very well for some reason won't send proper collection name to process_database_question?
-        # def worker(j):
-        #     return process_database_question(selected_directory_list[j], llm, selected_directory_list[j])
-        #
-        # with ThreadPoolExecutor() as executor:
-        #     qa_list = list(executor.map(worker, range(len(selected_directory_list))))
-
-        for i in range(len(qa_list)):
-            start_time = monotonic()
-            qa = qa_list[i]
-
-            print(f"\n\033[94mSeeking for answer from: [{selected_directory_list[i]}]. May take some minutes...\033[0m")
-            answer, docs = process_query(qa, query, model_n_answer_words, chat_history, db_get_only_relevant_docs, translate_answer=True)
-            print(f"\033[94mTook {round(((monotonic() - start_time) / 60), 2)} min to process the answer!\n\033[0m")
-
-            if isinstance(docs, Document):
-                doc = docs
+            targets.append((database_name, collection_name))
+
+        # all selected collections are searched concurrently and answered once from the merged context
+        qa = await process_databases_question(targets, llm)
+        logging.debug(f"Registry stats: {registry_stats()}")
+
+        start_time = monotonic()
+        skipped_before = skipped_prompt_tokens(llm)
+        print(f"\n\033[94mSeeking for answer from: [{', '.join(selected_directory_list)}]. May take some minutes...\033[0m")
+        answer, docs = process_query(qa, query, model_n_answer_words, chat_history, db_get_only_relevant_docs, translate_answer=True, cache_targets=targets)
+        print(f"\033[94mTook {round(((monotonic() - start_time) / 60), 2)} min to process the answer!\n\033[0m")
+        logging.debug(f"Prompt tokens reused from the model state: {skipped_prompt_tokens(llm) - skipped_before}")
+
+        if translate_docs and not isinstance(docs, Document):
+            # translate all chunks at once, they are printed one by one from the cache
+            translation_service.translate_batch([doc.page_content.replace('\n', ' ') for doc in docs], translate_src, translate_dst)
+
+        if isinstance(docs, Document):
+            doc = docs
+            print_hyperlink(doc)
+            print_document_chunk(doc)
+        else:
+            for doc in docs:
                 print_hyperlink(doc)
                 print_document_chunk(doc)
-            else:
-                for doc in docs:
-                    print_hyperlink(doc)
-                    print_document_chunk(doc)
 
 
 if __name__ == "__main__":
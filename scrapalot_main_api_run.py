@@ -1,29 +1,46 @@
 import asyncio
+import json
 import os
-import subprocess
 import sys
-import uuid
 from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 from urllib.parse import unquote
 
-import ebooklib
-import mammoth
-from bs4 import BeautifulSoup
-from deep_translator import GoogleTranslator
 from dotenv import load_dotenv, set_key
-from ebooklib import epub
-from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from langchain.callbacks import StreamingStdOutCallbackHandler
 from pydantic import BaseModel
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse, HTMLResponse
+from starlette.responses import FileResponse, HTMLResponse, StreamingResponse
 from starlette.staticfiles import StaticFiles
 
 from scrapalot_main import get_llm_instance
-from scripts.app_environment import translate_docs, translate_src, translate_q, chromaDB_manager, translate_a, model_n_answer_words, api_host, api_port, api_scheme
-from scripts.app_qa_builder import process_database_question, process_query
+from scripts.app_answer_cache import answer_cache
+from scripts.app_callbacks import AsyncQueueCallbackHandler
+from scripts.app_condense import condense_metrics
+from scripts.app_conversations import conversation_store
+from scripts.app_environment import translate_docs, translate_src, translate_q, chromaDB_manager, translate_a, model_n_answer_words, api_host, api_port, api_scheme, \
+    api_worker_threads, api_query_max_concurrency, api_query_max_queue, ingest_jobs_path, ingest_jobs_keep_finished, \
+    upload_max_file_mb, upload_max_request_mb, upload_chunk_size_kb, directory_index_max_size, \
+    preview_cache_dir, model_pool_replicas, model_pool_max_replicas, model_pool_checkout_timeout, model_pool_max_queue, model_path_or_id, cpu_model_n_threads, \
+    model_type, hf_batch_max_size, prompt_cache_enabled, prompt_cache_max_mb
+from scripts.app_file_index import DirectoryIndexCache
+from scripts.app_hf_batching import BatchedHuggingFacePipeline
+from scripts.app_ingest_jobs import IngestJob, IngestJobQueue
+from scripts.app_ingest_worker import IngestWorkerProcess
+from scripts.app_llm_pool import LLMPool, auto_replica_count
+from scripts.app_pdf_pages import parse_byte_range, read_byte_range, pdf_info, extract_pdf_pages, render_pdf_page
+from scripts.app_previews import PreviewCache, chapters_to_html
+from scripts.app_prompt_cache import PromptCachingLlamaCpp, skipped_prompt_tokens
+from scripts.app_qa_builder import process_databases_question, process_query
+from scripts.app_registry import get_embeddings, invalidate_vectorstore, registry_stats
+from scripts.app_rerank import rerank_metrics
+from scripts.app_translation import translation_service
+from scripts.app_uploads import InvalidUpload, UploadTooLarge, receive_uploads, store_uploads
+from scripts.app_worker_pool import BoundedWorkerPool, WorkerPoolSaturated
 
 sys.path.append(str(Path(sys.argv[0]).resolve().parent.parent))
 
@@ -40,6 +57,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    # pagination headers of the file listings, hidden from cross-origin scripts otherwise
+    expose_headers=["X-Total-Count", "X-Next-Cursor"],
 )
 
 app.mount("/static", StaticFiles(directory="scrapalot-chat-ui/static"), name="static")
@@ -50,12 +69,21 @@ load_dotenv()
 ###############################################################################
 # model classes
 ###############################################################################
-class QueryBody(BaseModel):
+class QueryTarget(BaseModel):
     database_name: str
-    collection_name: str
+    collection_name: Optional[str] = None
+
+
+class QueryBody(BaseModel):
+    database_name: Optional[str] = None
+    collection_name: Optional[str] = None
+    # several (database, collection) targets are searched concurrently and answered once
+    targets: Optional[List[QueryTarget]] = None
     question: str
     translate_chunks: bool = True
     locale: str
+    # continues the conversation of this session, without it every question is answered on its own
+    session_id: Optional[str] = None
 
 
 class TranslationBody(BaseModel):
@@ -72,35 +100,61 @@ class SourceDirectoryFile(BaseModel):
     name: str
 
 
-class LLM:
-    def __init__(self):
-        self.instance = None
-
-    def get_instance(self):
-        if not self.instance:
-            self.instance = get_llm_instance(StreamingStdOutCallbackHandler())
-        return self.instance
+###############################################################################
+# model pool
+###############################################################################
+def create_llm_pool() -> LLMPool:
+    # every llama.cpp replica fills its own prompt state cache
+    prompt_cache_bytes = prompt_cache_max_mb * 1024 * 1024 if prompt_cache_enabled and model_type == "llamacpp" else 0
+    replicas = model_pool_replicas or auto_replica_count(model_path_or_id, cpu_model_n_threads, model_pool_max_replicas, prompt_cache_bytes)
+    # the cores are split between the replicas, they generate at the same time
+    n_threads = max(1, cpu_model_n_threads // replicas)
+    slots_per_replica = hf_batch_max_size if model_type == "huggingface" else 1
+    return LLMPool(lambda: get_llm_instance(StreamingStdOutCallbackHandler(), n_threads=n_threads), replicas, model_pool_checkout_timeout, slots_per_replica,
+                   model_pool_max_queue)
 
 
 ###############################################################################
 # init
 ###############################################################################
-chat_history = []
-llm_manager = LLM()
+llm_pool = create_llm_pool()
 executor = ThreadPoolExecutor(max_workers=5)
+# every model replica can answer a question at the same time
+query_concurrency = max(api_query_max_concurrency, llm_pool.capacity)
+query_pool = BoundedWorkerPool("query", max(api_worker_threads, query_concurrency), query_concurrency, api_query_max_queue)
+directory_index_cache = DirectoryIndexCache(directory_index_max_size)
+preview_cache = PreviewCache(preview_cache_dir)
+ingest_worker = IngestWorkerProcess()
+ingest_jobs = IngestJobQueue(ingest_jobs_path, lambda job, on_progress: run_ingest_job(job, on_progress), ingest_jobs_keep_finished)
 
 
 @app.on_event("startup")
 async def startup_event():
-    llm_manager.get_instance()
+    llm_pool.start()
+    get_embeddings()
+    ingest_jobs.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    query_pool.shutdown()
+    ingest_jobs.stop()
+    ingest_worker.stop()
 
 
 ###############################################################################
 # helper functions
 ###############################################################################
 
-def get_llm():
-    return llm_manager.get_instance()
+def hf_batching_stats() -> Optional[list]:
+    # the slots of a replica share one instance and its scheduler
+    schedulers = {id(slot.instance): slot.instance.scheduler for slot in llm_pool.slots if isinstance(slot.instance, BatchedHuggingFacePipeline)}
+    return [scheduler.stats() for scheduler in schedulers.values()] or None
+
+
+def prompt_cache_stats() -> Optional[list]:
+    llms = {id(slot.instance): slot.instance for slot in llm_pool.slots if isinstance(slot.instance, PromptCachingLlamaCpp)}
+    return [llm.stats() for llm in llms.values()] or None
 
 
 def list_of_collections(database_name: str):
@@ -108,59 +162,66 @@ def list_of_collections(database_name: str):
     return client.list_collections()
 
 
-async def get_files_from_dir(database: str, page: int, items_per_page: int) -> List[SourceDirectoryFile]:
-    all_files = []
+async def get_files_from_dir(database: str, page: int, items_per_page: int, cursor: Optional[str], response: Response) -> List[SourceDirectoryFile]:
+    loop = asyncio.get_running_loop()
+    # the index is checked (and rebuilt after a change) off the event loop, large directories take a while to walk
+    index = await loop.run_in_executor(executor, directory_index_cache.get, database)
+    try:
+        files, next_cursor = index.page(cursor, items_per_page, offset=(page - 1) * items_per_page)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-    for root, dirs, files in os.walk(database):
-        for file in sorted(files):  # Added sorting here.
-            if not file.startswith('.'):
-                all_files.append(SourceDirectoryFile(id=str(uuid.uuid4()), name=file))
-    start = (page - 1) * items_per_page
-    end = start + items_per_page
-    return all_files[start:end]
+    response.headers["X-Total-Count"] = str(len(index.files))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [SourceDirectoryFile(id=indexed_file.id, name=indexed_file.name) for indexed_file in files]
 
 
-def run_ingest(database_name: str, collection_name: Optional[str] = None):
-    if database_name and not collection_name:
-        subprocess.run(["python", "scrapalot_ingest.py",
-                        "--ingest-dbname", database_name], check=True)
-    if database_name and collection_name:
-        subprocess.run(["python", "scrapalot_ingest.py",
-                        "--ingest-dbname", database_name, "--collection", collection_name], check=True)
+def run_ingest_job(job: IngestJob, on_progress):
+    ingest_worker.run(job, on_progress)
+    # cached vector store handles don't see what the ingest has just written
+    invalidate_vectorstore(job.database_name)
 
 
-async def docx_to_html(docx_path):
-    loop = asyncio.get_running_loop()
-    with open(docx_path, "rb") as docx_file:
-        result = await loop.run_in_executor(executor, mammoth.convert_to_html, docx_file)
-        html = result.value  # The generated HTML
-    return html
-
-
-async def epub_to_html(epub_path):
-    book = epub.read_epub(epub_path)
-    html = "<html><body>"
-    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-        soup = BeautifulSoup(item.get_content().decode("utf-8"), 'html.parser')
-        for tag in soup.find_all(['img', 'image', 'svg']):
-            tag.decompose()
-        html += str(soup)
-    html += "</body></html>"
-    return html
-
-
-async def get_database_file_response(absolute_file_path: str) -> Union[HTMLResponse, FileResponse]:
-    file_extension = os.path.splitext(absolute_file_path)[-1].lower()
-
-    if file_extension == ".docx":
-        html = await docx_to_html(absolute_file_path)
-        return HTMLResponse(content=html, status_code=200)
-    elif file_extension == ".epub":
-        html = await epub_to_html(absolute_file_path)
-        return HTMLResponse(content=html, status_code=200)
-    else:
+def is_not_modified(request: Request, etag: str, last_modified: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [value.strip() for value in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def get_database_file_response(request: Request, absolute_file_path: str, chapter: Optional[int] = None) -> Union[Response, FileResponse]:
+    if not preview_cache.supports(absolute_file_path):
         return FileResponse(absolute_file_path)
 
+    loop = asyncio.get_running_loop()
+    etag = await loop.run_in_executor(executor, preview_cache.etag, absolute_file_path)
+    if chapter is not None:
+        etag = f'{etag[:-1]}-{chapter}"'
+    headers = {"ETag": etag, "Last-Modified": preview_cache.last_modified(absolute_file_path), "Cache-Control": "no-cache"}
+    if is_not_modified(request, etag, headers["Last-Modified"]):
+        return Response(status_code=304, headers=headers)
+
+    # converting a long book takes seconds, it is done once and off the event loop
+    if chapter is None:
+        chapters = await loop.run_in_executor(executor, preview_cache.get_chapters, absolute_file_path)
+        headers["X-Chapter-Count"] = str(len(chapters))
+        return HTMLResponse(content=chapters_to_html(chapters), status_code=200, headers=headers)
+
+    # a chapter is returned once it is rendered, the chapters after it are rendered in the background
+    content, chapter_count = await loop.run_in_executor(executor, preview_cache.get_chapter, absolute_file_path, chapter)
+    if chapter_count is not None:
+        headers["X-Chapter-Count"] = str(chapter_count)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    return HTMLResponse(content=chapters_to_html([content]), status_code=200, headers=headers)
+
 
 ###############################################################################
 # API
@@ -170,6 +231,25 @@ async def root():
     return {"ping": "pong!"}
 
 
+@app.get("/api/stats")
+async def get_stats():
+    return {
+        'registry': registry_stats(),
+        'query_pool': query_pool.stats(),
+        'llm_pool': llm_pool.stats(),
+        'hf_batching': hf_batching_stats(),
+        'prompt_cache': prompt_cache_stats(),
+        'condense': condense_metrics.stats(),
+        'answer_cache': answer_cache.stats(),
+        'translation': translation_service.stats(),
+        'directory_index': directory_index_cache.stats(),
+        'rerank': rerank_metrics.stats(),
+        'conversations': conversation_store.stats(),
+        'previews': preview_cache.stats(),
+        'ingest_queue_depth': ingest_jobs.queue_depth()
+    }
+
+
 @app.post("/api/set-translation")
 async def set_translation(body: TranslationBody):
     locale = body.locale
@@ -201,30 +281,32 @@ async def get_database_names_and_collections():
 
 
 @app.get("/api/database/{database_name}", response_model=List[SourceDirectoryFile])
-async def get_database_files(database_name: str, page: int = Query(1, ge=1), items_per_page: int = Query(10, ge=1)):
+async def get_database_files(response: Response, database_name: str, page: int = Query(1, ge=1), items_per_page: int = Query(10, ge=1),
+                             cursor: Optional[str] = None):
     base_dir = "./source_documents"
     absolute_base_dir = os.path.abspath(base_dir)
     database_dir = os.path.join(absolute_base_dir, database_name)
     if not os.path.exists(database_dir) or not os.path.isdir(database_dir):
         raise HTTPException(status_code=404, detail="Database not found")
 
-    files = await get_files_from_dir(database_dir, page, items_per_page)
+    files = await get_files_from_dir(database_dir, page, items_per_page, cursor, response)
     return files
 
 
 @app.get("/api/database/{database_name}/collection/{collection_name}", response_model=List[SourceDirectoryFile])
-async def get_database_collection_files(database_name: str, collection_name: str, page: int = Query(1, ge=1), items_per_page: int = Query(10, ge=1)):
+async def get_database_collection_files(response: Response, database_name: str, collection_name: str, page: int = Query(1, ge=1),
+                                        items_per_page: int = Query(10, ge=1), cursor: Optional[str] = None):
     base_dir = "./source_documents"
     absolute_base_dir = os.path.abspath(base_dir)
     collection_dir = os.path.join(absolute_base_dir, database_name, collection_name)
     if not os.path.exists(collection_dir) or not os.path.isdir(collection_dir):
         raise HTTPException(status_code=404, detail="Collection not found")
-    files = await get_files_from_dir(collection_dir, page, items_per_page)
+    files = await get_files_from_dir(collection_dir, page, items_per_page, cursor, response)
     return files
 
 
 @app.get("/api/database/{database_name}/file-first", response_model=None)
-async def get_database_file_first(database_name: str) -> Union[HTMLResponse, FileResponse]:
+async def get_database_file_first(request: Request, database_name: str, chapter: Optional[int] = Query(None, ge=0)) -> Union[Response, FileResponse]:
     base_dir = "./source_documents"
     absolute_base_dir = os.path.abspath(base_dir)
     database_dir = os.path.join(absolute_base_dir, database_name)
@@ -237,11 +319,11 @@ async def get_database_file_first(database_name: str) -> Union[HTMLResponse, Fil
         raise HTTPException(status_code=404, detail="No documents in database")
 
     absolute_file_path = os.path.join(database_dir, files[0])
-    return await get_database_file_response(absolute_file_path)
+    return await get_database_file_response(request, absolute_file_path, chapter)
 
 
 @app.get("/api/database/{database_name}/file/{file_name}", response_model=None)
-async def get_database_file(database_name: str, file_name: str) -> Union[HTMLResponse, FileResponse]:
+async def get_database_file(request: Request, database_name: str, file_name: str, chapter: Optional[int] = Query(None, ge=0)) -> Union[Response, FileResponse]:
     base_dir = "./source_documents"
     absolute_base_dir = os.path.abspath(base_dir)
     database_dir = os.path.join(absolute_base_dir, database_name)
@@ -252,86 +334,287 @@ async def get_database_file(database_name: str, file_name: str) -> Union[HTMLRes
     if not os.path.exists(absolute_file_path):
         raise HTTPException(status_code=404, detail="File not found")
 
-    return await get_database_file_response(absolute_file_path)
+    return await get_database_file_response(request, absolute_file_path, chapter)
+
+
+def get_database_pdf_path(database_name: str, file_name: str) -> str:
+    database_dir = os.path.abspath(os.path.join("./source_documents", database_name))
+    absolute_file_path = os.path.abspath(os.path.join(database_dir, unquote(file_name)))
+    # file_name may hold a collection sub-directory, but nothing outside the database
+    if os.path.commonpath([database_dir, absolute_file_path]) != database_dir or not os.path.isfile(absolute_file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not absolute_file_path.lower().endswith(".pdf"):
+        raise HTTPException(status_code=415, detail="Not a PDF document")
+    return absolute_file_path
+
+
+def pdf_cache_headers(absolute_file_path: str) -> dict:
+    stat = os.stat(absolute_file_path)
+    return {"ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', "Cache-Control": "no-cache"}
+
+
+async def ranged_response(request: Request, content: Union[bytes, str], media_type: str, headers: dict) -> Response:
+    """
+    Answers a Range request with 206 and the requested bytes, content is either the bytes or the path of a file.
+    """
+    loop = asyncio.get_running_loop()
+    size = len(content) if isinstance(content, bytes) else os.path.getsize(content)
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    try:
+        byte_range = parse_byte_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        if isinstance(content, bytes):
+            return Response(content=content, media_type=media_type, headers=headers)
+        return FileResponse(content, media_type=media_type, headers=headers)
+
+    first, last = byte_range
+    if isinstance(content, bytes):
+        body = content[first:last + 1]
+    else:
+        body = await loop.run_in_executor(executor, read_byte_range, content, first, last)
+    return Response(content=body, status_code=206, media_type=media_type, headers={**headers, "Content-Range": f"bytes {first}-{last}/{size}"})
+
+
+@app.get("/api/database/{database_name}/pdf/info/{file_name:path}")
+async def get_database_pdf_info(database_name: str, file_name: str):
+    absolute_file_path = get_database_pdf_path(database_name, file_name)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, pdf_info, absolute_file_path)
+
+
+@app.get("/api/database/{database_name}/pdf/file/{file_name:path}", response_model=None)
+async def get_database_pdf_file(request: Request, database_name: str, file_name: str) -> Response:
+    absolute_file_path = get_database_pdf_path(database_name, file_name)
+    return await ranged_response(request, absolute_file_path, "application/pdf", pdf_cache_headers(absolute_file_path))
+
+
+@app.get("/api/database/{database_name}/pdf/pages/{file_name:path}", response_model=None)
+async def get_database_pdf_pages(request: Request, database_name: str, file_name: str, start: int = Query(0, ge=0), end: int = Query(..., ge=0)) -> Response:
+    absolute_file_path = get_database_pdf_path(database_name, file_name)
+    loop = asyncio.get_running_loop()
+    try:
+        content = await loop.run_in_executor(executor, extract_pdf_pages, absolute_file_path, start, end)
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return await ranged_response(request, content, "application/pdf", pdf_cache_headers(absolute_file_path))
+
+
+@app.get("/api/database/{database_name}/pdf/image/{file_name:path}", response_model=None)
+async def get_database_pdf_page_image(database_name: str, file_name: str, page: int = Query(0, ge=0), zoom: float = Query(1.5, gt=0, le=4)) -> Response:
+    absolute_file_path = get_database_pdf_path(database_name, file_name)
+    loop = asyncio.get_running_loop()
+    try:
+        content = await loop.run_in_executor(executor, render_pdf_page, absolute_file_path, page, zoom)
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(content=content, media_type="image/png", headers=pdf_cache_headers(absolute_file_path))
+
+
+def get_query_targets(body: QueryBody) -> List[Tuple[str, str]]:
+    targets = list(body.targets or [])
+    if body.database_name:
+        targets.insert(0, QueryTarget(database_name=body.database_name, collection_name=body.collection_name))
+    if not targets:
+        raise HTTPException(status_code=422, detail="Either database_name or targets has to be set")
+    return [(target.database_name, target.collection_name or target.database_name) for target in targets]
 
 
 @app.post('/api/query')
-async def query_files(body: QueryBody, llm=Depends(get_llm)):
-    database_name = body.database_name
-    collection_name = body.collection_name
+async def query_files(body: QueryBody):
+    targets = get_query_targets(body)
     question = body.question
     locale = body.locale
     translate_chunks = body.translate_chunks
 
     try:
-        if translate_q:
-            question = GoogleTranslator(source=locale, target=translate_src).translate(question)
-
-        seeking_from = database_name + '/' + collection_name if collection_name and collection_name != database_name else database_name
-        print(f"\n\033[94mSeeking for answer from: [{seeking_from}]. May take some minutes...\033[0m")
-        qa = await process_database_question(database_name, llm, collection_name)
-        answer, docs = process_query(qa, question, model_n_answer_words, chat_history, chromadb_get_only_relevant_docs=False, translate_answer=False)
-
-        if translate_a:
-            answer = GoogleTranslator(source=translate_src, target=locale).translate(answer)
-
-        source_documents = []
-        for doc in docs:
-            document_page = doc.page_content.replace('\n', ' ')
-            if translate_docs == translate_chunks:
-                document_page = GoogleTranslator(source=translate_src, target=locale).translate(document_page)
-
-            source_documents.append({
-                'content': document_page,
-                'link': doc.metadata['source']
-            })
+        async with query_pool.slot():
+            return await answer_query(targets, question, locale, translate_chunks, body.session_id)
+    except WorkerPoolSaturated as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    except Exception as e:
+        return HTTPException(status_code=500, detail=str(e))
+
+
+async def answer_query(targets: List[Tuple[str, str]], question: str, locale: str, translate_chunks: bool, session_id: Optional[str] = None):
+    if translate_q:
+        question = await query_pool.run(translation_service.translate, question, locale, translate_src)
+
+    seeking_from = ', '.join(database_name + '/' + collection_name if collection_name != database_name else database_name for database_name, collection_name in targets)
+    print(f"\n\033[94mSeeking for answer from: [{seeking_from}]. May take some minutes...\033[0m")
+    chat_history = conversation_store.get_history(session_id) if session_id else []
+    async with llm_pool.checkout() as llm:
+        # the replica is used by this request only, the difference is what its prompts skipped
+        skipped_before = skipped_prompt_tokens(llm)
+        timings = {}
+        qa = await process_databases_question(targets, llm)
+        answer, docs = await query_pool.run(process_query, qa, question, model_n_answer_words, chat_history, chromadb_get_only_relevant_docs=False, translate_answer=False,
+                                            cache_targets=targets, timings=timings)
+        skipped_tokens = skipped_prompt_tokens(llm) - skipped_before
+    if session_id and answer is not None:
+        conversation_store.append(session_id, question, answer)
+
+    # the answer and the source chunks are translated concurrently
+    answer, source_documents = await asyncio.gather(
+        query_pool.run(translation_service.translate, answer, translate_src, locale) if translate_a else as_result(answer),
+        translate_source_documents(docs, locale, translate_chunks)
+    )
+
+    response = {
+        'answer': answer,
+        'source_documents': source_documents,
+        'prompt_tokens_skipped': skipped_tokens,
+        'condense_seconds_saved': timings.get('condense_seconds_saved', 0)
+    }
+    return response
+
+
+async def as_result(value):
+    return value
+
+
+async def translate_source_documents(docs, locale: str, translate_chunks: bool) -> List[dict]:
+    document_pages = [doc.page_content.replace('\n', ' ') for doc in docs]
+    if translate_docs == translate_chunks:
+        document_pages = await query_pool.run(translation_service.translate_batch, document_pages, translate_src, locale)
+
+    source_documents = []
+    for doc, document_page in zip(docs, document_pages):
+        source_documents.append({
+            'content': document_page,
+            'link': doc.metadata['source'],
+            # set by the PDF loader, lets a viewer open the document at the quoted page
+            'page': doc.metadata.get('page')
+        })
+    return source_documents
+
+
+def server_sent_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post('/api/query-stream')
+async def query_files_stream(body: QueryBody):
+    """
+    Same as /api/query, but answer tokens are sent as server-sent events while they are generated.
+    Events: "token" for every generated token, "sources" with the final answer and source documents, "error" on failure.
+    """
+    targets = get_query_targets(body)
+    if query_pool.is_saturated():
+        raise HTTPException(status_code=503, detail="query queue is full", headers={"Retry-After": "10"})
+
+    return StreamingResponse(stream_answer(body, targets), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def stream_answer(body: QueryBody, targets: List[Tuple[str, str]]):
+    loop = asyncio.get_running_loop()
+    tokens: asyncio.Queue = asyncio.Queue()
+    handler = AsyncQueueCallbackHandler(loop, tokens)
+    locale = body.locale
 
-        response = {
+    try:
+        async with query_pool.slot():
+            question = body.question
+            if translate_q:
+                question = await query_pool.run(translation_service.translate, question, locale, translate_src)
+
+            chat_history = conversation_store.get_history(body.session_id) if body.session_id else []
+            async with llm_pool.checkout() as llm:
+                skipped_before = skipped_prompt_tokens(llm)
+                timings = {}
+                qa = await process_databases_question(targets, llm)
+                generation = asyncio.ensure_future(query_pool.run(process_query, qa, question, model_n_answer_words, chat_history,
+                                                                  chromadb_get_only_relevant_docs=False, translate_answer=False, callbacks=[handler],
+                                                                  cache_targets=targets, timings=timings))
+                try:
+                    while not generation.done() or not tokens.empty():
+                        token_task = asyncio.ensure_future(tokens.get())
+                        await asyncio.wait({token_task, generation}, return_when=asyncio.FIRST_COMPLETED)
+                        if token_task.done():
+                            yield server_sent_event("token", token_task.result())
+                        else:
+                            token_task.cancel()
+                finally:
+                    # a client gone mid-answer doesn't stop the generation, the replica is given back only once it's done
+                    await asyncio.wait({generation})
+
+                answer, docs = generation.result()
+                skipped_tokens = skipped_prompt_tokens(llm) - skipped_before
+            if body.session_id and answer is not None:
+                conversation_store.append(body.session_id, question, answer)
+            if translate_a:
+                answer = await query_pool.run(translation_service.translate, answer, translate_src, locale)
+            source_documents = await translate_source_documents(docs, locale, body.translate_chunks)
+
+        yield server_sent_event("sources", {
             'answer': answer,
-            'source_documents': source_documents
-        }
-        return response
+            'source_documents': source_documents,
+            'prompt_tokens_skipped': skipped_tokens,
+            'condense_seconds_saved': timings.get('condense_seconds_saved', 0)
+        })
     except Exception as e:
-        return HTTPException(status_code=500, detail=str(e))
+        yield server_sent_event("error", {'detail': str(e)})
 
 
 @app.post("/api/upload")
 async def upload_files(request: Request):
-    form = await request.form()
-    database_name = form['database_name']
-    collection_name = form.get('collection_name')  # Optional field
-
-    files = form["files"]  # get files from form data
+    content_length = int(request.headers.get("content-length") or 0)
+    if content_length > upload_max_request_mb * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"Upload is larger than {upload_max_request_mb} MB")
 
-    # make sure files is a list
-    if not isinstance(files, list):
-        files = [files]
-
-    saved_files = []
     source_documents = './source_documents'
     try:
-        for file in files:
-            content = await file.read()  # read file content
-            if collection_name and database_name != collection_name:
-                file_path = os.path.join(source_documents, database_name, collection_name, file.filename)
-            else:
-                file_path = os.path.join(source_documents, database_name, file.filename)
-
-            saved_files.append(file_path)
-            with open(file_path, "wb") as f:
-                f.write(content)
-
-            # assuming run_ingest is defined elsewhere
-            run_ingest(database_name, collection_name)
-
-            response = {
-                'message': "OK",
-                'files': saved_files,
-                "database_name": database_name
-            }
-            return response
+        # parsed while it arrives, the body is never held in memory or spooled whole
+        form = await receive_uploads(request.stream(), request.headers.get("content-type", ""), source_documents, executor,
+                                       upload_chunk_size_kb * 1024, upload_max_file_mb * 1024 * 1024, upload_max_request_mb * 1024 * 1024)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidUpload as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    database_name = form.fields.get('database_name')
+    if not database_name:
+        form.discard()
+        raise HTTPException(status_code=400, detail="database_name is required")
+    collection_name = form.fields.get('collection_name') or database_name  # Optional field
+    try:
+        stored = await asyncio.get_running_loop().run_in_executor(executor, store_uploads, form.files, database_name, collection_name, source_documents)
     except Exception as e:
-        return HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+    saved_files = [upload.file_path for upload in stored if upload.duplicate_of is None]
+    response = {
+        'message': "OK",
+        'files': saved_files,
+        'duplicates': [{'file': upload.file_path, 'duplicate_of': upload.duplicate_of} for upload in stored if upload.duplicate_of is not None],
+        "database_name": database_name,
+        "job_id": None
+    }
+    if saved_files:
+        # uploads to the same collection waiting in the queue are ingested together
+        response["job_id"] = ingest_jobs.submit(database_name, collection_name, saved_files).id
+    return response
+
+
+@app.delete("/api/conversations/{session_id}")
+async def delete_conversation(session_id: str):
+    conversation_store.clear(session_id)
+    return {'message': "OK"}
+
+
+@app.get("/api/ingest-jobs")
+async def get_ingest_jobs():
+    return [asdict(job) for job in ingest_jobs.list()]
+
+
+@app.get("/api/ingest-jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingest job not found")
+    return asdict(job)
 
 
 ###############################################################################
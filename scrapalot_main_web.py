@@ -1,15 +1,16 @@
-import base64
+import json
 import os
-import socket
-from typing import List
+import uuid
+from typing import List, Optional
+from urllib.parse import quote
 
-import requests
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit_chat import message
 from streamlit_option_menu import option_menu
-from urllib3.connection import HTTPConnection
 
-from scripts.app_environment import api_base_url
+from scripts.app_environment import api_base_url, api_public_url, api_client_timeout, api_client_query_timeout, api_client_retries, api_client_cache_ttl
+from scripts.app_http_client import APIClient
 
 st.set_page_config(
     layout="centered",
@@ -39,6 +40,10 @@ translations = [
 # --- upload settings ---
 ACCEPTABLE_FILE_TYPES = ["pdf", "epub", "docx"]
 
+# --- pdf viewer settings ---
+# pages shown at a time by the viewer of a PDF source
+PDF_VIEWER_PAGES = 10
+
 
 ###############################################################################
 # init
@@ -64,6 +69,28 @@ def initialize_state():
     if 'book_button_clicked' not in st.session_state:
         st.session_state['book_button_clicked'] = False
 
+    if 'synced_locale' not in st.session_state:
+        # the locale last sent to the API, None until the first sync
+        st.session_state['synced_locale'] = None
+
+
+def new_db_state() -> dict:
+    return {
+        'history': [],  # This will store both questions and answers
+        'source_documents': [],
+        # the API keeps the conversation of every database under its own session
+        'session_id': str(uuid.uuid4())
+    }
+
+
+def get_api_client() -> APIClient:
+    """
+    One pooled client per browser session, kept across reruns of the script.
+    """
+    if 'api_client' not in st.session_state:
+        st.session_state['api_client'] = APIClient(api_base_url, api_client_timeout, api_client_query_timeout, api_client_retries)
+    return st.session_state['api_client']
+
 
 ###############################################################################
 # translation
@@ -72,14 +99,13 @@ def initialize_state():
 
 def set_translation(locale):
     st.session_state['locale'] = locale
+    # every interaction reruns the script, the API only has to hear about an actual change
+    if st.session_state.get('synced_locale') == locale:
+        return
     payload = {"locale": locale}  # Send locale directly
-    endpoint = f"{api_base_url}/set-translation"
-    response = requests.post(endpoint, json=payload)
+    response = get_api_client().post("/set-translation", json=payload)
     if response.status_code == 200:
-        pass
-    else:
-        # Handle error here
-        pass
+        st.session_state['synced_locale'] = locale
 
 
 def setup_translation():
@@ -100,10 +126,9 @@ def setup_translation():
 ###############################################################################
 
 
-@st.cache_data
-def get_database_names_and_collections():
-    endpoint = f"{api_base_url}/databases"
-    response = requests.get(endpoint)
+@st.cache_data(ttl=api_client_cache_ttl, show_spinner=False)
+def get_database_names_and_collections(_client: APIClient):
+    response = _client.get("/databases")
     if response.status_code == 200:
         result = response.json()
         databases = {db['database_name']: [col['name'] for col in db['collections']] for db in result}
@@ -114,7 +139,7 @@ def get_database_names_and_collections():
         return {}
 
 
-databases = get_database_names_and_collections()
+databases = get_database_names_and_collections(get_api_client())
 
 
 def handle_database_and_collection_selection():
@@ -134,28 +159,41 @@ def handle_database_and_collection_selection():
 
 
 def query_documents(question: str, database_name: str, collection_name: str):
-    with st.spinner("Processing..."):
-        endpoint = f"{api_base_url}/query"
-        data = {
-            "question": question,
-            "database_name": database_name,
-            "collection_name": collection_name,
-            "locale": st.session_state['locale']
-        }
-
-        # Modify socket options for the HTTPConnection class
-        set_keepalive_options(HTTPConnection)
-
-        response = requests.post(endpoint, json=data)
-        if response.status_code == 200:
-            result = response.json()
-            answer = result["answer"]
-            source_documents = result["source_documents"]
-            set_translation(st.session_state['locale'])
-            return answer, source_documents
-        else:
+    data = {
+        "question": question,
+        "database_name": database_name,
+        "collection_name": collection_name,
+        "locale": st.session_state['locale'],
+        "session_id": st.session_state['db_states'][database_name]['session_id']
+    }
+
+    # Tokens are rendered as soon as they arrive, the placeholder is cleared once the full answer is known
+    placeholder = st.empty()
+    placeholder.markdown("Processing...")
+    streamed_answer = ""
+    client = get_api_client()
+    with client.post("/query-stream", json=data, stream=True, timeout=client.query_timeout) as response:
+        if response.status_code != 200:
+            placeholder.empty()
             st.error("Failed to query documents.")
             st.write(response.text)
+            return None, []
+
+        for event, payload in iter_server_sent_events(response):
+            if event == "token":
+                streamed_answer += payload
+                placeholder.markdown(streamed_answer + "▌")
+            elif event == "sources":
+                placeholder.empty()
+                return payload["answer"], payload["source_documents"]
+            elif event == "error":
+                placeholder.empty()
+                st.error("Failed to query documents.")
+                st.write(payload["detail"])
+                return None, []
+
+    placeholder.empty()
+    return streamed_answer, []
 
 
 def handle_user_query():
@@ -184,6 +222,8 @@ def handle_user_query_processing(user_input):
         })
         # Then wait for the answer
         answer, source_documents = query_documents(user_input, selected_database, selected_collection)
+        if answer is None:
+            return
         # Append to the history
         answer_key = str(len(st.session_state['db_states'][selected_database]['history'])) + '_gen_next'
         st.session_state['db_states'][selected_database]['history'].append({
@@ -198,7 +238,7 @@ def handle_user_query_processing(user_input):
 
         # Display the source documents in the same container
         st.write("source:")
-        redraw_source_documents(source_documents)
+        redraw_source_documents(source_documents, "answer-")
 
 
 ###############################################################################
@@ -206,15 +246,54 @@ def handle_user_query_processing(user_input):
 ###############################################################################
 
 
-def display_pdf(file):
-    abs_path = os.path.abspath(file)
-    # Opening file from a file path
-    with open(abs_path, "rb") as f:
-        base64_pdf = base64.b64encode(f.read()).decode('utf-8')
-        # Embedding PDF in HTML
-        pdf_display = F'<embed src="data:application/pdf;base64,{base64_pdf}" width="800" height="800" type="application/pdf"/>'
-        # Displaying File
-        st.markdown(pdf_display, unsafe_allow_html=True)
+@st.cache_data(ttl=api_client_cache_ttl, show_spinner=False)
+def get_pdf_info(_client: APIClient, database_name: str, file_name: str) -> Optional[dict]:
+    response = _client.get(f"/database/{database_name}/pdf/info/{quote(file_name)}")
+    return response.json() if response.status_code == 200 else None
+
+
+def display_pdf(database_name: str, file_name: str, first_page: int = 0, key: str = ""):
+    """
+    A PDF source, nothing is requested until the user opens it. An open viewer shows PDF_VIEWER_PAGES pages at a time,
+    from the page the source was found on, the browser loads each page image from API_PUBLIC_URL once it is scrolled into view.
+    :param key: Prefix of the widget keys, the same source can be shown twice in one run.
+    """
+    # first page shown per open viewer, kept across reruns
+    viewers = st.session_state.setdefault('pdf_viewers', {})
+    viewer_key = f"{database_name}/{file_name}#{first_page}"
+    if viewer_key not in viewers:
+        if not st.button("Open document", key=f"{key}open-{viewer_key}"):
+            return
+        viewers[viewer_key] = first_page
+
+    info = get_pdf_info(get_api_client(), database_name, file_name)
+    if info is None:
+        st.error("Failed to open document.")
+        return
+    page_count = len(info["page_sizes"])
+
+    col_previous, col_next, col_close = st.columns(3)
+    start = min(viewers[viewer_key], max(page_count - 1, 0))
+    if col_previous.button("Previous pages", key=f"{key}previous-{viewer_key}", disabled=start == 0):
+        start = max(0, start - PDF_VIEWER_PAGES)
+    if col_next.button("Next pages", key=f"{key}next-{viewer_key}", disabled=start + PDF_VIEWER_PAGES >= page_count):
+        start += PDF_VIEWER_PAGES
+    if col_close.button("Close", key=f"{key}close-{viewer_key}"):
+        del viewers[viewer_key]
+        # shows the open button again in place of the viewer
+        st.experimental_rerun()
+    viewers[viewer_key] = start
+
+    end = min(start + PDF_VIEWER_PAGES, page_count)
+    image_url = f"{api_public_url}/database/{quote(database_name)}/pdf/image/{quote(file_name)}"
+    pages = []
+    for page_number in range(start, end):
+        width, height = info["page_sizes"][page_number]
+        # the aspect ratio reserves the space of a page before it is loaded, otherwise every page would be in view at once
+        pages.append(f'<img src="{image_url}?page={page_number}" loading="lazy" alt="page {page_number + 1}" '
+                     f'style="width: 100%; aspect-ratio: {width} / {height}; margin-bottom: 8px;"/>')
+    st.caption(f"Pages {start + 1}-{end} of {page_count}")
+    components.html(f'<div style="height: 800px; overflow-y: auto;">{"".join(pages)}</div>', height=810)
 
 
 ###############################################################################
@@ -233,15 +312,19 @@ def redraw_conversation():
     source_documents = st.session_state['db_states'][selected_database].get('source_documents', [])
     if source_documents:  # Check if there are any source documents
         st.write("source:")
-        redraw_source_documents(source_documents[0])
+        redraw_source_documents(source_documents[0], "history-")
 
 
-def redraw_source_documents(source_documents):
+def redraw_source_documents(source_documents, key: str = ""):
     # Display the answer and source documents in the same container
+    database_name = st.session_state['selected_database']
     for idx, doc in enumerate(source_documents):
         link = doc["link"]
         st.write(f'> {link}:')
         st.markdown(f'<p class="small-font">{doc["content"]}</p>', unsafe_allow_html=True)
+        file_name = os.path.relpath(link, os.path.join("source_documents", database_name))
+        if link.lower().endswith(".pdf") and not file_name.startswith(".."):
+            display_pdf(database_name, file_name, doc.get("page") or 0, f"{key}{idx}-")
 
 
 ###############################################################################
@@ -269,12 +352,13 @@ def handle_file_upload():
 # noinspection PyUnresolvedReferences
 def upload_documents(files: List[st.runtime.uploaded_file_manager.UploadedFile], database_name: str, collection_name: str):
     with st.spinner("Processing..."):
-        endpoint = f"{api_base_url}/upload"
         files_data = [("files", file) for file in files]
         data = {"database_name": database_name, "collection_name": collection_name}
 
-        response = requests.post(endpoint, files=files_data, data=data)
+        response = get_api_client().post("/upload", files=files_data, data=data)
         if response.status_code == 200:
+            # the listing may have changed, the next rerun fetches it again
+            get_database_names_and_collections.clear()
             st.success("Documents stored successfully!")
         else:
             st.error("Document storing failed.")
@@ -286,20 +370,20 @@ def upload_documents(files: List[st.runtime.uploaded_file_manager.UploadedFile],
 ###############################################################################
 
 
-def set_keepalive_options(http_conn):
-    http_conn.default_socket_options = (
-        http_conn.default_socket_options + [
-        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-    ])
-
-    if hasattr(socket, 'TCP_KEEPIDLE'):
-        http_conn.default_socket_options += [(socket.SOL_TCP, socket.TCP_KEEPIDLE, 45)]
-
-    if hasattr(socket, 'TCP_KEEPINTVL'):
-        http_conn.default_socket_options += [(socket.SOL_TCP, socket.TCP_KEEPINTVL, 10)]
-
-    if hasattr(socket, 'TCP_KEEPCNT'):
-        http_conn.default_socket_options += [(socket.SOL_TCP, socket.TCP_KEEPCNT, 6)]
+def iter_server_sent_events(response):
+    """
+    Parses a text/event-stream response into (event, data) pairs, data is JSON decoded.
+    """
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].strip())
 
 
 def main():
@@ -319,20 +403,16 @@ def main():
         if clear_history_button:
             # Clear the history for the selected database
             if selected_database in st.session_state['db_states']:
-                st.session_state['db_states'][selected_database] = {
-                    'history': [],  # This will store both questions and answers
-                    'source_documents': []
-                }
+                # the API forgets the conversation too, the next question starts a new one
+                get_api_client().delete(f"/conversations/{st.session_state['db_states'][selected_database]['session_id']}")
+                st.session_state['db_states'][selected_database] = new_db_state()
 
         if selected_database:
             if selected_database != st.session_state['current_db']:
                 st.session_state['current_db'] = selected_database
                 # Ensure the selected database has an entry in the session state
                 if selected_database not in st.session_state['db_states']:
-                    st.session_state['db_states'][selected_database] = {
-                        'history': [],  # This will store both questions and answers
-                        'source_documents': []
-                    }
+                    st.session_state['db_states'][selected_database] = new_db_state()
                 redraw_conversation()
             else:
                 # If the database didn't change, display the history
@@ -0,0 +1,187 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from .app_environment import answer_cache_enabled, answer_cache_max_entries, answer_cache_ttl_seconds, answer_cache_similarity_threshold, answer_cache_path
+from .app_ingest_manifest import IngestManifest, write_json_atomic
+
+ANSWER_CACHE_VERSION = 1
+# persisting the whole cache on every new answer would be wasteful, it is written at most this often (and on exit)
+ANSWER_CACHE_SAVE_INTERVAL_SECONDS = 30
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+def collections_version(targets: List[Tuple[str, str]]) -> str:
+    """
+    Changes whenever one of the collections is re-ingested, the manifest is rewritten at the end of every ingest.
+    """
+    mtimes = []
+    for database_name, collection_name in sorted(targets):
+        manifest_path = IngestManifest.get_manifest_path(f"./db/{database_name}", collection_name)
+        mtimes.append(str(os.path.getmtime(manifest_path)) if os.path.exists(manifest_path) else "0")
+    return ",".join(mtimes)
+
+
+class SemanticAnswerCache:
+    """
+    Cache of generated answers per (collections, model, prompt template) namespace.
+    A question is looked up by its normalized text first, then by the cosine similarity of its embedding to cached questions.
+    Entries expire after a TTL, the least recently used entry is evicted when the cache is full,
+    and all entries of a namespace are dropped once its collections are re-ingested.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, similarity_threshold: float, persist_path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.persist_path = persist_path
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0.0
+        if persist_path:
+            self._load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def namespace(targets: List[Tuple[str, str]], model: str, template: str) -> str:
+        template_hash = hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+        return json.dumps([sorted(targets), model, template_hash])
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry["created"] > self.ttl_seconds
+
+    def get(self, namespace: str, version: str, question: str, embed: Callable[[str], List[float]]) -> Tuple[Optional[dict], Optional[np.ndarray]]:
+        """
+        :return: The cached entry or None, and the question embedding if it had to be computed (to be reused by put).
+        """
+        now = time.time()
+        key = (namespace, normalize_question(question))
+        with self._lock:
+            self._evict(now, namespace, version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry, None
+
+            candidates = [(entry_key, entry) for entry_key, entry in self._entries.items() if entry_key[0] == namespace]
+
+        embedding = self._normalize(embed(question))
+        if candidates:
+            matrix = np.array([entry["embedding"] for _, entry in candidates], dtype=np.float32)
+            similarities = matrix @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                entry_key, entry = candidates[best]
+                with self._lock:
+                    if entry_key in self._entries:
+                        self._entries.move_to_end(entry_key)
+                    self.semantic_hits += 1
+                logging.debug(f"Answer cache semantic hit ({similarities[best]:.3f}): '{question}' ~ '{entry['question']}'")
+                return entry, embedding
+
+        with self._lock:
+            self.misses += 1
+        return None, embedding
+
+    def put(self, namespace: str, version: str, question: str, answer: str, docs: List[Document], embedding: Optional[np.ndarray],
+            embed: Callable[[str], List[float]]):
+        if embedding is None:
+            embedding = self._normalize(embed(question))
+        entry = {
+            "version": version,
+            "question": question,
+            "embedding": embedding.tolist(),
+            "answer": answer,
+            "docs": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs],
+            "created": time.time(),
+        }
+        with self._lock:
+            key = (namespace, normalize_question(question))
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+        if self.persist_path and time.time() - self._last_save > ANSWER_CACHE_SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    @staticmethod
+    def entry_docs(entry: dict) -> List[Document]:
+        return [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in entry["docs"]]
+
+    def invalidate(self, predicate: Optional[Callable[[str], bool]] = None) -> int:
+        with self._lock:
+            keys = [key for key in self._entries if predicate is None or predicate(key[0])]
+            for key in keys:
+                del self._entries[key]
+            self._dirty = self._dirty or bool(keys)
+            return len(keys)
+
+    def _evict(self, now: float, namespace: str, version: str):
+        stale = [key for key, entry in self._entries.items()
+                 if self._is_expired(entry, now) or (key[0] == namespace and entry["version"] != version)]
+        for key in stale:
+            del self._entries[key]
+        self._dirty = self._dirty or bool(stale)
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _load(self):
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                content = json.load(f)
+            now = time.time()
+            for namespace, question_key, entry in content.get("entries", []):
+                if not self._is_expired(entry, now):
+                    self._entries[(namespace, question_key)] = entry
+            logging.info(f"Loaded {len(self._entries)} cached answers from {self.persist_path}")
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load answer cache from {self.persist_path}: {e}")
+
+    def save(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [[namespace, question_key, entry] for (namespace, question_key), entry in self._entries.items()]
+            self._dirty = False
+            self._last_save = time.time()
+        write_json_atomic(self.persist_path, {"version": ANSWER_CACHE_VERSION, "entries": entries})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'enabled': answer_cache_enabled,
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+            }
+
+
+answer_cache = SemanticAnswerCache(answer_cache_max_entries, answer_cache_ttl_seconds, answer_cache_similarity_threshold, answer_cache_path or None)
@@ -0,0 +1,38 @@
+import asyncio
+from typing import Any, Dict, Optional, Set
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+# Chains whose LLM tokens are part of the answer (the question-condensing step is not streamed)
+ANSWER_CHAIN_NAMES = {"StuffDocumentsChain"}
+
+
+class AsyncQueueCallbackHandler(BaseCallbackHandler):
+    """
+    Per-request callback handler which forwards generated answer tokens to an asyncio.Queue.
+    The LLM runs on a worker thread, so tokens are handed over to the event loop thread-safely.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, answer_chain_names: Optional[Set[str]] = None):
+        self.loop = loop
+        self.queue = queue
+        self.answer_chain_names = answer_chain_names if answer_chain_names is not None else ANSWER_CHAIN_NAMES
+        self._answer_run_ids: Set[UUID] = set()
+
+    def _is_answering(self) -> bool:
+        return not self.answer_chain_names or bool(self._answer_run_ids)
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any) -> None:
+        if serialized and serialized.get("name") in self.answer_chain_names:
+            self._answer_run_ids.add(run_id)
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any) -> None:
+        self._answer_run_ids.discard(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._answer_run_ids.discard(run_id)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self._is_answering():
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
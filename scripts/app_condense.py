@@ -0,0 +1,198 @@
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain import PromptTemplate
+from langchain.callbacks.manager import CallbackManagerForChainRun, Callbacks
+from langchain.chains import ConversationalRetrievalChain, LLMChain
+from langchain.embeddings.base import Embeddings
+from langchain.llms import LlamaCpp
+
+from .app_environment import condense_mode, condense_model_path, condense_max_tokens, condense_similarity_threshold, model_n_ctx, cpu_model_n_threads
+from .app_registry import get_embeddings
+
+# the instructions come first, the conversation and the follow-up question after them
+CONDENSE_TEMPLATE = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question.
+    Keep the language of the follow up question, don't answer it.
+
+    Chat History:
+    {chat_history}
+    Follow Up Input: {question}
+    Standalone question:"""
+
+
+def format_chat_history(chat_history: List[Tuple[str, str]]) -> str:
+    return "\n".join(f"Human: {question}\nAssistant: {answer}" for question, answer in chat_history)
+
+
+class QuestionCondenser(ABC):
+    """
+    Turns a follow-up question into a question that can be searched for on its own, using the earlier turns of the conversation.
+    """
+
+    # whether condensing takes a generation of the model answering the question
+    uses_answer_model = False
+
+    @abstractmethod
+    def condense(self, question: str, chat_history: List[Tuple[str, str]], callbacks: Callbacks = None) -> str:
+        pass
+
+
+class LLMQuestionCondenser(QuestionCondenser):
+    """
+    Lets a model rephrase the follow-up question, the model answering the questions or a smaller one shared by all requests.
+    """
+
+    def __init__(self, llm, uses_answer_model: bool, lock: Optional[threading.Lock] = None):
+        self.chain = LLMChain(llm=llm, prompt=PromptTemplate(template=CONDENSE_TEMPLATE, input_variables=["chat_history", "question"]))
+        self.uses_answer_model = uses_answer_model
+        # a shared llama.cpp model can't generate for two requests at once
+        self.lock = lock
+
+    def condense(self, question: str, chat_history: List[Tuple[str, str]], callbacks: Callbacks = None) -> str:
+        with self.lock or nullcontext():
+            return self.chain.run(question=question, chat_history=format_chat_history(chat_history), callbacks=callbacks).strip() or question
+
+
+class EmbeddingQuestionCondenser(QuestionCondenser):
+    """
+    Rewrites the follow-up question without a model call: the latest earlier question, and the earlier questions
+    whose embeddings are similar to the follow-up, are prepended to it.
+    """
+
+    def __init__(self, embeddings: Embeddings, similarity_threshold: float):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+
+    def condense(self, question: str, chat_history: List[Tuple[str, str]], callbacks: Callbacks = None) -> str:
+        earlier = [earlier_question for earlier_question, _ in chat_history]
+        vectors = np.array(self.embeddings.embed_documents(earlier + [question]), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        similarities = vectors[:-1] @ vectors[-1]
+        # a short follow-up ("and its side effects?") is rarely similar to anything, it continues the latest question
+        related = [text for i, text in enumerate(earlier) if i == len(earlier) - 1 or similarities[i] >= self.similarity_threshold]
+        return " ".join(related + [question])
+
+
+class CondenseMetrics:
+    """
+    Time spent condensing follow-up questions, and the time saved by condensing them without the model answering them.
+    Savings are only counted for follow-ups condensed by the embedding or the small model path: the answering model would have
+    generated the standalone question at the speed measured on its answers, a first question isn't condensed at all.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.condensed = 0
+        self.condense_seconds = 0.0
+        self.seconds_saved = 0.0
+        self.answer_seconds_per_char = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _average(average: Optional[float], value: float) -> float:
+        return value if average is None else 0.8 * average + 0.2 * value
+
+    def record(self, condensed: bool, by_answer_model: bool, condense_seconds: float, answer_seconds: float, answer_chars: int,
+               standalone_chars: int) -> float:
+        """
+        :param answer_chars: Length of the answer generated in answer_seconds.
+        :param standalone_chars: Length of the standalone question the condenser produced.
+        :return: The estimated seconds saved on this question.
+        """
+        with self._lock:
+            self.queries += 1
+            if answer_chars:
+                self.answer_seconds_per_char = self._average(self.answer_seconds_per_char, answer_seconds / answer_chars)
+            if not condensed:
+                return 0.0
+            self.condensed += 1
+            self.condense_seconds += condense_seconds
+            if by_answer_model or self.answer_seconds_per_char is None:
+                return 0.0
+            saved = max(0.0, self.answer_seconds_per_char * standalone_chars - condense_seconds)
+            self.seconds_saved += saved
+            return saved
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'mode': condense_mode,
+                'queries': self.queries,
+                'condensed': self.condensed,
+                'avg_condense_ms': round(self.condense_seconds / max(self.condensed, 1) * 1000, 1),
+                'seconds_saved': round(self.seconds_saved, 1),
+            }
+
+
+condense_metrics = CondenseMetrics()
+
+
+class CondensingRetrievalChain(ConversationalRetrievalChain):
+    """
+    ConversationalRetrievalChain condensing the question with a QuestionCondenser only when there is a chat history,
+    a first question is searched and answered in a single model call.
+    """
+
+    condenser: Any
+
+    @property
+    def output_keys(self) -> List[str]:
+        return super().output_keys + ["condense_seconds_saved"]
+
+    def _call(self, inputs: Dict[str, Any], run_manager: Optional[CallbackManagerForChainRun] = None) -> Dict[str, Any]:
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        question, chat_history = inputs["question"], inputs["chat_history"]
+
+        start_time = monotonic()
+        new_question = self.condenser.condense(question, chat_history, _run_manager.get_child()) if chat_history else question
+        condense_seconds = monotonic() - start_time
+        docs = self._get_docs(new_question, inputs)
+
+        start_time = monotonic()
+        answer = self.combine_docs_chain.run(input_documents=docs, callbacks=_run_manager.get_child(),
+                                             **{**inputs, "question": new_question, "chat_history": format_chat_history(chat_history)})
+        answer_seconds = monotonic() - start_time
+
+        saved = condense_metrics.record(bool(chat_history), self.condenser.uses_answer_model, condense_seconds, answer_seconds, len(answer), len(new_question))
+        if chat_history:
+            logging.debug(f"Condensed the question to '{new_question}' in {condense_seconds:.2f}s")
+        output: Dict[str, Any] = {self.output_key: answer, "condense_seconds_saved": round(saved, 2)}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = new_question
+        return output
+
+
+# the small condense model is loaded once and shared by every request
+condense_llm_lock = threading.Lock()
+condense_llm_generate_lock = threading.Lock()
+condense_llm = None
+
+
+def get_condense_llm():
+    global condense_llm
+    with condense_llm_lock:
+        if condense_llm is None:
+            logging.info(f"Loading the condense model {condense_model_path}")
+            condense_llm = LlamaCpp(model_path=condense_model_path, n_ctx=int(model_n_ctx), n_threads=cpu_model_n_threads, max_tokens=condense_max_tokens,
+                                    temperature=0, streaming=False, verbose=False)
+        return condense_llm
+
+
+def create_condenser(llm, mode: Optional[str] = None) -> QuestionCondenser:
+    mode = mode or condense_mode
+    if mode == "embedding":
+        return EmbeddingQuestionCondenser(get_embeddings(), condense_similarity_threshold)
+    if mode == "model":
+        if condense_model_path:
+            return LLMQuestionCondenser(get_condense_llm(), False, condense_llm_generate_lock)
+        logging.warning("CONDENSE_MODE is 'model' but CONDENSE_MODEL_PATH is not set, condensing with the answer model")
+    elif mode != "llm":
+        logging.warning(f"Unknown CONDENSE_MODE '{mode}', falling back to 'llm'")
+    return LLMQuestionCondenser(llm, True)
@@ -0,0 +1,113 @@
+import logging
+from functools import lru_cache
+from typing import Callable, List, Tuple
+
+from langchain.schema import BaseRetriever, Document
+
+from .app_retrievers import SyncRetriever
+
+# shorter matches between two chunks are more likely a coincidence than the overlap left by the splitter
+MIN_OVERLAP_CHARS = 20
+
+
+def get_token_counter(llm) -> Callable[[str], int]:
+    """
+    Counts tokens with the tokenizer of the model the prompt is sent to, counts of repeated texts are memoized.
+    """
+    # HuggingFace models, get_num_tokens would fall back to the GPT-2 tokenizer
+    tokenizer = getattr(getattr(llm, "pipeline", None), "tokenizer", None)
+    scheduler = getattr(llm, "scheduler", None)
+    if scheduler is not None:
+        # the batching thread tokenizes with the same tokenizer
+        count = scheduler.count_tokens
+    elif tokenizer is not None:
+        count = lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    else:
+        count = llm.get_num_tokens
+    return lru_cache(maxsize=4096)(count)
+
+
+def trim_overlap(kept: str, text: str, max_overlap: int) -> str:
+    """
+    Removes from text what it shares with the end or the start of kept, the overlap between neighbouring chunks of a file.
+    """
+    for length in range(min(max_overlap, len(kept), len(text)), MIN_OVERLAP_CHARS - 1, -1):
+        if kept.endswith(text[:length]):
+            return text[length:]
+        if kept.startswith(text[-length:]):
+            return text[:-length]
+    return text
+
+
+def dedupe_documents(docs: List[Document], max_overlap: int) -> List[Document]:
+    """
+    Drops chunks contained in an earlier chunk of the same file, and trims the overlap between chunks of the same file.
+    """
+    deduped: List[Document] = []
+    for doc in docs:
+        text = doc.page_content
+        for kept in deduped:
+            if kept.metadata.get('source') != doc.metadata.get('source'):
+                continue
+            if text in kept.page_content:
+                text = ""
+                break
+            text = trim_overlap(kept.page_content, text, max_overlap)
+        if text.strip():
+            deduped.append(doc if text == doc.page_content else Document(page_content=text, metadata=doc.metadata))
+    return deduped
+
+
+class ContextPacker:
+    """
+    Fits the retrieved chunks and the chat history into token budgets of the model context,
+    instead of relying on the model to truncate an overflowing prompt.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], context_budget: int, history_budget: int, history_max_turns: int, max_overlap: int):
+        self.count_tokens = count_tokens
+        self.context_budget = context_budget
+        self.history_budget = history_budget
+        self.history_max_turns = history_max_turns
+        self.max_overlap = max_overlap
+
+    def pack_documents(self, docs: List[Document], question: str) -> List[Document]:
+        """
+        Keeps documents in retrieval order while they fit, a shorter document further down may still fill the rest.
+        """
+        budget = self.context_budget - self.count_tokens(question)
+        packed, tokens = [], 0
+        for doc in dedupe_documents(docs, self.max_overlap):
+            doc_tokens = self.count_tokens(doc.page_content)
+            if tokens + doc_tokens <= budget:
+                packed.append(doc)
+                tokens += doc_tokens
+        if len(packed) < len(docs):
+            logging.debug(f"Packed {len(packed)} of {len(docs)} chunks into {tokens}/{budget} tokens")
+        return packed
+
+    def compact_history(self, chat_history: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        :return: The most recent turns that fit the history window.
+        """
+        window, tokens = [], 0
+        for question, answer in reversed(chat_history[-self.history_max_turns:] if self.history_max_turns > 0 else []):
+            turn_tokens = self.count_tokens(question) + self.count_tokens(answer)
+            if tokens + turn_tokens > self.history_budget:
+                break
+            window.insert(0, (question, answer))
+            tokens += turn_tokens
+        return window
+
+
+class ContextPackingRetriever(SyncRetriever):
+    """
+    Passes on only the retrieved documents that fit the context budget of the model, without duplicated text.
+    """
+
+    def __init__(self, retriever: BaseRetriever, packer: ContextPacker):
+        self.retriever = retriever
+        self.packer = packer
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return self.packer.pack_documents(self.retriever.get_relevant_documents(query), query)
@@ -0,0 +1,148 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import List, Tuple
+
+from .app_environment import conversation_store_backend, conversation_store_path, conversation_max_turns, conversation_idle_seconds, conversation_max_sessions
+
+
+class ConversationStore(ABC):
+    """
+    Chat histories keyed by session id, each bounded to the latest max_turns (question, answer) turns.
+    Conversations idle for longer than idle_seconds are dropped.
+    """
+
+    def __init__(self, max_turns: int, idle_seconds: int):
+        self.max_turns = max(1, max_turns)
+        self.idle_seconds = idle_seconds
+        self.expired = 0
+
+    @abstractmethod
+    def get_history(self, session_id: str) -> List[Tuple[str, str]]:
+        pass
+
+    @abstractmethod
+    def append(self, session_id: str, question: str, answer: str):
+        pass
+
+    @abstractmethod
+    def clear(self, session_id: str):
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    Keeps conversations in memory, the least recently used one is dropped once there are more than max_sessions.
+    """
+
+    def __init__(self, max_turns: int, idle_seconds: int, max_sessions: int):
+        super().__init__(max_turns, idle_seconds)
+        self.max_sessions = max(1, max_sessions)
+        self._conversations: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float):
+        if self.idle_seconds > 0:
+            # ordered by last use, the idle ones are at the front
+            while self._conversations and now - next(iter(self._conversations.values()))["last_seen"] > self.idle_seconds:
+                self._conversations.popitem(last=False)
+                self.expired += 1
+        while len(self._conversations) > self.max_sessions:
+            self._conversations.popitem(last=False)
+
+    def get_history(self, session_id: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            self._evict(time.time())
+            conversation = self._conversations.get(session_id)
+            return list(conversation["turns"]) if conversation else []
+
+    def append(self, session_id: str, question: str, answer: str):
+        now = time.time()
+        with self._lock:
+            conversation = self._conversations.setdefault(session_id, {"turns": deque(maxlen=self.max_turns)})
+            conversation["turns"].append((question, answer))
+            conversation["last_seen"] = now
+            self._conversations.move_to_end(session_id)
+            self._evict(now)
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._conversations.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'sessions': len(self._conversations),
+                'expired': self.expired,
+            }
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Keeps conversations in a SQLite file, so they survive a restart of the API.
+    """
+
+    def __init__(self, path: str, max_turns: int, idle_seconds: int):
+        super().__init__(max_turns, idle_seconds)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS turns (session_id TEXT, created REAL, question TEXT, answer TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, created)")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float):
+        if self.idle_seconds > 0:
+            idle = self._db.execute("SELECT session_id FROM turns GROUP BY session_id HAVING MAX(created) < ?", (now - self.idle_seconds,)).fetchall()
+            self._db.executemany("DELETE FROM turns WHERE session_id = ?", idle)
+            self.expired += len(idle)
+
+    def get_history(self, session_id: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            self._evict(time.time())
+            self._db.commit()
+            rows = self._db.execute("SELECT question, answer FROM turns WHERE session_id = ? ORDER BY created DESC LIMIT ?",
+                                    (session_id, self.max_turns)).fetchall()
+            return [(question, answer) for question, answer in reversed(rows)]
+
+    def append(self, session_id: str, question: str, answer: str):
+        with self._lock:
+            self._db.execute("INSERT INTO turns VALUES (?, ?, ?, ?)", (session_id, time.time(), question, answer))
+            self._db.execute("DELETE FROM turns WHERE session_id = ? AND created NOT IN "
+                             "(SELECT created FROM turns WHERE session_id = ? ORDER BY created DESC LIMIT ?)",
+                             (session_id, session_id, self.max_turns))
+            self._db.commit()
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = self._db.execute("SELECT COUNT(DISTINCT session_id) FROM turns").fetchone()[0]
+            return {
+                'backend': 'sqlite',
+                'sessions': sessions,
+                'expired': self.expired,
+            }
+
+
+def create_conversation_store() -> ConversationStore:
+    if conversation_store_backend == "sqlite":
+        return SQLiteConversationStore(conversation_store_path, conversation_max_turns, conversation_idle_seconds)
+    if conversation_store_backend != "memory":
+        logging.warning(f"Unknown CONVERSATION_STORE '{conversation_store_backend}', falling back to 'memory'")
+    return MemoryConversationStore(conversation_max_turns, conversation_idle_seconds, conversation_max_sessions)
+
+
+conversation_store = create_conversation_store()
@@ -0,0 +1,109 @@
+import os
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, Optional
+
+import fitz  # PyMuPDF
+from langchain.document_loaders import TextLoader
+
+from .app_utils import LOADER_MAPPING
+
+# text based formats are read block by block instead of through their loader
+TEXT_EXTENSIONS = {ext for ext, (loader_class, _) in LOADER_MAPPING.items() if loader_class is TextLoader}
+TEXT_BLOCK_SIZE = 64 * 1024
+
+_END = object()
+
+
+def iter_document_segments(file_path: str) -> Iterator[str]:
+    """
+    Yields the text of a document piece by piece: PDFs page by page, text files block by block.
+    Other formats go through their LOADER_MAPPING loader, lazily where the loader supports it.
+    """
+    ext = os.path.splitext(file_path)[-1].lower()
+    if ext == ".pdf":
+        with fitz.open(file_path) as document:
+            for page in document:
+                yield page.get_text()
+    elif ext in TEXT_EXTENSIONS:
+        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+            for block in iter(lambda: f.read(TEXT_BLOCK_SIZE), ""):
+                yield block
+    elif ext in LOADER_MAPPING:
+        loader_class, loader_args = LOADER_MAPPING[ext]
+        loader = loader_class(file_path, **loader_args)
+        try:
+            documents = loader.lazy_load()
+        except NotImplementedError:
+            documents = loader.load()
+        for document in documents:
+            yield document.page_content
+    else:
+        raise ValueError(f"Unsupported file extension '{ext}'")
+
+
+def iter_text_chunks(segments: Iterable[str], chunk_size: int) -> Iterator[str]:
+    buffer = ""
+    for segment in segments:
+        buffer = f"{buffer}\n{segment}" if buffer else segment
+        while len(buffer) >= chunk_size:
+            yield buffer[:chunk_size]
+            buffer = buffer[chunk_size:]
+    if buffer:
+        yield buffer
+
+
+class LazyDocumentReader:
+    """
+    Reads a document chunk by chunk without parsing it whole.
+    A background thread keeps up to read_ahead chunks ready (already passed through transform, e.g. translated),
+    so the first chunk shows up as soon as it is parsed and the next one is usually waiting when it's asked for.
+    """
+
+    def __init__(self, file_path: str, chunk_size: int, read_ahead: int = 2, transform: Optional[Callable[[str], str]] = None):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.transform = transform
+        self._chunks = queue.Queue(maxsize=max(1, read_ahead))
+        self._closed = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._read, name="document-reader", daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self):
+        try:
+            for chunk in iter_text_chunks(iter_document_segments(self.file_path), self.chunk_size):
+                if self.transform is not None:
+                    chunk = self.transform(chunk)
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self._put(e)
+        self._put(_END)
+
+    def next_chunk(self) -> Optional[str]:
+        """
+        :return: The next chunk, None at the end of the document.
+        """
+        if self._done:
+            return None
+        item = self._chunks.get()
+        if item is _END:
+            self._done = True
+            return None
+        if isinstance(item, Exception):
+            self._done = True
+            raise ValueError(f"Problem with document {self.file_path}: \n'{item}'")
+        return item
+
+    def close(self):
+        self._closed.set()
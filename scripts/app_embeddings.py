@@ -0,0 +1,91 @@
+import atexit
+import logging
+from time import monotonic
+from typing import List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from sentence_transformers import SentenceTransformer
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    SentenceTransformer embeddings with an explicit batch size, and a multi-process encode pool on CPU.
+    Texts are sorted by length before encoding, so every batch holds texts of similar length and little padding is wasted,
+    the original order is restored afterwards. Throughput (chunks/s, tokens/s) is tracked over the lifetime of the object.
+    """
+
+    def __init__(self, model_name: str, device: str = "cpu", batch_size: int = 32, processes: int = 1, normalize_embeddings: bool = False, verbose: bool = False):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = max(1, batch_size)
+        self.processes = processes if device == "cpu" else 1
+        self.normalize_embeddings = normalize_embeddings
+        self.verbose = verbose
+        self.model = SentenceTransformer(model_name, device=device)
+        self.chunks_embedded = 0
+        self.tokens_embedded = 0
+        self.seconds_spent = 0.0
+        self._pool = None
+
+    def _get_pool(self) -> Optional[dict]:
+        if self.processes <= 1:
+            return None
+        if self._pool is None:
+            logging.info(f"Starting {self.processes} embedding processes")
+            self._pool = self.model.start_multi_process_pool(["cpu"] * self.processes)
+            atexit.register(self.close)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            SentenceTransformer.stop_multi_process_pool(self._pool)
+            self._pool = None
+
+    def _count_tokens(self, texts: List[str]) -> int:
+        return sum(len(input_ids) for input_ids in self.model.tokenizer(texts, add_special_tokens=False)["input_ids"])
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        start_time = monotonic()
+        texts = [text.replace("\n", " ") for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        sorted_texts = [texts[i] for i in order]
+
+        pool = self._get_pool()
+        if pool is not None and len(sorted_texts) > self.batch_size:
+            sorted_embeddings = self.model.encode_multi_process(sorted_texts, pool, batch_size=self.batch_size)
+            if self.normalize_embeddings:
+                sorted_embeddings = sorted_embeddings / np.linalg.norm(sorted_embeddings, axis=1, keepdims=True)
+        else:
+            sorted_embeddings = self.model.encode(sorted_texts, batch_size=self.batch_size, normalize_embeddings=self.normalize_embeddings,
+                                                  show_progress_bar=False, convert_to_numpy=True)
+
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+
+        elapsed = monotonic() - start_time
+        tokens = self._count_tokens(sorted_texts)
+        self.chunks_embedded += len(texts)
+        self.tokens_embedded += tokens
+        self.seconds_spent += elapsed
+        report = f"Embedded {len(texts)} chunks in {elapsed:.1f}s ({len(texts) / max(elapsed, 1e-9):.1f} chunks/s, {tokens / max(elapsed, 1e-9):.0f} tokens/s)"
+        if self.verbose:
+            print(report)
+        else:
+            logging.debug(report)
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.encode(text.replace("\n", " "), normalize_embeddings=self.normalize_embeddings, convert_to_numpy=True).tolist()
+
+    def throughput(self) -> dict:
+        seconds = max(self.seconds_spent, 1e-9)
+        return {
+            'chunks': self.chunks_embedded,
+            'tokens': self.tokens_embedded,
+            'seconds': round(self.seconds_spent, 2),
+            'chunks_per_second': round(self.chunks_embedded / seconds, 1),
+            'tokens_per_second': round(self.tokens_embedded / seconds, 1),
+        }
@@ -78,9 +78,15 @@ ingest_persist_directory = os.environ.get('INGEST_PERSIST_DIRECTORY', 'db')
 # Basic variables for ingestion
 ingest_source_directory = os.environ.get('INGEST_SOURCE_DIRECTORY', 'source_documents')
 ingest_embeddings_model = os.environ.get('INGEST_EMBEDDINGS_MODEL', 'all-MiniLM-L6-v2')
+ingest_embeddings_batch_size = int(os.environ.get("INGEST_EMBEDDINGS_BATCH_SIZE", "32"))
+# number of CPU processes encoding embeddings during ingest, 0 means half of the cores, 1 disables the pool
+ingest_embeddings_processes = int(os.environ.get("INGEST_EMBEDDINGS_PROCESSES", "0"))
 ingest_chunk_size = int(os.environ.get("INGEST_CHUNK_SIZE", "1000"))
 ingest_chunk_overlap = int(os.environ.get("INGEST_OVERLAP", "100"))
 ingest_target_source_chunks = int(os.environ.get('INGEST_TARGET_SOURCE_CHUNKS', '6'))
+ingest_batch_size = int(os.environ.get("INGEST_BATCH_SIZE", "256"))
+ingest_persist_every_n_batches = int(os.environ.get("INGEST_PERSIST_EVERY_N_BATCHES", "10"))
+ingest_max_files_in_flight = int(os.environ.get("INGEST_MAX_FILES_IN_FLIGHT", "16"))
 
 # Set the basic model settings
 model_type = os.environ.get("MODEL_TYPE", "llamacpp")
@@ -91,6 +97,9 @@ model_verbose = os.environ.get("MODEL_VERBOSE", "false") == "true"
 model_top_p = float(os.environ.get("MODEL_TOP_P", "0.9"))
 model_n_batch = int(os.environ.get('MODEL_N_BATCH', "1024"))
 model_n_answer_words = int(os.environ.get('MODEL_ANSWER_N_WORDS', "200"))
+# GPU memory llama.cpp layers are offloaded into, 0 = the free memory minus OFFLOAD_GPU_RESERVE_MB
+offload_gpu_budget_mb = int(os.environ.get("OFFLOAD_GPU_BUDGET_MB", "0"))
+offload_gpu_reserve_mb = int(os.environ.get("OFFLOAD_GPU_RESERVE_MB", "512"))
 
 # Settings specific for LLAMA
 model_path_or_id = os.environ.get("MODEL_ID_OR_PATH")
@@ -101,6 +110,20 @@ openai_use = os.environ.get("OPENAI_USE", "false") == "true"
 
 # Setting specific for Huggingface models
 huggingface_model_base_name = os.environ.get("MODEL_HF_BASE_NAME")
+# Questions asked at the same time are generated in one batch of up to HF_BATCH_MAX_SIZE prompts, 1 = no batching
+hf_batch_max_size = int(os.environ.get("HF_BATCH_MAX_SIZE", "1"))
+hf_batch_wait_ms = int(os.environ.get("HF_BATCH_WAIT_MS", "20"))
+hf_max_new_tokens = int(os.environ.get("HF_MAX_NEW_TOKENS", "512"))
+# Saved llama.cpp states of prompt prefixes, a prompt starting like an earlier one skips evaluating the shared tokens
+prompt_cache_enabled = os.environ.get("PROMPT_CACHE_ENABLED", "true") == "true"
+prompt_cache_max_states = int(os.environ.get("PROMPT_CACHE_MAX_STATES", "4"))
+prompt_cache_max_mb = int(os.environ.get("PROMPT_CACHE_MAX_MB", "2048"))
+# How a follow-up question is made standalone before the search: "llm" asks the answering model, "model" a smaller
+# llama.cpp model at CONDENSE_MODEL_PATH, "embedding" prepends the related earlier questions without a model call
+condense_mode = os.environ.get("CONDENSE_MODE", "llm")
+condense_model_path = os.environ.get("CONDENSE_MODEL_PATH", "")
+condense_max_tokens = int(os.environ.get("CONDENSE_MAX_TOKENS", "64"))
+condense_similarity_threshold = float(os.environ.get("CONDENSE_SIMILARITY_THRESHOLD", "0.5"))
 
 # Setting specific for GPT4All (can be llama or gptj)
 gpt4all_backend = os.environ.get("GPT4ALL_BACKEND", "gptj")
@@ -113,6 +136,32 @@ if str(is_cuda_available()).lower() == "true":
 
 # Setting specific for a database
 db_get_only_relevant_docs = os.environ.get("DB_GET_ONLY_RELEVANT_DOCS", "false") == "true"
+# Semantic cache of generated answers
+answer_cache_enabled = os.environ.get("ANSWER_CACHE_ENABLED", "false") == "true"
+answer_cache_similarity_threshold = float(os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95"))
+answer_cache_ttl_seconds = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "86400"))
+answer_cache_max_entries = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+answer_cache_path = os.environ.get("ANSWER_CACHE_PATH", "")
+# How many collections are searched concurrently when a question targets several of them
+retriever_fanout_workers = int(os.environ.get("RETRIEVER_FANOUT_WORKERS", "4"))
+# Optional second retrieval stage, RERANK_FETCH_K candidates are reranked and the best INGEST_TARGET_SOURCE_CHUNKS are kept
+rerank_enabled = os.environ.get("RERANK_ENABLED", "false") == "true"
+rerank_method = os.environ.get("RERANK_METHOD", "cross-encoder")
+rerank_fetch_k = int(os.environ.get("RERANK_FETCH_K", "20"))
+rerank_cross_encoder_model = os.environ.get("RERANK_CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+rerank_mmr_lambda = float(os.environ.get("RERANK_MMR_LAMBDA", "0.5"))
+rerank_token_budget = int(os.environ.get("RERANK_TOKEN_BUDGET", "0"))
+# Token budgets of the prompt, 0 = MODEL_N_CTX minus the tokens reserved for the template and the answer
+context_token_budget = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "0"))
+context_reserved_tokens = int(os.environ.get("CONTEXT_RESERVED_TOKENS", "512"))
+context_history_token_budget = int(os.environ.get("CONTEXT_HISTORY_TOKEN_BUDGET", "512"))
+context_history_max_turns = int(os.environ.get("CONTEXT_HISTORY_MAX_TURNS", "4"))
+# Chat histories of API clients, kept per session id in memory or in a SQLite file
+conversation_store_backend = os.environ.get("CONVERSATION_STORE", "memory")
+conversation_store_path = os.environ.get("CONVERSATION_STORE_PATH", "./cache/conversations.sqlite")
+conversation_max_turns = int(os.environ.get("CONVERSATION_MAX_TURNS", "10"))
+conversation_idle_seconds = int(os.environ.get("CONVERSATION_IDLE_SECONDS", "3600"))
+conversation_max_sessions = int(os.environ.get("CONVERSATION_MAX_SESSIONS", "1000"))
 
 # Set desired translation preferences
 translate_q = os.environ.get("TRANSLATE_QUESTION", "true") == "true"
@@ -120,16 +169,49 @@ translate_a = os.environ.get("TRANSLATE_ANSWER", "true") == "true"
 translate_docs = os.environ.get("TRANSLATE_DOCS", "true") == "true"
 translate_src = os.environ.get('TRANSLATE_SRC_LANG', "en")
 translate_dst = os.environ.get('TRANSLATE_DST_LANG', "hr")
+# "google" calls Google Translate over the network, "none" leaves texts untranslated (offline)
+translate_backend = os.environ.get("TRANSLATE_BACKEND", "google")
+translate_max_workers = int(os.environ.get("TRANSLATE_MAX_WORKERS", "8"))
+translate_cache_size = int(os.environ.get("TRANSLATE_CACHE_SIZE", "4096"))
+translate_cache_path = os.environ.get("TRANSLATE_CACHE_PATH", "")
+ingest_translate_chunks = os.environ.get("INGEST_TRANSLATE_CHUNKS", "false") == "true"
 
 # Set the desired column width and the number of columns
 cli_column_width = int(os.environ.get("CLI_COLUMN_WIDTH", "30"))
 cli_column_number = int(os.environ.get("CLI_COLUMN_NUMBER", "4"))
+# chunks parsed ahead of the one on screen when reading a document in scrapalot_browse.py
+browse_read_ahead_chunks = int(os.environ.get("BROWSE_READ_AHEAD_CHUNKS", "2"))
 
 # API
 api_host = os.environ.get("API_HOST", "0.0.0.0")
 api_port = int(os.environ.get("API_PORT", "8000"))
 api_scheme = os.environ.get("API_SCHEME", "http")
 api_base_url = os.environ.get("API_BASE_URL", f"{api_scheme}://{api_host}:{api_port}/api")
+# the API as the browsers of the Streamlit UI reach it, page images of PDF sources are loaded from there
+api_public_url = os.environ.get("API_PUBLIC_URL") or api_base_url
+api_client_timeout = float(os.environ.get("API_CLIENT_TIMEOUT", "30"))
+api_client_query_timeout = float(os.environ.get("API_CLIENT_QUERY_TIMEOUT", "600"))
+api_client_retries = int(os.environ.get("API_CLIENT_RETRIES", "3"))
+api_client_cache_ttl = int(os.environ.get("API_CLIENT_CACHE_TTL", "300"))
+api_worker_threads = int(os.environ.get("API_WORKER_THREADS", "4"))
+api_query_max_concurrency = int(os.environ.get("API_QUERY_MAX_CONCURRENCY", "1"))
+api_query_max_queue = int(os.environ.get("API_QUERY_MAX_QUEUE", "16"))
+# Replicas of the model loaded by the API, 0 = as many as fit the available RAM and cores
+model_pool_replicas = int(os.environ.get("MODEL_POOL_REPLICAS", "1"))
+model_pool_max_replicas = int(os.environ.get("MODEL_POOL_MAX_REPLICAS", "4"))
+model_pool_checkout_timeout = float(os.environ.get("MODEL_POOL_CHECKOUT_TIMEOUT", "120"))
+model_pool_max_queue = int(os.environ.get("MODEL_POOL_MAX_QUEUE", "16"))
+ingest_jobs_path = os.environ.get("INGEST_JOBS_PATH", "./cache/ingest_jobs.json")
+ingest_jobs_keep_finished = int(os.environ.get("INGEST_JOBS_KEEP_FINISHED", "100"))
+upload_max_file_mb = int(os.environ.get("UPLOAD_MAX_FILE_MB", "512"))
+upload_max_request_mb = int(os.environ.get("UPLOAD_MAX_REQUEST_MB", "2048"))
+upload_chunk_size_kb = int(os.environ.get("UPLOAD_CHUNK_SIZE_KB", "1024"))
+directory_index_max_size = int(os.environ.get("DIRECTORY_INDEX_MAX_SIZE", "64"))
+preview_cache_dir = os.environ.get("PREVIEW_CACHE_DIR", "./cache/previews")
+
+# Shared registries of embedding models and vector store handles
+registry_embeddings_max_size = int(os.environ.get("REGISTRY_EMBEDDINGS_MAX_SIZE", "2"))
+registry_vectorstores_max_size = int(os.environ.get("REGISTRY_VECTORSTORES_MAX_SIZE", "16"))
 
 
 def parse_arguments():
@@ -188,6 +270,22 @@ def parse_arguments():
         type=str,
         help="Name of the database directory",
     )
+    parser.add_argument(
+        "--resume",
+        action='store_true',
+        help="Continue an interrupted ingest from its last committed batch",
+    )
+    parser.add_argument(
+        "--plan-offload",
+        action='store_true',
+        help="Print how the llama.cpp model would be split between GPU and CPU, without loading it",
+    )
+    parser.add_argument(
+        "--gpu-memory-mb",
+        type=int,
+        default=None,
+        help="Free GPU memory to plan the offload with, instead of the memory of the actual GPU",
+    )
 
     return parser.parse_args()
 
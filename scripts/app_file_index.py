@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class IndexedFile:
+    id: str
+    name: str
+    # relative to the indexed directory, files are sorted by it
+    path: str
+
+
+def file_id(relative_path: str) -> str:
+    """
+    Derived from the path of the file within its directory, so it stays the same between listings and restarts.
+    """
+    return hashlib.sha256(relative_path.encode("utf-8")).hexdigest()[:16]
+
+
+def encode_cursor(relative_path: str) -> str:
+    return base64.urlsafe_b64encode(relative_path.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> str:
+    return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+
+
+class DirectoryIndex:
+    """
+    Sorted listing of all files below a directory, with the mtimes of every directory in the tree.
+    Adding, removing or renaming a file changes the mtime of the directory holding it,
+    so comparing these mtimes tells whether the listing is still valid without walking the files again.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files: List[IndexedFile] = []
+        self.directory_mtimes: Dict[str, int] = {}
+        self._paths: List[str] = []
+        self._build()
+
+    def _build(self):
+        files = []
+        for root, dirs, names in os.walk(self.directory):
+            self.directory_mtimes[root] = os.stat(root).st_mtime_ns
+            for name in names:
+                if not name.startswith('.'):
+                    relative_path = os.path.relpath(os.path.join(root, name), self.directory)
+                    files.append(IndexedFile(id=file_id(relative_path), name=name, path=relative_path))
+        self.files = sorted(files, key=lambda indexed_file: indexed_file.path)
+        self._paths = [indexed_file.path for indexed_file in self.files]
+
+    def is_current(self) -> bool:
+        try:
+            return all(os.stat(directory).st_mtime_ns == mtime for directory, mtime in self.directory_mtimes.items())
+        except FileNotFoundError:
+            return False
+
+    def page(self, cursor: Optional[str], limit: int, offset: int = 0) -> Tuple[List[IndexedFile], Optional[str]]:
+        """
+        :param cursor: Files after this one are returned, None for the first page.
+        :param offset: Only used without a cursor, for clients still paginating by page number.
+        :return: The files of the page, and the cursor of the next page (None after the last page).
+        """
+        start = bisect_right(self._paths, decode_cursor(cursor)) if cursor else offset
+        files = self.files[start:start + limit]
+        next_cursor = encode_cursor(files[-1].path) if files and start + limit < len(self.files) else None
+        return files, next_cursor
+
+
+class DirectoryIndexCache:
+    """
+    Keeps the indexes of the most recently listed directories, an index is rebuilt only after its directory tree changed.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self.hits = 0
+        self.rebuilds = 0
+        self._indexes: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, directory: str) -> DirectoryIndex:
+        directory = os.path.abspath(directory)
+        with self._lock:
+            index = self._indexes.get(directory)
+            if index is not None:
+                self._indexes.move_to_end(directory)
+
+        if index is not None and index.is_current():
+            with self._lock:
+                self.hits += 1
+            return index
+
+        index = DirectoryIndex(directory)
+        with self._lock:
+            self.rebuilds += 1
+            self._indexes[directory] = index
+            self._indexes.move_to_end(directory)
+            while len(self._indexes) > self.max_size:
+                self._indexes.popitem(last=False)
+        return index
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._indexes),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'rebuilds': self.rebuilds,
+            }
@@ -0,0 +1,124 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import Any, List, Optional, Tuple
+
+import torch
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from langchain.llms.utils import enforce_stop_tokens
+
+
+class HFBatchScheduler:
+    """
+    Collects prompts arriving at the same time from several requests, and generates all of them in a single padded `generate` call.
+    A batch is started as soon as max_batch_size prompts are waiting, or wait_ms after its first prompt arrived.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int, wait_ms: int, **generate_kwargs):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.wait_seconds = wait_ms / 1000
+        self.generate_kwargs = generate_kwargs
+        self.batches = 0
+        self.prompts = 0
+        self.generated_tokens = 0
+        self.generate_seconds = 0.0
+        # decoder-only models continue the text at the end of the row, padding goes to the left
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # a fast tokenizer can't be used by two threads at once, the token counter of the query threads shares it with the batches
+        self._tokenizer_lock = threading.Lock()
+        self._requests: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._work, name="hf-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str) -> Future:
+        future = Future()
+        self._requests.put((prompt, future))
+        return future
+
+    def generate(self, prompt: str) -> str:
+        return self.submit(prompt).result()
+
+    def count_tokens(self, text: str) -> int:
+        with self._tokenizer_lock:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        batch = [self._requests.get()]
+        deadline = monotonic() + self.wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._collect()
+            try:
+                outputs = self._generate([prompt for prompt, _ in batch])
+            except Exception as e:
+                logging.error(f"Batched generation of {len(batch)} prompts failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def _generate(self, prompts: List[str]) -> List[str]:
+        start_time = monotonic()
+        with self._tokenizer_lock:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        with torch.no_grad():
+            output_ids = self.model.generate(**inputs, pad_token_id=self.tokenizer.pad_token_id, **self.generate_kwargs)
+        # rows share the padded prompt length, everything after it was generated
+        new_ids = output_ids[:, inputs["input_ids"].shape[1]:]
+        with self._tokenizer_lock:
+            outputs = self.tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+
+        elapsed = monotonic() - start_time
+        generated = int((new_ids != self.tokenizer.pad_token_id).sum())
+        self.batches += 1
+        self.prompts += len(prompts)
+        self.generated_tokens += generated
+        self.generate_seconds += elapsed
+        logging.debug(f"Generated {len(prompts)} answers in one batch, {generated} tokens in {elapsed:.1f}s")
+        return outputs
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'avg_batch_size': round(self.prompts / max(self.batches, 1), 2),
+            'tokens_per_second': round(self.generated_tokens / max(self.generate_seconds, 1e-9), 1),
+        }
+
+
+class BatchedHuggingFacePipeline(LLM):
+    """
+    HuggingFace text generation through an HFBatchScheduler, safe to call from several threads at once.
+    """
+
+    scheduler: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "huggingface_batched"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None) -> str:
+        text = self.scheduler.generate(prompt)
+        if stop:
+            text = enforce_stop_tokens(text, stop)
+        if run_manager:
+            # the batch is generated as a whole, streaming callbacks get the answer in one piece
+            run_manager.on_llm_new_token(text)
+        return text
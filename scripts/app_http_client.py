@@ -0,0 +1,62 @@
+import socket
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+
+def keepalive_socket_options() -> list:
+    options = list(HTTPConnection.default_socket_options) + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options.append((socket.SOL_TCP, socket.TCP_KEEPIDLE, 45))
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        options.append((socket.SOL_TCP, socket.TCP_KEEPINTVL, 10))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        options.append((socket.SOL_TCP, socket.TCP_KEEPCNT, 6))
+    return options
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """
+    Enables TCP keepalive on the connections of this adapter only, the defaults of urllib3 are left untouched.
+    Long generations keep a streamed response idle for a while, keepalive stops proxies and NATs from dropping it.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = keepalive_socket_options()
+        super().init_poolmanager(*args, **kwargs)
+
+
+class APIClient:
+    """
+    A pooled HTTP client for the scrapalot API, reusing connections between calls.
+    Failed connections are retried for every method, 502/503/504 responses only for idempotent ones (honouring Retry-After),
+    so a question or an upload is never sent twice.
+    """
+
+    def __init__(self, base_url: str, timeout: float, query_timeout: float, retries: int = 3, connect_timeout: float = 5.0, pool_size: int = 4):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, timeout)
+        self.query_timeout = (connect_timeout, query_timeout)
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"GET", "HEAD"}), respect_retry_after_header=True, raise_on_status=False)
+        adapter = KeepAliveHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(f"{self.base_url}{path}", **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(f"{self.base_url}{path}", **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.delete(f"{self.base_url}{path}", **kwargs)
+
+    def close(self):
+        self.session.close()
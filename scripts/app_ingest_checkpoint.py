@@ -0,0 +1,137 @@
+import json
+import os
+from typing import Dict, List
+
+from .app_ingest_manifest import IngestManifest, file_content_hash
+
+CHECKPOINT_VERSION = 2
+
+
+class IngestCheckpoint:
+    """
+    Journal of a running ingest, written next to the persist directory.
+    The committed part (batch number, finished files, chunk ids of the file being written) only changes after Chroma has been persisted.
+    Ids of every batch are journaled as pending before the batch is written, so after a crash they can be deleted
+    and a batch that was never committed is never counted as done.
+    The journal is append-only, every record holds only the changes of one batch or commit, and it is replayed on load.
+    """
+
+    def __init__(self, checkpoint_path: str):
+        self.checkpoint_path = checkpoint_path
+        self.batch_number = 0
+        self.chunks_written = 0
+        self.files_done: Dict[str, List[str]] = {}
+        self.partial: Dict[str, dict] = {}
+        self.pending_ids: List[str] = []
+
+    @staticmethod
+    def get_checkpoint_path(persist_dir: str, collection_name: str) -> str:
+        return os.path.join(persist_dir, f"{collection_name}.checkpoint.jsonl")
+
+    @classmethod
+    def load(cls, persist_dir: str, collection_name: str) -> "IngestCheckpoint":
+        checkpoint = cls(cls.get_checkpoint_path(persist_dir, collection_name))
+        if os.path.exists(checkpoint.checkpoint_path):
+            with open(checkpoint.checkpoint_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last record may be cut short by a crash, it was never acknowledged
+                        break
+                    checkpoint._apply(record)
+        return checkpoint
+
+    def _apply(self, record: dict):
+        if "pending_ids" in record:
+            self.pending_ids.extend(record["pending_ids"])
+        if "committed" in record:
+            committed = record["committed"]
+            self.batch_number = committed["batch_number"]
+            self.chunks_written = committed["chunks_written"]
+            self.files_done.update(committed["files_done"])
+            self.partial = committed["partial"]
+            self.pending_ids = []
+
+    def is_interrupted(self) -> bool:
+        return os.path.exists(self.checkpoint_path)
+
+    def _append(self, record: dict):
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"version": CHECKPOINT_VERSION, **record}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite(self):
+        """
+        Compacts the journal into a single commit record.
+        """
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"version": CHECKPOINT_VERSION, "committed": self._committed(self.files_done), "pending_ids": self.pending_ids}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _committed(self, files_done: Dict[str, List[str]]) -> dict:
+        return {
+            "batch_number": self.batch_number,
+            "chunks_written": self.chunks_written,
+            "files_done": files_done,
+            "partial": self.partial,
+        }
+
+    def begin_batch(self, ids: List[str]):
+        """
+        Journals the ids of a batch before it is written to Chroma.
+        """
+        self.pending_ids.extend(ids)
+        self._append({"pending_ids": ids})
+
+    def commit(self, batch_number: int, chunks_written: int, files_done: Dict[str, List[str]], partial: Dict[str, List[str]]):
+        """
+        Marks everything written so far as durable, must only be called after Chroma has been persisted.
+        :param chunks_written: Chunks written by the ingest in total, including the runs it resumed.
+        :param files_done: Files finished since the previous commit.
+        """
+        self.batch_number = batch_number
+        self.chunks_written = chunks_written
+        self.files_done.update(files_done)
+        self.partial = {file_path: {"hash": file_content_hash(file_path), "ids": ids} for file_path, ids in partial.items()}
+        self.pending_ids = []
+        self._append({"committed": self._committed(files_done)})
+
+    def recover(self, chroma_db, manifest: IngestManifest, resume: bool) -> Dict[str, List[str]]:
+        """
+        Cleans up after an interrupted ingest: uncommitted chunks are deleted and finished files are recorded in the manifest.
+        When resuming, chunks already written for a partially ingested file are kept if the file didn't change in the meantime.
+        :return: The chunk ids already written per partially ingested file, to be skipped by the resumed run.
+        """
+        orphan_ids = list(self.pending_ids)
+        for file_path, ids in self.files_done.items():
+            # a changed file still has its stale entry, with the ids already purged, it is replaced
+            if os.path.exists(file_path):
+                manifest.record(file_path, ids)
+
+        resumed_partial = {}
+        for file_path, entry in self.partial.items():
+            if resume and os.path.exists(file_path) and file_content_hash(file_path) == entry["hash"]:
+                resumed_partial[file_path] = entry["ids"]
+            else:
+                orphan_ids.extend(entry["ids"])
+
+        if orphan_ids:
+            print(f"Deleting {len(orphan_ids)} chunks left behind by the interrupted ingest")
+            chroma_db._collection.delete(ids=orphan_ids)
+            chroma_db.persist()
+
+        self.pending_ids = []
+        self.partial = {file_path: self.partial[file_path] for file_path in resumed_partial}
+        self._rewrite()
+        manifest.save()
+        return resumed_partial
+
+    def finish(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
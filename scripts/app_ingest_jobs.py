@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from typing import Callable, List, Optional
+
+from .app_ingest_manifest import write_json_atomic
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+@dataclass
+class IngestJob:
+    id: str
+    database_name: str
+    collection_name: str
+    files: List[str] = field(default_factory=list)
+    status: str = JOB_QUEUED
+    files_total: int = 0
+    files_done: int = 0
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+
+class IngestJobQueue:
+    """
+    Persistent queue of ingest jobs, processed one at a time by a long-lived worker thread.
+    Uploads to a collection that already has a queued job are coalesced into that job, a single ingest run picks up all of them.
+    Jobs are written to disk on every state change, jobs interrupted by a restart are queued again.
+    """
+
+    def __init__(self, jobs_path: str, run_job: Callable[[IngestJob, Callable[[int, int], None]], None], keep_finished: int = 100):
+        self.jobs_path = jobs_path
+        self.run_job = run_job
+        self.keep_finished = keep_finished
+        self._jobs: OrderedDict = OrderedDict()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.jobs_path):
+            return
+        try:
+            with open(self.jobs_path, "r", encoding="utf-8") as f:
+                content = json.load(f)
+            for job_content in content.get("jobs", []):
+                job = IngestJob(**job_content)
+                if job.status == JOB_RUNNING:
+                    # interrupted by a restart, the ingest checkpoint lets it continue
+                    job.status = JOB_QUEUED
+                self._jobs[job.id] = job
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning(f"Could not load ingest jobs from {self.jobs_path}: {e}")
+
+    def _save(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in (JOB_DONE, JOB_FAILED)]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+        write_json_atomic(self.jobs_path, {"jobs": [asdict(job) for job in self._jobs.values()]})
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = threading.Thread(target=self._work, name="ingest-worker", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def submit(self, database_name: str, collection_name: str, files: List[str]) -> IngestJob:
+        with self._condition:
+            for job in self._jobs.values():
+                if job.status == JOB_QUEUED and job.database_name == database_name and job.collection_name == collection_name:
+                    job.files.extend(file for file in files if file not in job.files)
+                    self._save()
+                    return job
+
+            job = IngestJob(id=str(uuid.uuid4()), database_name=database_name, collection_name=collection_name, files=list(files))
+            self._jobs[job.id] = job
+            self._save()
+            self._condition.notify_all()
+            return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[IngestJob]:
+        with self._condition:
+            return list(self._jobs.values())
+
+    def queue_depth(self) -> int:
+        with self._condition:
+            return sum(1 for job in self._jobs.values() if job.status == JOB_QUEUED)
+
+    def _next_job(self) -> Optional[IngestJob]:
+        with self._condition:
+            while not self._stopped:
+                for job in self._jobs.values():
+                    if job.status == JOB_QUEUED:
+                        job.status = JOB_RUNNING
+                        job.started = time.time()
+                        self._save()
+                        return job
+                self._condition.wait()
+            return None
+
+    def _update_progress(self, job: IngestJob, files_done: int, files_total: int):
+        with self._condition:
+            job.files_done = files_done
+            job.files_total = files_total
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            logging.info(f"Ingest job {job.id} started for {job.database_name}/{job.collection_name}")
+            try:
+                self.run_job(job, lambda files_done, files_total: self._update_progress(job, files_done, files_total))
+                status, error = JOB_DONE, None
+            except BaseException as e:
+                # SystemExit included, ingest code may still exit on its own
+                logging.error(f"Ingest job {job.id} failed: {e}")
+                status, error = JOB_FAILED, str(e)
+
+            with self._condition:
+                job.status = status
+                job.error = error
+                job.finished = time.time()
+                self._save()
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+MANIFEST_VERSION = 1
+
+
+def write_json_atomic(file_path: str, content: dict):
+    """
+    Writes to a temporary file first and renames it over the target, a crash never leaves a truncated file behind.
+    """
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(content, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def file_content_hash(file_path: str, block_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+@dataclass
+class ManifestChanges:
+    new: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+
+    @property
+    def to_load(self) -> List[str]:
+        return self.new + self.changed
+
+    @property
+    def to_purge(self) -> List[str]:
+        return self.changed + self.removed
+
+
+class IngestManifest:
+    """
+    Persistent record of the files ingested into one collection, keyed by path.
+    Every entry keeps size, mtime and content hash of the file, plus the ids of the chunks it was split into,
+    so unchanged files are skipped and chunks of changed or removed files can be deleted by id.
+    """
+
+    def __init__(self, manifest_path: str, files: Optional[Dict[str, dict]] = None):
+        self.manifest_path = manifest_path
+        self.files: Dict[str, dict] = files or {}
+
+    @staticmethod
+    def get_manifest_path(persist_dir: str, collection_name: str) -> str:
+        return os.path.join(persist_dir, f"{collection_name}.manifest.json")
+
+    @classmethod
+    def load(cls, persist_dir: str, collection_name: str) -> "IngestManifest":
+        manifest_path = cls.get_manifest_path(persist_dir, collection_name)
+        if not os.path.exists(manifest_path):
+            return cls(manifest_path)
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            content = json.load(f)
+        return cls(manifest_path, content.get("files", {}))
+
+    def save(self):
+        write_json_atomic(self.manifest_path, {"version": MANIFEST_VERSION, "files": self.files})
+
+    def is_empty(self) -> bool:
+        return not self.files
+
+    def diff(self, file_paths: List[str]) -> ManifestChanges:
+        """
+        Compares the files found on disk with the manifest.
+        Size and mtime are checked first, the content is hashed only when they differ.
+        """
+        changes = ManifestChanges()
+        current = {os.path.normpath(file_path) for file_path in file_paths}
+
+        for file_path in sorted(current):
+            entry = self.files.get(file_path)
+            if entry is None:
+                changes.new.append(file_path)
+                continue
+
+            stat = os.stat(file_path)
+            if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+                changes.unchanged.append(file_path)
+            elif stat.st_size == entry["size"] and file_content_hash(file_path) == entry["hash"]:
+                # touched, but the content is the same
+                entry["mtime"] = stat.st_mtime
+                changes.unchanged.append(file_path)
+            else:
+                changes.changed.append(file_path)
+
+        changes.removed = [file_path for file_path in self.files if file_path not in current]
+        return changes
+
+    def chunk_ids(self, file_paths: List[str]) -> List[str]:
+        ids = []
+        for file_path in file_paths:
+            ids.extend(self.files.get(os.path.normpath(file_path), {}).get("ids", []))
+        return ids
+
+    def contains(self, file_path: str) -> bool:
+        return os.path.normpath(file_path) in self.files
+
+    def record(self, file_path: str, ids: List[str], content_hash: Optional[str] = None):
+        file_path = os.path.normpath(file_path)
+        stat = os.stat(file_path)
+        self.files[file_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": content_hash or file_content_hash(file_path),
+            "ids": ids,
+        }
+
+    def remove(self, file_path: str):
+        self.files.pop(os.path.normpath(file_path), None)
+
+    def bootstrap(self, ids: List[str], metadatas: List[dict]):
+        """
+        Builds the manifest of a collection ingested before manifests existed, from the ids and metadata stored in Chroma.
+        """
+        ids_by_source: Dict[str, List[str]] = {}
+        for chunk_id, metadata in zip(ids, metadatas):
+            source = metadata.get("source") if metadata else None
+            if source:
+                ids_by_source.setdefault(os.path.normpath(source), []).append(chunk_id)
+
+        for source, source_ids in ids_by_source.items():
+            if os.path.exists(source):
+                self.record(source, source_ids)
+            else:
+                # keep the ids, the file is gone and its chunks will be purged
+                self.files[source] = {"size": -1, "mtime": -1, "hash": "", "ids": source_ids}
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+from typing import Callable, Optional, TextIO
+
+from .app_ingest_jobs import IngestJob
+
+
+class IngestWorkerError(Exception):
+    pass
+
+
+class IngestWorkerProcess:
+    """
+    Runs ingest jobs in a dedicated long-lived process, started as its own interpreter, so it imports the ingest code and not the API.
+    Its embeddings model stays loaded between jobs, and the process pools of the ingest are started from a process without API threads.
+    Jobs are sent to its stdin and progress comes back on its stdout, one JSON line each, the ingest output goes to its stderr.
+    A worker that died is started again for the next job.
+    """
+
+    def __init__(self, args: Optional[list] = None):
+        # the worker parses the same command line arguments as the API
+        self.args = sys.argv[1:] if args is None else args
+        self._process: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> subprocess.Popen:
+        if self._process is None or self._process.poll() is not None:
+            logging.info("Starting the ingest worker process")
+            self._process = subprocess.Popen([sys.executable, "-m", "scripts.app_ingest_worker", *self.args], stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE, encoding="utf-8", bufsize=1)
+        return self._process
+
+    def run(self, job: IngestJob, on_progress: Callable[[int, int], None]):
+        """
+        Runs the job in the worker process, blocking until it finished.
+        """
+        with self._lock:
+            process = self._ensure_started()
+            try:
+                process.stdin.write(json.dumps({"database_name": job.database_name, "collection_name": job.collection_name}) + "\n")
+                process.stdin.flush()
+            except OSError as e:
+                raise IngestWorkerError(f"Could not send the job to the ingest worker: {e}")
+
+            for line in process.stdout:
+                event = json.loads(line)
+                if event["event"] == "progress":
+                    on_progress(event["files_done"], event["files_total"])
+                elif event["event"] == "done":
+                    return
+                else:
+                    raise IngestWorkerError(event["error"])
+            raise IngestWorkerError(f"The ingest worker exited with code {process.wait()}")
+
+    def stop(self):
+        """
+        Lets the worker exit after its current job, the job is queued again after a restart.
+        """
+        process = self._process
+        if process is not None and process.poll() is None:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+
+def serve(jobs: TextIO, events: TextIO):
+    """
+    The loop of the worker process, runs the jobs read from jobs until it is closed.
+    """
+    from scrapalot_ingest import main as ingest_main, create_embeddings
+
+    events_lock = threading.Lock()
+
+    def send(event: dict):
+        with events_lock:
+            events.write(json.dumps(event) + "\n")
+            events.flush()
+
+    embeddings = None
+    for line in jobs:
+        job = json.loads(line)
+        database_name = job["database_name"]
+        collection_name = job["collection_name"]
+        source_directory = f"./source_documents/{database_name}"
+        persist_directory = f"./db/{database_name}"
+        try:
+            os.makedirs(source_directory, exist_ok=True)
+            os.makedirs(persist_directory, exist_ok=True)
+            # loaded on the first job and kept warm afterwards
+            embeddings = embeddings or create_embeddings()
+            # interrupted jobs are queued again after a restart, their checkpoint lets them continue where they stopped
+            ingest_main(source_directory, persist_directory, database_name, collection_name if collection_name != database_name else None,
+                        embeddings=embeddings, resume=True,
+                        on_progress=lambda files_done, files_total: send({"event": "progress", "files_done": files_done, "files_total": files_total}))
+            send({"event": "done"})
+        except (Exception, SystemExit) as e:
+            # SystemExit included, ingest code may still exit on its own
+            send({"event": "failed", "error": str(e)})
+    if embeddings is not None:
+        embeddings.close()
+
+
+if __name__ == "__main__":
+    # stdout carries the events, everything printed by the ingest (from Python or native code) goes to stderr
+    events_stream = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    serve(sys.stdin, events_stream)
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Callable, Deque, List, Optional
+
+from .app_worker_pool import WorkerPoolSaturated
+
+try:
+    import psutil
+except ImportError:
+    # not installed on macOS
+    psutil = None
+
+# a loaded model takes about its file size, plus the KV cache and scratch buffers
+MODEL_MEMORY_OVERHEAD = 1.2
+# fewer threads than this make a single generation too slow to be worth another replica
+MIN_THREADS_PER_REPLICA = 4
+
+
+class LLMPoolTimeout(WorkerPoolSaturated):
+    """Raised when no model replica became free within the checkout timeout, or too many requests are waiting for one."""
+
+
+def auto_replica_count(model_path: Optional[str], n_threads: int, max_replicas: int, extra_bytes_per_replica: int = 0) -> int:
+    """
+    How many replicas of the model fit the available RAM, without giving a replica fewer than MIN_THREADS_PER_REPLICA of the n_threads.
+    :param extra_bytes_per_replica: Memory every replica may take besides the model, a prompt state cache for example.
+    """
+    model_bytes = os.path.getsize(model_path) if model_path and os.path.isfile(model_path) else 0
+    if psutil is None or not model_bytes:
+        logging.warning("Can't tell the available memory or the model size, using a single model replica")
+        return 1
+    by_memory = int(psutil.virtual_memory().available // (model_bytes * MODEL_MEMORY_OVERHEAD + extra_bytes_per_replica))
+    by_cores = n_threads // MIN_THREADS_PER_REPLICA
+    return max(1, min(by_memory, by_cores, max_replicas))
+
+
+@dataclass
+class LLMSlot:
+    index: int
+    instance: Any
+    busy: bool = False
+    checkouts: int = 0
+    busy_seconds: float = 0.0
+    last_change: float = field(default_factory=monotonic)
+
+    def stats(self) -> dict:
+        in_state = monotonic() - self.last_change
+        return {
+            'slot': self.index,
+            'busy': self.busy,
+            'checkouts': self.checkouts,
+            'busy_seconds': round(self.busy_seconds + (in_state if self.busy else 0), 1),
+            'idle_seconds': 0 if self.busy else round(in_state, 1),
+        }
+
+
+class LLMPool:
+    """
+    Replicas of the model, each used by one request at a time, a llama.cpp context can't generate for two requests at once.
+    A replica batching concurrent prompts itself is shared by up to slots_per_replica requests.
+    Requests check a slot out in FIFO order, and give up with LLMPoolTimeout when none became free in time.
+    With max_waiting requests already waiting, a request is rejected right away instead of waiting for the timeout.
+    """
+
+    def __init__(self, factory: Callable[[], Any], replicas: int, checkout_timeout: float, slots_per_replica: int = 1, max_waiting: int = 16):
+        self.factory = factory
+        self.replicas = max(1, replicas)
+        self.slots_per_replica = max(1, slots_per_replica)
+        self.checkout_timeout = checkout_timeout
+        self.max_waiting = max(0, max_waiting)
+        self.timeouts = 0
+        self.rejected = 0
+        self.slots: List[LLMSlot] = []
+        self._idle: Deque[LLMSlot] = deque()
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def start(self):
+        """
+        Loads every replica, blocking.
+        """
+        while len(self.slots) < self.capacity:
+            logging.info(f"Loading model replica {len(self.slots) // self.slots_per_replica + 1}/{self.replicas}")
+            instance = self.factory()
+            for _ in range(self.slots_per_replica):
+                slot = LLMSlot(len(self.slots), instance)
+                self.slots.append(slot)
+                self._idle.append(slot)
+
+    @property
+    def capacity(self) -> int:
+        return self.replicas * self.slots_per_replica
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def _acquire(self) -> LLMSlot:
+        if self._idle and not self._waiters:
+            return self._idle.popleft()
+        if len(self._waiters) >= self.max_waiting:
+            self.rejected += 1
+            raise LLMPoolTimeout(f"{len(self._waiters)} requests are already waiting for a model replica")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # shielded, a slot handed over just as the wait times out is not lost
+            return await asyncio.wait_for(asyncio.shield(waiter), self.checkout_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                if isinstance(e, asyncio.TimeoutError):
+                    return waiter.result()
+                self._release(waiter.result())
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise LLMPoolTimeout(f"no model replica became free within {self.checkout_timeout}s")
+            raise
+
+    def _release(self, slot: LLMSlot):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(slot)
+                return
+        self._idle.append(slot)
+
+    @asynccontextmanager
+    async def checkout(self):
+        """
+        Yields a model replica for the exclusive use of one request.
+        """
+        slot = await self._acquire()
+        now = monotonic()
+        slot.busy, slot.last_change = True, now
+        slot.checkouts += 1
+        try:
+            yield slot.instance
+        finally:
+            now = monotonic()
+            slot.busy_seconds += now - slot.last_change
+            slot.busy, slot.last_change = False, now
+            self._release(slot)
+
+    def stats(self) -> dict:
+        return {
+            'replicas': len(self.slots) // self.slots_per_replica,
+            'busy': sum(1 for slot in self.slots if slot.busy),
+            'queue_depth': self.waiting,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'slots': [slot.stats() for slot in self.slots],
+        }
@@ -0,0 +1,235 @@
+import logging
+import os
+import re
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO, List, Optional, Tuple
+
+try:
+    import psutil
+except ImportError:
+    # not installed on macOS
+    psutil = None
+
+MB = 1024 ** 2
+
+GGML_MAGICS = {b"lmgg": "ggml", b"fmgg": "ggmf", b"tjgg": "ggjt"}
+# (elements per block, bytes per block) of the ggml tensor types
+GGML_BLOCK_SIZES = {
+    0: (1, 4),  # F32
+    1: (1, 2),  # F16
+    2: (32, 18),  # Q4_0
+    3: (32, 20),  # Q4_1
+    6: (32, 22),  # Q5_0
+    7: (32, 24),  # Q5_1
+    8: (32, 34),  # Q8_0
+    9: (32, 40),  # Q8_1
+    10: (256, 84),  # Q2_K
+    11: (256, 110),  # Q3_K
+    12: (256, 144),  # Q4_K
+    13: (256, 176),  # Q5_K
+    14: (256, 210),  # Q6_K
+    15: (256, 292),  # Q8_K
+}
+# before ggjt v3 the Q4 and Q8 blocks had 32 bit scales, the Q5 blocks had 16 bit scales from the start
+GGML_LEGACY_BLOCK_SIZES = {**GGML_BLOCK_SIZES, 2: (32, 20), 3: (32, 24), 8: (32, 36)}
+GGML_FTYPE_NAMES = {0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1", 10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M",
+                    13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K"}
+LAYER_TENSOR = re.compile(r"^layers\.(\d+)\.")
+
+# CUDA context and cuBLAS workspace, not reported by the model file
+GPU_OVERHEAD_MB = 300
+# llama.cpp keeps a VRAM scratch buffer of one MB per token of the batch
+VRAM_SCRATCH_BYTES_PER_BATCH_TOKEN = MB
+MIN_N_BATCH = 64
+
+
+@dataclass
+class ModelMetadata:
+    path: str
+    format: str
+    version: int
+    n_vocab: int
+    n_embd: int
+    n_head: int
+    n_layer: int
+    ftype: int
+    layer_bytes: List[int]
+    output_bytes: int
+    other_bytes: int
+
+    @property
+    def quantization(self) -> str:
+        return GGML_FTYPE_NAMES.get(self.ftype, f"ftype {self.ftype}")
+
+    def kv_bytes_per_layer(self, n_ctx: int) -> int:
+        # keys and values of every context position, in F16
+        return 2 * n_ctx * self.n_embd * 2
+
+
+def _read_int32s(file: BinaryIO, count: int) -> Tuple[int, ...]:
+    data = file.read(4 * count)
+    if len(data) != 4 * count:
+        raise ValueError("unexpected end of file")
+    return struct.unpack(f"<{count}i", data)
+
+
+def read_ggml_metadata(path: str) -> ModelMetadata:
+    """
+    Reads the hyperparameters and the tensor sizes of a ggml/ggmf/ggjt (llama.cpp) model file, skipping over the tensor data.
+    """
+    with open(path, "rb") as file:
+        magic = file.read(4)
+        if magic not in GGML_MAGICS:
+            raise ValueError(f"{path} is not a llama.cpp ggml model file")
+        model_format = GGML_MAGICS[magic]
+        version = _read_int32s(file, 1)[0] if model_format != "ggml" else 0
+        n_vocab, n_embd, _n_mult, n_head, n_layer, _n_rot, ftype = _read_int32s(file, 7)
+
+        for _ in range(n_vocab):
+            (length,) = _read_int32s(file, 1)
+            # the token text, and its score in the versioned formats
+            file.seek(length + (4 if model_format != "ggml" else 0), os.SEEK_CUR)
+
+        block_sizes = GGML_BLOCK_SIZES if model_format == "ggjt" and version >= 3 else GGML_LEGACY_BLOCK_SIZES
+        layer_bytes = [0] * n_layer
+        output_bytes = other_bytes = 0
+        while True:
+            header = file.read(12)
+            if not header:
+                break
+            n_dims, name_length, tensor_type = struct.unpack("<3i", header)
+            n_elements = 1
+            for dim in _read_int32s(file, n_dims):
+                n_elements *= dim
+            name = file.read(name_length).decode("utf-8", errors="replace")
+            if tensor_type not in block_sizes:
+                raise ValueError(f"tensor {name} has the unsupported type {tensor_type}")
+            block_elements, block_bytes = block_sizes[tensor_type]
+            size = n_elements // block_elements * block_bytes
+            if model_format == "ggjt":
+                # tensor data is aligned to 32 bytes
+                file.seek(-file.tell() & 31, os.SEEK_CUR)
+            file.seek(size, os.SEEK_CUR)
+
+            match = LAYER_TENSOR.match(name)
+            if match and int(match.group(1)) < n_layer:
+                layer_bytes[int(match.group(1))] += size
+            elif name.startswith("output") or name == "norm.weight":
+                output_bytes += size
+            else:
+                other_bytes += size
+
+    return ModelMetadata(path, model_format, version, n_vocab, n_embd, n_head, n_layer, ftype, layer_bytes, output_bytes, other_bytes)
+
+
+@dataclass
+class OffloadPlan:
+    n_gpu_layers: int
+    n_batch: int
+    n_threads: int
+    n_ctx: int
+    gpu_budget_bytes: int
+    gpu_bytes: int
+    cpu_bytes: int
+    metadata: Optional[ModelMetadata] = None
+    notes: List[str] = field(default_factory=list)
+
+    def describe(self) -> List[str]:
+        lines = []
+        if self.metadata:
+            meta = self.metadata
+            lines.append(f"Model: {os.path.basename(meta.path)} ({meta.format} v{meta.version}, {meta.quantization}), {meta.n_layer} layers, "
+                         f"{sum(meta.layer_bytes) / MB:.0f} MB of layers, {(meta.output_bytes + meta.other_bytes) / MB:.0f} MB of embeddings and output")
+            lines.append(f"KV cache at n_ctx={self.n_ctx}: {meta.kv_bytes_per_layer(self.n_ctx) * meta.n_layer / MB:.0f} MB")
+        lines.append(f"GPU budget: {self.gpu_budget_bytes / MB:.0f} MB, planned GPU use: {self.gpu_bytes / MB:.0f} MB")
+        lines.append(f"Planned RAM use: {self.cpu_bytes / MB:.0f} MB")
+        lines.append(f"n_gpu_layers={self.n_gpu_layers} n_batch={self.n_batch} n_threads={self.n_threads}")
+        return lines + self.notes
+
+
+def _offloaded_bytes(meta: ModelMetadata, n_gpu_layers: int, n_ctx: int) -> int:
+    """
+    VRAM taken by the weights and caches llama.cpp moves to the GPU for n_gpu_layers:
+    the last layers first, then the output, then the V and the K cache.
+    """
+    n_layer = meta.n_layer
+    kv_half = meta.kv_bytes_per_layer(n_ctx) * n_layer // 2
+    offloaded = sum(meta.layer_bytes[n_layer - min(n_gpu_layers, n_layer):])
+    if n_gpu_layers > n_layer:
+        offloaded += meta.output_bytes
+    if n_gpu_layers > n_layer + 1:
+        offloaded += kv_half
+    if n_gpu_layers > n_layer + 2:
+        offloaded += kv_half
+    return offloaded
+
+
+def _batch_candidates(n_batch: int, n_ctx: int) -> List[int]:
+    n_batch = max(1, min(n_batch, n_ctx))
+    candidates = [n_batch]
+    while candidates[-1] // 2 >= MIN_N_BATCH:
+        candidates.append(candidates[-1] // 2)
+    return candidates
+
+
+def plan_offload(meta: Optional[ModelMetadata], n_ctx: int, n_batch: int, gpu_budget_bytes: int, cpu_threads: int, gpu_threads: int) -> OffloadPlan:
+    """
+    Picks the most layers that fit the GPU budget with the largest n_batch (at most the requested one),
+    a smaller batch is taken only when its smaller scratch buffer lets more layers fit.
+    Fully offloaded models run with gpu_threads, the layers left on the CPU need cpu_threads.
+    """
+    if meta is None:
+        return OffloadPlan(0, min(n_batch, n_ctx), cpu_threads, n_ctx, gpu_budget_bytes, 0, 0,
+                           notes=["Model metadata unknown, nothing is offloaded to the GPU"])
+
+    max_layers = meta.n_layer + 3
+    best: Optional[Tuple[int, int]] = None
+    if gpu_budget_bytes > 0:
+        for candidate in _batch_candidates(n_batch, n_ctx):
+            available = gpu_budget_bytes - candidate * VRAM_SCRATCH_BYTES_PER_BATCH_TOKEN
+            layers = 0
+            while layers < max_layers and _offloaded_bytes(meta, layers + 1, n_ctx) <= available:
+                layers += 1
+            if best is None or layers > best[0]:
+                best = (layers, candidate)
+            if layers == max_layers:
+                break
+    n_gpu_layers, planned_batch = best if best and best[0] > 0 else (0, min(n_batch, n_ctx))
+
+    gpu_bytes = _offloaded_bytes(meta, n_gpu_layers, n_ctx) + (planned_batch * VRAM_SCRATCH_BYTES_PER_BATCH_TOKEN if n_gpu_layers else 0)
+    total_bytes = sum(meta.layer_bytes) + meta.output_bytes + meta.other_bytes + meta.kv_bytes_per_layer(n_ctx) * meta.n_layer
+    cpu_bytes = total_bytes - _offloaded_bytes(meta, n_gpu_layers, n_ctx)
+    n_threads = min(gpu_threads, cpu_threads) if n_gpu_layers >= meta.n_layer else cpu_threads
+
+    plan = OffloadPlan(n_gpu_layers, planned_batch, n_threads, n_ctx, gpu_budget_bytes, gpu_bytes, cpu_bytes, meta)
+    if 0 < n_gpu_layers < meta.n_layer:
+        plan.notes.append(f"{meta.n_layer - n_gpu_layers} of {meta.n_layer} layers stay on the CPU")
+    if planned_batch < min(n_batch, n_ctx):
+        plan.notes.append(f"n_batch lowered from {min(n_batch, n_ctx)} to {planned_batch} to fit more layers on the GPU")
+    if psutil is not None and cpu_bytes > psutil.virtual_memory().available:
+        plan.notes.append(f"The model needs more RAM than the {psutil.virtual_memory().available / MB:.0f} MB available")
+    return plan
+
+
+def free_gpu_memory_bytes() -> int:
+    import torch
+    return int(torch.cuda.mem_get_info()[0]) if torch.cuda.is_available() else 0
+
+
+def gpu_budget(free_bytes: int, reserve_mb: int, budget_mb: int) -> int:
+    """
+    :param budget_mb: Fixed budget, 0 uses the free memory minus reserve_mb and the CUDA overhead.
+    """
+    if budget_mb > 0:
+        return budget_mb * MB
+    return max(0, free_bytes - (reserve_mb + GPU_OVERHEAD_MB) * MB)
+
+
+def load_metadata(model_path: Optional[str]) -> Optional[ModelMetadata]:
+    try:
+        return read_ggml_metadata(model_path)
+    except (OSError, ValueError, TypeError, struct.error) as e:
+        logging.warning(f"Can't read the metadata of model {model_path}: {e}")
+        return None
+
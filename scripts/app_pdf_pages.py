@@ -0,0 +1,60 @@
+import re
+from typing import Optional, Tuple
+
+import fitz  # PyMuPDF
+
+BYTE_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_byte_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single range of a Range header, multipart ranges are not supported and answered with the whole content.
+    :return: The first and last byte (inclusive), None when the header is missing or not understood.
+    :raises ValueError: If the range is not satisfiable.
+    """
+    match = BYTE_RANGE_PATTERN.match((range_header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # the last n bytes
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first > last or first >= size:
+        raise ValueError(f"Range not satisfiable for {size} bytes")
+    return first, last
+
+
+def read_byte_range(file_path: str, first: int, last: int) -> bytes:
+    with open(file_path, "rb") as f:
+        f.seek(first)
+        return f.read(last - first + 1)
+
+
+def pdf_info(file_path: str) -> dict:
+    with fitz.open(file_path) as document:
+        return {
+            'page_count': document.page_count,
+            # sizes in points, lets a viewer reserve space for pages not loaded yet
+            'page_sizes': [[page.rect.width, page.rect.height] for page in document],
+        }
+
+
+def extract_pdf_pages(file_path: str, start: int, end: int) -> bytes:
+    """
+    Copies pages start..end (0-based, inclusive) into a new PDF, without rendering them.
+    """
+    with fitz.open(file_path) as document, fitz.open() as extract:
+        if not 0 <= start <= end < document.page_count:
+            raise IndexError(f"Pages {start}-{end} out of range, the document has {document.page_count} pages")
+        extract.insert_pdf(document, from_page=start, to_page=end)
+        return extract.tobytes(garbage=2, deflate=True)
+
+
+def render_pdf_page(file_path: str, page_number: int, zoom: float) -> bytes:
+    with fitz.open(file_path) as document:
+        if not 0 <= page_number < document.page_count:
+            raise IndexError(f"Page {page_number} out of range, the document has {document.page_count} pages")
+        pixmap = document[page_number].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return pixmap.tobytes("png")
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import ebooklib
+import mammoth
+from bs4 import BeautifulSoup
+from ebooklib import epub
+
+from .app_ingest_manifest import file_content_hash, write_json_atomic
+
+# bump whenever the rendered HTML or its layout on disk changes, previews of older renderers are rendered again
+PREVIEW_RENDERER_VERSION = 2
+# written once every chapter of a preview is on disk
+PREVIEW_INDEX_FILE = "chapters.json"
+
+
+def docx_to_chapters(docx_path: str) -> Iterator[str]:
+    # mammoth converts the document as a whole
+    with open(docx_path, "rb") as docx_file:
+        yield mammoth.convert_to_html(docx_file).value
+
+
+def epub_to_chapters(epub_path: str) -> Iterator[str]:
+    book = epub.read_epub(epub_path)
+    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+        soup = BeautifulSoup(item.get_content().decode("utf-8"), 'html.parser')
+        for tag in soup.find_all(['img', 'image', 'svg']):
+            tag.decompose()
+        yield str(soup)
+
+
+PREVIEW_RENDERERS: Dict[str, Callable[[str], Iterator[str]]] = {
+    ".docx": docx_to_chapters,
+    ".epub": epub_to_chapters,
+}
+
+
+def chapters_to_html(chapters: List[str]) -> str:
+    return "".join(["<html><body>", *chapters, "</body></html>"])
+
+
+class _Render:
+    def __init__(self):
+        self.rendered = 0
+        self.done = False
+        self.error: Optional[Exception] = None
+
+
+class PreviewCache:
+    """
+    HTML previews of documents the browser can't display, rendered once and kept on disk one file per chapter.
+    A preview is rendered in the background chapter by chapter, a request returns as soon as the chapter it asks for exists.
+    Previews are keyed by content hash and renderer version, so a renamed file keeps its preview and a changed one gets a new one.
+    Hashes of the max_hashes most recently viewed files are remembered per (path, size, mtime), such a file is read again only after it changed.
+    """
+
+    def __init__(self, cache_dir: str, max_hashes: int = 10000):
+        self.cache_dir = cache_dir
+        self.max_hashes = max(1, max_hashes)
+        self.hits = 0
+        self.renders = 0
+        self._hashes: OrderedDict[Tuple[str, int, int], str] = OrderedDict()
+        # renders in progress by preview directory, concurrent views of the same new document share one
+        self._renders: Dict[str, _Render] = {}
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    @staticmethod
+    def supports(file_path: str) -> bool:
+        return os.path.splitext(file_path)[-1].lower() in PREVIEW_RENDERERS
+
+    def _content_hash(self, file_path: str, stat: os.stat_result) -> str:
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            content_hash = self._hashes.get(key)
+            if content_hash is not None:
+                self._hashes.move_to_end(key)
+        if content_hash is None:
+            content_hash = file_content_hash(file_path)
+            with self._lock:
+                self._hashes[key] = content_hash
+                while len(self._hashes) > self.max_hashes:
+                    self._hashes.popitem(last=False)
+        return content_hash
+
+    def etag(self, file_path: str) -> str:
+        """
+        Cheap enough to check a conditional GET before the preview is loaded.
+        """
+        return f'"{self._content_hash(file_path, os.stat(file_path))}-{PREVIEW_RENDERER_VERSION}"'
+
+    @staticmethod
+    def last_modified(file_path: str) -> str:
+        return formatdate(os.stat(file_path).st_mtime, usegmt=True)
+
+    def _preview_dir(self, file_path: str) -> str:
+        return os.path.join(self.cache_dir, f"{self._content_hash(file_path, os.stat(file_path))}-v{PREVIEW_RENDERER_VERSION}")
+
+    @staticmethod
+    def _chapter_count(preview_dir: str) -> Optional[int]:
+        """
+        :return: The number of chapters of a completely rendered preview, None while it isn't.
+        """
+        try:
+            with open(os.path.join(preview_dir, PREVIEW_INDEX_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)["chapters"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _read_chapter(preview_dir: str, index: int) -> str:
+        with open(os.path.join(preview_dir, f"{index}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["html"]
+
+    def _render(self, file_path: str, preview_dir: str, render: _Render):
+        error = None
+        try:
+            rendered = 0
+            for chapter in PREVIEW_RENDERERS[os.path.splitext(file_path)[-1].lower()](file_path):
+                write_json_atomic(os.path.join(preview_dir, f"{rendered}.json"), {"html": chapter})
+                rendered += 1
+                with self._condition:
+                    render.rendered = rendered
+                    self._condition.notify_all()
+            write_json_atomic(os.path.join(preview_dir, PREVIEW_INDEX_FILE), {"version": PREVIEW_RENDERER_VERSION, "chapters": rendered})
+        except Exception as e:
+            logging.warning(f"Could not render the preview of {file_path}: {e}")
+            error = e
+        with self._condition:
+            render.done, render.error = True, error
+            self._renders.pop(preview_dir, None)
+            self._condition.notify_all()
+
+    def _wait_for_render(self, file_path: str, preview_dir: str, until: Callable[[_Render], bool]) -> _Render:
+        with self._condition:
+            render = self._renders.get(preview_dir)
+            if render is None and self._chapter_count(preview_dir) is not None:
+                # finished since the caller looked
+                render = _Render()
+                render.rendered, render.done = self._chapter_count(preview_dir), True
+                return render
+            if render is None:
+                render = self._renders[preview_dir] = _Render()
+                self.renders += 1
+                threading.Thread(target=self._render, args=(file_path, preview_dir, render), name="preview-render", daemon=True).start()
+            self._condition.wait_for(lambda: render.done or until(render))
+        # chapters rendered before a failure can still be read
+        if render.error is not None and not until(render):
+            raise render.error
+        return render
+
+    def get_chapter(self, file_path: str, index: int) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Starts rendering the preview on the first request, and returns as soon as the chapter is rendered,
+        blocking, to be called off the event loop.
+        :return: The chapter (None past the last one), and the number of chapters (None while they are still being rendered).
+        """
+        preview_dir = self._preview_dir(file_path)
+        count = self._chapter_count(preview_dir)
+        if count is None:
+            render = self._wait_for_render(file_path, preview_dir, lambda r: r.rendered > index)
+            count = self._chapter_count(preview_dir) if render.done else None
+            available = render.rendered
+        else:
+            with self._lock:
+                self.hits += 1
+            available = count
+        return (self._read_chapter(preview_dir, index) if index < available else None), count
+
+    def get_chapters(self, file_path: str) -> List[str]:
+        """
+        Every chapter of the preview, waiting for the render to finish, blocking, to be called off the event loop.
+        """
+        preview_dir = self._preview_dir(file_path)
+        count = self._chapter_count(preview_dir)
+        if count is None:
+            count = self._wait_for_render(file_path, preview_dir, lambda r: False).rendered
+        else:
+            with self._lock:
+                self.hits += 1
+        return [self._read_chapter(preview_dir, index) for index in range(count)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'renders': self.renders,
+                'rendering': len(self._renders),
+            }
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Sequence, Tuple
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms import LlamaCpp
+from llama_cpp import BaseLlamaCache, Llama, LlamaState
+
+
+class PromptStateCache(BaseLlamaCache):
+    """
+    Saved llama.cpp states of one model, keyed by the tokens evaluated into them.
+    A prompt starting like a saved state (the static instructions of a template, an earlier turn of the conversation)
+    is loaded from it, and only the tokens after the shared prefix are evaluated.
+    The least recently used states are dropped beyond max_states or capacity_bytes.
+    """
+
+    def __init__(self, capacity_bytes: int, max_states: int):
+        super().__init__(capacity_bytes)
+        self.max_states = max(1, max_states)
+        self.hits = 0
+        self._states: OrderedDict[Tuple[int, ...], LlamaState] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self._states.values())
+
+    def longest_prefix(self, tokens: Sequence[int]) -> Tuple[Optional[Tuple[int, ...]], int]:
+        """
+        :return: The key of the saved state sharing the longest prefix with tokens, and the length of that prefix.
+        """
+        best_key, best_len = None, 0
+        for key in self._states.keys():
+            prefix_len = Llama.longest_token_prefix(key, tokens)
+            if prefix_len > best_len:
+                best_key, best_len = key, prefix_len
+        return best_key, best_len
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        with self._lock:
+            best_key, _ = self.longest_prefix(tuple(key))
+            if best_key is None:
+                raise KeyError("No saved state shares a prefix with the prompt")
+            self._states.move_to_end(best_key)
+            self.hits += 1
+            return self._states[best_key]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            return self.longest_prefix(tuple(key))[0] is not None
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        key = tuple(key)
+        with self._lock:
+            self._states.pop(key, None)
+            self._states[key] = value
+            while len(self._states) > 1 and (len(self._states) > self.max_states or self.cache_size > self.capacity_bytes):
+                self._states.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'states': len(self._states),
+                'size_mb': round(self.cache_size / (1024 ** 2), 1),
+                'hits': self.hits,
+            }
+
+
+class PromptCachingLlamaCpp(LlamaCpp):
+    """
+    LlamaCpp counting the prompt tokens which didn't have to be evaluated,
+    because they were still in the context from the previous prompt or were loaded from a PromptStateCache.
+    """
+
+    prompt_tokens: int = 0
+    skipped_tokens: int = 0
+
+    def reusable_tokens(self, tokens: List[int]) -> int:
+        reusable = Llama.longest_token_prefix(self.client.eval_tokens, tokens)
+        if isinstance(self.client.cache, PromptStateCache):
+            reusable = max(reusable, self.client.cache.longest_prefix(tokens)[1])
+        # the last prompt token is always evaluated again, its logits start the answer
+        return min(reusable, max(len(tokens) - 1, 0))
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        # tokenized the way Llama.create_completion does it
+        tokens = self.client.tokenize(b" " + prompt.encode("utf-8"))
+        self.prompt_tokens += len(tokens)
+        self.skipped_tokens += self.reusable_tokens(tokens)
+        return super()._call(prompt, stop, run_manager, **kwargs)
+
+    def stats(self) -> dict:
+        stats = self.client.cache.stats() if isinstance(self.client.cache, PromptStateCache) else {}
+        return {
+            **stats,
+            'prompt_tokens': self.prompt_tokens,
+            'skipped_tokens': self.skipped_tokens,
+        }
+
+
+def skipped_prompt_tokens(llm) -> int:
+    """
+    Prompt tokens the model didn't evaluate so far, 0 for models without a prompt cache.
+    """
+    return getattr(llm, "skipped_tokens", 0)
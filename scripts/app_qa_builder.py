@@ -1,18 +1,59 @@
+import asyncio
 import os
 import textwrap
-from typing import Optional
+from typing import List, Optional, Tuple
 from urllib.request import pathname2url
 
-from deep_translator import GoogleTranslator
 from langchain import PromptTemplate
-from langchain.chains import ConversationalRetrievalChain
+from langchain.callbacks.manager import Callbacks
 from langchain.chains.retrieval_qa.base import BaseRetrievalQA
-from langchain.embeddings import OpenAIEmbeddings, HuggingFaceEmbeddings
-from langchain.vectorstores import Chroma
 from openai.error import AuthenticationError
 
-from .app_environment import translate_dst, translate_src, translate_docs, translate_q, ingest_target_source_chunks, args, openai_use, ingest_embeddings_model, gpu_is_enabled, \
-    chromaDB_manager
+from .app_answer_cache import answer_cache, collections_version
+from .app_condense import CONDENSE_TEMPLATE, CondensingRetrievalChain, QuestionCondenser, create_condenser
+from .app_context_packer import ContextPacker, ContextPackingRetriever, get_token_counter
+from .app_environment import translate_dst, translate_src, translate_docs, translate_q, ingest_target_source_chunks, args, answer_cache_enabled, model_path_or_id, model_type, \
+    rerank_enabled, rerank_fetch_k, rerank_token_budget, model_n_ctx, context_token_budget, context_reserved_tokens, context_history_token_budget, \
+    context_history_max_turns, ingest_chunk_overlap
+from .app_registry import get_embeddings, get_vectorstore
+from .app_rerank import RerankingRetriever, create_reranker
+from .app_retrievers import FederatedRetriever
+from .app_translation import translation_service
+
+
+# the instructions come first and don't depend on the question, llama.cpp reuses their evaluated state between questions
+QA_TEMPLATE = """You are a an AI assistant providing helpful advice. You are given the following extracted parts of a long document and a question.
+    Provide a conversational answer based on the context provided.
+    If you can't find the answer in the context below, just say
+    "Hmm, I'm not sure." Don't try to make up an answer. If the question is not related to the context, politely respond
+    that you are tuned to only answer questions that are related to the context.
+
+    =========
+    {context}
+    =========
+    Question: {question}
+    Answer (about {answer_length} words):"""
+
+
+# one packer per model, its token counts are memoized
+context_packers = {}
+
+
+def get_context_packer(llm) -> ContextPacker:
+    if id(llm) not in context_packers:
+        budget = context_token_budget if context_token_budget > 0 else int(model_n_ctx) - context_reserved_tokens
+        context_packers[id(llm)] = ContextPacker(get_token_counter(llm), budget, context_history_token_budget, context_history_max_turns, ingest_chunk_overlap)
+    return context_packers[id(llm)]
+
+
+# one condenser per model, like the packers
+condensers = {}
+
+
+def get_condenser(llm) -> QuestionCondenser:
+    if id(llm) not in condensers:
+        condensers[id(llm)] = create_condenser(llm)
+    return condensers[id(llm)]
 
 
 def print_hyperlink(doc):
@@ -30,7 +71,7 @@ def print_hyperlink(doc):
 def print_document_chunk(doc):
     document_page = doc.page_content.replace('\n', ' ')
     if translate_docs:
-        document_page = GoogleTranslator(source=translate_src, target=translate_dst).translate(document_page)
+        document_page = translation_service.translate(document_page, translate_src, translate_dst)
     wrapper = textwrap.TextWrapper(initial_indent='\033[37m', subsequent_indent='\033[37m', width=120)
     print(f"{wrapper.fill(document_page)}\033[0m\n")
     print(f'\033[94m"n" -> next, "q" -> quit: \033[0m')
@@ -40,39 +81,45 @@ def print_document_chunk(doc):
 
 
 async def process_database_question(database_name, llm, collection_name: Optional[str]):
-    embeddings_kwargs = {'device': 'cuda'} if gpu_is_enabled else {'device': 'cpu'}
-    encode_kwargs = {'normalize_embeddings': False}
-    embeddings = OpenAIEmbeddings() if openai_use else HuggingFaceEmbeddings(
-        model_name=ingest_embeddings_model, model_kwargs=embeddings_kwargs, encode_kwargs=encode_kwargs
-    )
-    persist_dir = f"./db/{database_name}"
-
-    db = Chroma(persist_directory=persist_dir,
-                embedding_function=embeddings,
-                collection_name=collection_name if collection_name else args.collection,
-                client_settings=chromaDB_manager.get_chroma_setting(persist_dir)
-                )
-
-    retriever = db.as_retriever(search_kwargs={"k": ingest_target_source_chunks if ingest_target_source_chunks else args.ingest_target_source_chunks})
-
-    template = """You are a an AI assistant providing helpful advice. You are given the following extracted parts of a long document and a question.
-    Provide a conversational answer (about {answer_length} words) based on the context provided.
-    If you can't find the answer in the context below, just say
-    "Hmm, I'm not sure." Don't try to make up an answer. If the question is not related to the context, politely respond
-    that you are tuned to only answer questions that are related to the context.
-
-    Question: {question}
-    =========
-    {context}
-    =========
-    Answer:"""
-    question_prompt = PromptTemplate(template=template, input_variables=["question", "answer_length", "context"])
-
-    qa = ConversationalRetrievalChain.from_llm(llm=llm, condense_question_prompt=question_prompt, retriever=retriever, chain_type="stuff", return_source_documents=not args.hide_source)
+    return await process_databases_question([(database_name, collection_name if collection_name else args.collection)], llm)
+
+
+async def process_databases_question(targets: List[Tuple[str, str]], llm):
+    """
+    Builds the QA chain over one or more (database, collection) targets.
+    Several targets are searched concurrently by a FederatedRetriever and answered once from the merged context.
+    """
+    loop = asyncio.get_running_loop()
+    # opening a collection reads it from disk the first time, keep that off the event loop
+    stores = await asyncio.gather(*[loop.run_in_executor(None, get_vectorstore, database_name, collection_name) for database_name, collection_name in targets])
+    k = ingest_target_source_chunks if ingest_target_source_chunks else args.ingest_target_source_chunks
+    # with reranking, more candidates are fetched than will end up in the prompt
+    fetch_k = max(k, rerank_fetch_k) if rerank_enabled else k
+
+    if len(stores) == 1:
+        retriever = stores[0].as_retriever(search_kwargs={"k": fetch_k})
+    else:
+        retriever = FederatedRetriever([(database_name, collection_name, store) for (database_name, collection_name), store in zip(targets, stores)], fetch_k)
+
+    packer = get_context_packer(llm)
+    if rerank_enabled:
+        retriever = RerankingRetriever(retriever, create_reranker(), k, rerank_token_budget, packer.count_tokens)
+    retriever = ContextPackingRetriever(retriever, packer)
+
+    question_prompt = PromptTemplate(template=QA_TEMPLATE, input_variables=["question", "answer_length", "context"])
+    condense_prompt = PromptTemplate(template=CONDENSE_TEMPLATE, input_variables=["chat_history", "question"])
+
+    qa = CondensingRetrievalChain.from_llm(llm=llm, condense_question_prompt=condense_prompt, retriever=retriever, chain_type="stuff", return_source_documents=not args.hide_source,
+                                           combine_docs_chain_kwargs={"prompt": question_prompt}, condenser=get_condenser(llm))
     return qa
 
 
-def process_query(qa: BaseRetrievalQA, query: str, answer_length: int, chat_history, chromadb_get_only_relevant_docs: bool, translate_answer: bool):
+def process_query(qa: BaseRetrievalQA, query: str, answer_length: int, chat_history, chromadb_get_only_relevant_docs: bool, translate_answer: bool, callbacks: Callbacks = None,
+                  cache_targets: Optional[List[Tuple[str, str]]] = None, timings: Optional[dict] = None):
+    """
+    Asks the chain a question. When cache_targets are given, a first-turn question is answered from the semantic answer cache if a similar one was answered before.
+    :param timings: Filled with the estimated seconds saved on condensing the question, under 'condense_seconds_saved'.
+    """
     try:
 
         if chromadb_get_only_relevant_docs:
@@ -80,18 +127,41 @@ def process_query(qa: BaseRetrievalQA, query: str, answer_length: int, chat_hist
             return None, docs
 
         if translate_q:
-            query_en = GoogleTranslator(source=translate_dst, target=translate_src).translate(query)
-            res = qa({"question": query_en, "answer_length": answer_length, "chat_history": chat_history})
+            query_en = translation_service.translate(query, translate_dst, translate_src)
+        else:
+            query_en = query
+
+        if isinstance(qa.retriever, ContextPackingRetriever):
+            # only the latest turns are condensed with the question
+            chat_history = qa.retriever.packer.compact_history(chat_history)
+
+        use_cache = answer_cache_enabled and cache_targets and not chat_history
+        if use_cache:
+            namespace = answer_cache.namespace(cache_targets, model_path_or_id or model_type, QA_TEMPLATE)
+            version = collections_version(cache_targets)
+            embed = get_embeddings().embed_query
+            cached, embedding = answer_cache.get(namespace, version, query_en, embed)
+
+        if use_cache and cached is not None:
+            print(f"\nQuestion: {query} (answered from cache)\n")
+            answer, docs = cached['answer'], answer_cache.entry_docs(cached)
         else:
-            res = qa({"question": query, "answer_length": answer_length, "chat_history": chat_history})
+            res = qa({"question": query_en, "answer_length": answer_length, "chat_history": chat_history}, callbacks=callbacks)
+
+            # Print the question
+            print(f"\nQuestion: {query}\n")
 
-        # Print the question
-        print(f"\nQuestion: {query}\n")
+            answer, docs = res['answer'], res['source_documents']
+            if 'condense_seconds_saved' in res:
+                print(f"\033[94mSaved about {res['condense_seconds_saved']}s on condensing the question\033[0m")
+                if timings is not None:
+                    timings['condense_seconds_saved'] = res['condense_seconds_saved']
+            if use_cache:
+                answer_cache.put(namespace, version, query_en, answer, docs, embedding, embed)
 
-        answer, docs = res['answer'], res['source_documents']
         # Translate answer if necessary
         if translate_answer:
-            answer = GoogleTranslator(source=translate_src, target=translate_dst).translate(answer)
+            answer = translation_service.translate(answer, translate_src, translate_dst)
 
         print(f"\n\033[1m\033[97mAnswer: \"{answer}\"\033[0m\n")
 
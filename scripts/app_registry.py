@@ -0,0 +1,123 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from langchain.embeddings import OpenAIEmbeddings, HuggingFaceEmbeddings
+from langchain.vectorstores import Chroma
+from sentence_transformers import CrossEncoder
+
+from .app_environment import openai_use, ingest_embeddings_model, gpu_is_enabled, chromaDB_manager, registry_embeddings_max_size, registry_vectorstores_max_size
+
+
+class LRURegistry:
+    """
+    Thread-safe, size-bounded registry of expensive objects.
+    Objects are built on the first request for a key, and the least recently used entry is evicted once max_size is exceeded.
+    """
+
+    def __init__(self, name: str, max_size: int):
+        self.name = name
+        self.max_size = max(1, max_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            self.misses += 1
+            logging.debug(f"{self.name} registry miss for {key}")
+            value = factory()
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self.evictions += 1
+                logging.debug(f"{self.name} registry evicted {evicted_key}")
+            return value
+
+    def invalidate(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """
+        Drops all entries, or only those whose key matches the predicate.
+        :return: The number of dropped entries.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate is None or predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+embeddings_registry = LRURegistry("embeddings", registry_embeddings_max_size)
+vectorstore_registry = LRURegistry("vectorstores", registry_vectorstores_max_size)
+cross_encoder_registry = LRURegistry("cross-encoders", 1)
+
+
+def get_embeddings(model_name: str = ingest_embeddings_model, device: Optional[str] = None, encode_kwargs: Optional[dict] = None):
+    """
+    Returns a shared embeddings model keyed by (model name, device, encode kwargs).
+    """
+    device = device or ('cuda' if gpu_is_enabled else 'cpu')
+    encode_kwargs = encode_kwargs if encode_kwargs is not None else {'normalize_embeddings': False}
+    key = ('openai',) if openai_use else (model_name, device, tuple(sorted(encode_kwargs.items())))
+
+    def _create():
+        if openai_use:
+            return OpenAIEmbeddings()
+        return HuggingFaceEmbeddings(model_name=model_name, model_kwargs={'device': device}, encode_kwargs=encode_kwargs)
+
+    return embeddings_registry.get_or_create(key, _create)
+
+
+def get_cross_encoder(model_name: str, device: str) -> CrossEncoder:
+    """
+    Returns a shared cross-encoder used to rerank retrieved chunks.
+    """
+    return cross_encoder_registry.get_or_create((model_name, device), lambda: CrossEncoder(model_name, device=device))
+
+
+def get_vectorstore(database_name: str, collection_name: str) -> Chroma:
+    """
+    Returns a shared Chroma handle keyed by (database, collection).
+    """
+
+    def _create():
+        persist_dir = f"./db/{database_name}"
+        return Chroma(persist_directory=persist_dir,
+                      embedding_function=get_embeddings(),
+                      collection_name=collection_name,
+                      client_settings=chromaDB_manager.get_chroma_setting(persist_dir)
+                      )
+
+    return vectorstore_registry.get_or_create((database_name, collection_name), _create)
+
+
+def invalidate_vectorstore(database_name: str, collection_name: Optional[str] = None) -> int:
+    """
+    Drops cached Chroma handles of a database (or one of its collections), so freshly ingested data is picked up.
+    """
+    return vectorstore_registry.invalidate(lambda key: key[0] == database_name and (collection_name is None or key[1] == collection_name))
+
+
+def registry_stats() -> dict:
+    return {
+        'embeddings': embeddings_registry.stats(),
+        'vectorstores': vectorstore_registry.stats(),
+        'cross_encoders': cross_encoder_registry.stats(),
+    }
@@ -0,0 +1,145 @@
+import logging
+import threading
+from abc import ABC, abstractmethod
+from time import monotonic
+from typing import Callable, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+from .app_environment import rerank_method, rerank_cross_encoder_model, rerank_mmr_lambda, gpu_is_enabled
+from .app_registry import get_cross_encoder, get_embeddings
+from .app_retrievers import SyncRetriever
+
+
+def approximate_token_count(text: str) -> int:
+    # about four characters per token for English text
+    return max(1, len(text) // 4)
+
+
+class Reranker(ABC):
+    """
+    Orders candidate documents for a question, best first.
+    """
+
+    @abstractmethod
+    def rerank(self, query: str, docs: List[Document]) -> List[Document]:
+        pass
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Scores every (question, chunk) pair with a local cross-encoder, more accurate than the embedding distance but slower.
+    """
+
+    def __init__(self, model_name: str, device: str = "cpu"):
+        self.model_name = model_name
+        self.device = device
+
+    def rerank(self, query: str, docs: List[Document]) -> List[Document]:
+        scores = get_cross_encoder(self.model_name, self.device).predict([(query, doc.page_content) for doc in docs])
+        return [docs[i] for i in np.argsort(-np.asarray(scores), kind="stable")]
+
+
+class MMRReranker(Reranker):
+    """
+    Maximal marginal relevance, picks chunks relevant to the question but different from the ones already picked,
+    so near-duplicate chunks don't crowd out the rest of the context.
+    """
+
+    def __init__(self, embeddings: Embeddings, lambda_mult: float):
+        self.embeddings = embeddings
+        self.lambda_mult = lambda_mult
+
+    def rerank(self, query: str, docs: List[Document]) -> List[Document]:
+        query_embedding = np.array(self.embeddings.embed_query(query), dtype=np.float32)
+        doc_embeddings = self.embeddings.embed_documents([doc.page_content for doc in docs])
+        selected = maximal_marginal_relevance(query_embedding, doc_embeddings, lambda_mult=self.lambda_mult, k=len(docs))
+        return [docs[i] for i in selected]
+
+
+class RerankMetrics:
+    """
+    Cumulative timings of the retrieval and rerank stages, to weigh the added latency against the answer quality.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.candidates = 0
+        self.selected = 0
+        self.retrieve_seconds = 0.0
+        self.rerank_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, candidates: int, selected: int, retrieve_seconds: float, rerank_seconds: float):
+        with self._lock:
+            self.queries += 1
+            self.candidates += candidates
+            self.selected += selected
+            self.retrieve_seconds += retrieve_seconds
+            self.rerank_seconds += rerank_seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            queries = max(self.queries, 1)
+            return {
+                'queries': self.queries,
+                'avg_candidates': round(self.candidates / queries, 1),
+                'avg_selected': round(self.selected / queries, 1),
+                'avg_retrieve_ms': round(self.retrieve_seconds / queries * 1000, 1),
+                'avg_rerank_ms': round(self.rerank_seconds / queries * 1000, 1),
+            }
+
+
+rerank_metrics = RerankMetrics()
+
+
+class RerankingRetriever(SyncRetriever):
+    """
+    Two-stage retrieval: the wrapped retriever over-fetches candidates, the reranker orders them,
+    and the best ones are kept until k documents or the token budget of the context is reached.
+    """
+
+    def __init__(self, retriever: BaseRetriever, reranker: Reranker, k: int, token_budget: int = 0,
+                 count_tokens: Callable[[str], int] = approximate_token_count):
+        self.retriever = retriever
+        self.reranker = reranker
+        self.k = k
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+
+    def _select(self, docs: List[Document]) -> List[Document]:
+        selected, tokens = [], 0
+        for doc in docs:
+            if len(selected) == self.k:
+                break
+            doc_tokens = self.count_tokens(doc.page_content)
+            if self.token_budget and tokens + doc_tokens > self.token_budget:
+                # a shorter chunk further down may still fit
+                continue
+            selected.append(doc)
+            tokens += doc_tokens
+        return selected
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        start_time = monotonic()
+        candidates = self.retriever.get_relevant_documents(query)
+        retrieved_time = monotonic()
+        ranked = self.reranker.rerank(query, candidates) if len(candidates) > 1 else candidates
+        selected = self._select(ranked)
+        rerank_seconds = monotonic() - retrieved_time
+
+        rerank_metrics.record(len(candidates), len(selected), retrieved_time - start_time, rerank_seconds)
+        logging.debug(f"Reranked {len(candidates)} candidates to {len(selected)} in {rerank_seconds * 1000:.0f}ms")
+        return selected
+
+
+def create_reranker(method: Optional[str] = None) -> Reranker:
+    method = method or rerank_method
+    if method == "mmr":
+        return MMRReranker(get_embeddings(), rerank_mmr_lambda)
+    if method != "cross-encoder":
+        logging.warning(f"Unknown RERANK_METHOD '{method}', falling back to 'cross-encoder'")
+    return CrossEncoderReranker(rerank_cross_encoder_model, 'cuda' if gpu_is_enabled else 'cpu')
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores import Chroma
+from langchain.vectorstores.chroma import _results_to_docs_and_scores
+
+from .app_environment import retriever_fanout_workers
+
+fanout_executor = ThreadPoolExecutor(max_workers=max(1, retriever_fanout_workers), thread_name_prefix="retriever")
+
+
+class SyncRetriever(BaseRetriever):
+    """
+    Base of retrievers doing their work synchronously, async chains run it on the default executor instead of blocking the event loop.
+    """
+
+    @abstractmethod
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        pass
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_relevant_documents, query)
+
+
+class FederatedRetriever(SyncRetriever):
+    """
+    Retrieves from several (database, collection) vector stores at once.
+    The question is embedded once, all collections are searched concurrently,
+    and the hits are merged by distance into a single global top-k.
+    """
+
+    def __init__(self, stores: List[Tuple[str, str, Chroma]], k: int):
+        self.stores = stores
+        self.k = k
+
+    def _search(self, database_name: str, collection_name: str, store: Chroma, query_embedding: List[float]) -> List[Tuple[Document, float]]:
+        n_results = min(self.k, store._collection.count())
+        if n_results == 0:
+            return []
+        results = store._collection.query(query_embeddings=[query_embedding], n_results=n_results)
+        docs_and_scores = _results_to_docs_and_scores(results)
+        for doc, _ in docs_and_scores:
+            doc.metadata['database'] = database_name
+            doc.metadata['collection'] = collection_name
+        return docs_and_scores
+
+    def get_relevant_documents_with_scores(self, query: str) -> List[Tuple[Document, float]]:
+        # every store shares the embedding model from the registry, so one query embedding fits all of them
+        query_embedding = self.stores[0][2]._embedding_function.embed_query(query)
+        if len(self.stores) == 1:
+            hits = self._search(*self.stores[0], query_embedding)
+        else:
+            futures = [fanout_executor.submit(self._search, database_name, collection_name, store, query_embedding)
+                       for database_name, collection_name, store in self.stores]
+            hits = []
+            for (database_name, collection_name, _), future in zip(self.stores, futures):
+                try:
+                    hits.extend(future.result())
+                except Exception as e:
+                    logging.error(f"Retrieval from {database_name}/{collection_name} failed: {e}")
+
+        # smaller distance is a better match
+        return sorted(hits, key=lambda hit: hit[1])[:self.k]
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return [doc for doc, _ in self.get_relevant_documents_with_scores(query)]
+
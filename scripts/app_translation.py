@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from deep_translator import GoogleTranslator
+
+from .app_environment import translate_backend, translate_cache_size, translate_cache_path, translate_max_workers
+
+
+class TranslationBackend(ABC):
+    """
+    Translates a batch of texts from one language to another, implementations have to be thread-safe.
+    """
+
+    @abstractmethod
+    def translate_batch(self, texts: List[str], source: str, target: str) -> List[str]:
+        pass
+
+
+class GoogleTranslationBackend(TranslationBackend):
+    """
+    Google Translate through deep_translator, texts of a batch are requested concurrently.
+    A GoogleTranslator keeps the text it sends in its request parameters, so every thread uses translators of its own.
+    """
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="translator")
+        self._local = threading.local()
+
+    def _get_translator(self, source: str, target: str) -> GoogleTranslator:
+        translators: Dict[Tuple[str, str], GoogleTranslator] = self._local.__dict__.setdefault("translators", {})
+        if (source, target) not in translators:
+            translators[(source, target)] = GoogleTranslator(source=source, target=target)
+        return translators[(source, target)]
+
+    def _translate(self, text: str, source: str, target: str) -> str:
+        return self._get_translator(source, target).translate(text)
+
+    def translate_batch(self, texts: List[str], source: str, target: str) -> List[str]:
+        return list(self._executor.map(lambda text: self._translate(text, source, target), texts))
+
+
+class IdentityTranslationBackend(TranslationBackend):
+    """
+    Offline stub returning texts unchanged, for tests and machines without network access.
+    """
+
+    def translate_batch(self, texts: List[str], source: str, target: str) -> List[str]:
+        return list(texts)
+
+
+TRANSLATION_BACKENDS = {
+    "google": lambda: GoogleTranslationBackend(translate_max_workers),
+    "none": IdentityTranslationBackend,
+}
+
+
+class TranslationService:
+    """
+    Translates texts through a pluggable backend, with an in-memory LRU and an optional SQLite cache on disk
+    keyed by (text hash, source language, target language). Only texts missing from both caches reach the backend.
+    """
+
+    def __init__(self, backend: TranslationBackend, cache_size: int, cache_path: Optional[str] = None):
+        self.backend = backend
+        self.cache_size = max(1, cache_size)
+        self.cache_path = cache_path
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            self._disk = sqlite3.connect(cache_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS translations (text_hash TEXT, source TEXT, target TEXT, translation TEXT, "
+                               "PRIMARY KEY (text_hash, source, target))")
+            self._disk.commit()
+
+    @staticmethod
+    def _key(text: str, source: str, target: str) -> Tuple[str, str, str]:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest(), source, target
+
+    def _get_cached(self, key: Tuple[str, str, str]) -> Optional[str]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+            if self._disk is not None:
+                row = self._disk.execute("SELECT translation FROM translations WHERE text_hash = ? AND source = ? AND target = ?", key).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def _remember(self, key: Tuple[str, str, str], translation: str):
+        self._memory[key] = translation
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.cache_size:
+            self._memory.popitem(last=False)
+
+    def _store(self, entries: List[Tuple[Tuple[str, str, str], str]]):
+        with self._lock:
+            for key, translation in entries:
+                self._remember(key, translation)
+            if self._disk is not None:
+                self._disk.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)", [key + (translation,) for key, translation in entries])
+                self._disk.commit()
+
+    def translate_batch(self, texts: List[str], source: str, target: str) -> List[str]:
+        if source == target:
+            return list(texts)
+
+        results: List[Optional[str]] = [None] * len(texts)
+        missing: Dict[str, List[int]] = OrderedDict()
+        for i, text in enumerate(texts):
+            if not text or not text.strip():
+                results[i] = text
+                continue
+            cached = self._get_cached(self._key(text, source, target))
+            if cached is not None:
+                results[i] = cached
+            else:
+                missing.setdefault(text, []).append(i)
+
+        if missing:
+            missing_texts = list(missing)
+            translations = self.backend.translate_batch(missing_texts, source, target)
+            self._store([(self._key(text, source, target), translation) for text, translation in zip(missing_texts, translations) if translation is not None])
+            for text, translation in zip(missing_texts, translations):
+                for i in missing[text]:
+                    results[i] = translation if translation is not None else text
+
+        return results
+
+    def translate(self, text: str, source: str, target: str) -> str:
+        return self.translate_batch([text], source, target)[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'memory_size': len(self._memory),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+
+def create_translation_service() -> TranslationService:
+    if translate_backend not in TRANSLATION_BACKENDS:
+        logging.warning(f"Unknown TRANSLATE_BACKEND '{translate_backend}', falling back to 'none'")
+    backend = TRANSLATION_BACKENDS.get(translate_backend, IdentityTranslationBackend)()
+    return TranslationService(backend, translate_cache_size, translate_cache_path or None)
+
+
+translation_service = create_translation_service()
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Set, Tuple
+
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+
+from .app_ingest_manifest import IngestManifest
+
+UPLOAD_TMP_SUFFIX = ".part"
+# files are received before the form fields naming their collection may have arrived, they wait here (on the same disk) until then
+UPLOAD_STAGING_DIR = ".uploads"
+# form fields are names, not documents
+MAX_FIELD_BYTES = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class InvalidUpload(Exception):
+    pass
+
+
+@dataclass
+class ReceivedFile:
+    file_name: str
+    tmp_path: str
+    size: int
+    content_hash: str
+
+
+@dataclass
+class StoredUpload:
+    file_path: str
+    size: int
+    content_hash: str
+    # set when the same content is already ingested (or uploaded twice), the file is not stored again
+    duplicate_of: Optional[str] = None
+
+
+def get_upload_directory(source_documents: str, database_name: str, collection_name: str) -> str:
+    if database_name != collection_name:
+        return os.path.join(source_documents, database_name, collection_name)
+    return os.path.join(source_documents, database_name)
+
+
+def ingested_hashes(database_name: str, collection_name: str) -> Dict[str, str]:
+    """
+    :return: The content hashes of files already ingested into the collection, mapped to their paths.
+    """
+    manifest = IngestManifest.load(f"./db/{database_name}", collection_name)
+    return {entry["hash"]: file_path for file_path, entry in manifest.files.items() if entry.get("hash")}
+
+
+def _write_block(f: BinaryIO, sha256, block: bytes):
+    sha256.update(block)
+    f.write(block)
+
+
+def _close_and_sync(f: BinaryIO):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class _FilePart:
+    def __init__(self, file_name: str, tmp_path: str, f: BinaryIO):
+        self.file_name = file_name
+        self.tmp_path = tmp_path
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.buffer = bytearray()
+
+
+class MultipartUploadReader:
+    """
+    Parses a multipart/form-data body while it arrives: form fields are kept in memory, files are written chunk by chunk
+    to temporary files in the staging directory, hashing them on the way. The size limits are checked on every received chunk,
+    so an upload too large is rejected before it is read whole. Disk writes and hashing run on the executor.
+    """
+
+    def __init__(self, content_type: str, directory: str, executor: Executor, chunk_size: int, max_file_bytes: int, max_request_bytes: int):
+        _, options = parse_options_header(content_type)
+        boundary = options.get(b"boundary")
+        if not boundary:
+            raise InvalidUpload("Expected a multipart/form-data body")
+        self.directory = directory
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.fields: Dict[str, str] = {}
+        self.files: List[ReceivedFile] = []
+        self._received_bytes = 0
+        # the parser callbacks can't await, they queue what they parsed for read() to handle after every chunk
+        self._events: List[Tuple[str, object]] = []
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = bytearray()
+        self._header_value = bytearray()
+        self._part = None
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": lambda data, start, end: self._header_field.extend(data[start:end]),
+            "on_header_value": lambda data, start, end: self._header_value.extend(data[start:end]),
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": lambda data, start, end: self._events.append(("data", data[start:end])),
+            "on_part_end": lambda: self._events.append(("end", None)),
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_end(self):
+        self._headers[bytes(self._header_field).lower()] = bytes(self._header_value)
+        self._header_field.clear()
+        self._header_value.clear()
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition"))
+        name = options.get(b"name", b"").decode("utf-8", errors="replace")
+        file_name = options.get(b"filename")
+        self._events.append(("part", (name, file_name.decode("utf-8", errors="replace") if file_name is not None else None)))
+
+    async def read(self, stream: AsyncIterator[bytes]):
+        """
+        Reads the whole body, temporary files of a failed upload are removed.
+        """
+        try:
+            async for chunk in stream:
+                self._received_bytes += len(chunk)
+                if self._received_bytes > self.max_request_bytes:
+                    raise UploadTooLarge(f"The upload is larger than {self.max_request_bytes // (1024 * 1024)} MB")
+                self._parser.write(chunk)
+                await self._handle_events()
+            self._parser.finalize()
+            await self._handle_events()
+        except MultipartParseError as e:
+            self.discard()
+            raise InvalidUpload(f"Malformed multipart body: {e}")
+        except BaseException:
+            self.discard()
+            raise
+
+    async def _handle_events(self):
+        loop = asyncio.get_running_loop()
+        events, self._events = self._events, []
+        for event, value in events:
+            part = self._part
+            if event == "part":
+                name, file_name = value
+                if file_name is None:
+                    self._part = (name, bytearray())
+                    continue
+                # a client controlled name must not point outside the collection directory
+                file_name = os.path.basename(file_name)
+                if not file_name:
+                    self._part = None
+                    continue
+                tmp_path = os.path.join(self.directory, f".{uuid.uuid4().hex}{UPLOAD_TMP_SUFFIX}")
+                self._part = _FilePart(file_name, tmp_path, await loop.run_in_executor(self.executor, open, tmp_path, "wb"))
+            elif event == "data" and isinstance(part, _FilePart):
+                part.size += len(value)
+                if part.size > self.max_file_bytes:
+                    raise UploadTooLarge(f"{part.file_name} is larger than {self.max_file_bytes // (1024 * 1024)} MB")
+                part.buffer.extend(value)
+                if len(part.buffer) >= self.chunk_size:
+                    block, part.buffer = bytes(part.buffer), bytearray()
+                    await loop.run_in_executor(self.executor, _write_block, part.f, part.sha256, block)
+            elif event == "data" and part is not None:
+                part[1].extend(value)
+                if len(part[1]) > MAX_FIELD_BYTES:
+                    raise UploadTooLarge(f"The form field {part[0]} is larger than {MAX_FIELD_BYTES // 1024} KB")
+            elif event == "end" and isinstance(part, _FilePart):
+                await loop.run_in_executor(self.executor, _write_block, part.f, part.sha256, bytes(part.buffer))
+                await loop.run_in_executor(self.executor, _close_and_sync, part.f)
+                self.files.append(ReceivedFile(part.file_name, part.tmp_path, part.size, part.sha256.hexdigest()))
+                self._part = None
+            elif event == "end" and part is not None:
+                self.fields[part[0]] = part[1].decode("utf-8", errors="replace")
+                self._part = None
+
+    def discard(self):
+        if isinstance(self._part, _FilePart):
+            self._part.f.close()
+            _remove_quietly(self._part.tmp_path)
+        self._part = None
+        for received in self.files:
+            _remove_quietly(received.tmp_path)
+        self.files = []
+
+
+def unique_file_name(file_name: str, taken: Set[str]) -> str:
+    """
+    The file name, numbered when a file of the same upload already took it.
+    """
+    stem, extension = os.path.splitext(file_name)
+    candidate, number = file_name, 1
+    while candidate in taken:
+        number += 1
+        candidate = f"{stem} ({number}){extension}"
+    return candidate
+
+
+async def receive_uploads(stream: AsyncIterator[bytes], content_type: str, source_documents: str, executor: Executor,
+                          chunk_size: int, max_file_bytes: int, max_request_bytes: int) -> MultipartUploadReader:
+    directory = os.path.join(source_documents, UPLOAD_STAGING_DIR)
+    os.makedirs(directory, exist_ok=True)
+    reader = MultipartUploadReader(content_type, directory, executor, chunk_size, max_file_bytes, max_request_bytes)
+    await reader.read(stream)
+    return reader
+
+
+def store_uploads(received: List[ReceivedFile], database_name: str, collection_name: str, source_documents: str) -> List[StoredUpload]:
+    """
+    Moves the files of an upload, received completely and within the limits, from the staging directory into the collection directory.
+    Files with content that is already ingested are skipped, files of the same upload sharing a name are numbered.
+    """
+    directory = get_upload_directory(source_documents, database_name, collection_name)
+    stored_uploads = []
+    taken: Set[str] = set()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        known_hashes = ingested_hashes(database_name, collection_name)
+        for upload in received:
+            duplicate_of = known_hashes.get(upload.content_hash)
+            if duplicate_of is not None:
+                os.remove(upload.tmp_path)
+                stored_uploads.append(StoredUpload(os.path.join(directory, upload.file_name), upload.size, upload.content_hash, duplicate_of))
+                continue
+            file_name = unique_file_name(upload.file_name, taken)
+            taken.add(file_name)
+            stored = StoredUpload(os.path.join(directory, file_name), upload.size, upload.content_hash)
+            os.replace(upload.tmp_path, stored.file_path)
+            known_hashes[upload.content_hash] = stored.file_path
+            stored_uploads.append(stored)
+    except BaseException:
+        # files already moved are gone from the staging directory
+        for upload in received:
+            _remove_quietly(upload.tmp_path)
+        raise
+    return stored_uploads
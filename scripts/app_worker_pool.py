@@ -0,0 +1,85 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Optional
+
+
+class WorkerPoolSaturated(Exception):
+    """Raised when a request can't be queued because the waiting queue is already full."""
+
+
+class BoundedWorkerPool:
+    """
+    Runs blocking work (retrieval, generation, translation) off the event loop.
+    Requests are admitted through a limited number of slots, everything above that waits in a bounded queue,
+    and anything above the queue size is rejected right away with WorkerPoolSaturated.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # created lazily, so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def is_saturated(self) -> bool:
+        return self._get_semaphore().locked() and self.waiting >= self.max_queue
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Admits one request, waiting in the queue if all slots are busy.
+        """
+        semaphore = self._get_semaphore()
+        if self.is_saturated():
+            self.rejected += 1
+            raise WorkerPoolSaturated(f"{self.name} queue is full ({self.waiting} waiting)")
+
+        self.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.completed += 1
+            semaphore.release()
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Runs a blocking function on the worker threads and awaits its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        logging.debug(f"Shutting down {self.name} worker pool")
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.max_workers,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'active': self.active,
+            'queue_depth': self.waiting,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
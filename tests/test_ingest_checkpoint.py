@@ -0,0 +1,60 @@
+from scripts.app_ingest_checkpoint import IngestCheckpoint
+from scripts.app_ingest_manifest import IngestManifest
+
+
+class FakeCollection:
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, ids):
+        self.deleted.extend(ids)
+
+
+class FakeChroma:
+    def __init__(self):
+        self._collection = FakeCollection()
+
+    def persist(self):
+        pass
+
+
+def test_recover_records_modified_file_committed_before_crash(tmp_path):
+    persist_dir = str(tmp_path / "db")
+    file_path = str(tmp_path / "doc.txt")
+    with open(file_path, "w") as f:
+        f.write("first version")
+    manifest = IngestManifest.load(persist_dir, "docs")
+    manifest.record(file_path, ["old-1"])
+    manifest.save()
+
+    # the file changes, its old chunks are purged and the new ones committed, then the ingest crashes before saving the manifest
+    with open(file_path, "w") as f:
+        f.write("second, longer version")
+    checkpoint = IngestCheckpoint.load(persist_dir, "docs")
+    checkpoint.begin_batch(["new-1", "new-2"])
+    checkpoint.commit(1, 2, {file_path: ["new-1", "new-2"]}, {})
+
+    chroma_db = FakeChroma()
+    manifest = IngestManifest.load(persist_dir, "docs")
+    checkpoint = IngestCheckpoint.load(persist_dir, "docs")
+    assert checkpoint.is_interrupted()
+    checkpoint.recover(chroma_db, manifest, resume=True)
+
+    manifest = IngestManifest.load(persist_dir, "docs")
+    changes = manifest.diff([file_path])
+    assert changes.unchanged == [file_path]
+    assert manifest.chunk_ids([file_path]) == ["new-1", "new-2"]
+    assert chroma_db._collection.deleted == []
+
+
+def test_recover_deletes_uncommitted_batch(tmp_path):
+    persist_dir = str(tmp_path / "db")
+    checkpoint = IngestCheckpoint.load(persist_dir, "docs")
+    checkpoint.begin_batch(["a-1"])
+    checkpoint.commit(1, 1, {}, {})
+    checkpoint.begin_batch(["a-2", "a-3"])
+
+    chroma_db = FakeChroma()
+    IngestCheckpoint.load(persist_dir, "docs").recover(chroma_db, IngestManifest.load(persist_dir, "docs"), resume=True)
+
+    assert chroma_db._collection.deleted == ["a-2", "a-3"]
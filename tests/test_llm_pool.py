@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from scripts.app_llm_pool import LLMPool, LLMPoolTimeout
+
+
+def test_checkout_rejects_beyond_max_waiting():
+    async def scenario():
+        pool = LLMPool(object, replicas=1, checkout_timeout=5, max_waiting=1)
+        pool.start()
+        async with pool.checkout():
+            waiting = asyncio.ensure_future(pool.checkout().__aenter__())
+            await asyncio.sleep(0)
+            assert pool.waiting == 1
+            with pytest.raises(LLMPoolTimeout):
+                async with pool.checkout():
+                    pass
+        # the waiting request gets the replica once it is released
+        assert await waiting is pool.slots[0].instance
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert pool.stats()["rejected"] == 1
+    assert pool.stats()["timeouts"] == 0
+
+
+def test_checkout_times_out():
+    async def scenario():
+        pool = LLMPool(object, replicas=1, checkout_timeout=0.01)
+        pool.start()
+        async with pool.checkout():
+            with pytest.raises(LLMPoolTimeout):
+                async with pool.checkout():
+                    pass
+        return pool
+
+    assert asyncio.run(scenario()).stats()["timeouts"] == 1
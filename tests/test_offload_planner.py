@@ -0,0 +1,57 @@
+import struct
+
+import pytest
+
+from scripts.app_offload_planner import load_metadata, read_ggml_metadata
+
+
+def write_ggjt(path, version, tensors, n_embd=64, n_layer=2, ftype=8):
+    """
+    Writes a ggjt model file with a two token vocabulary and the given (name, type, elements) tensors, filled with zeros.
+    """
+    with open(path, "wb") as f:
+        f.write(b"tjgg")
+        f.write(struct.pack("<8i", version, 2, n_embd, 256, 4, n_layer, 16, ftype))
+        for token in (b"a", b"b"):
+            f.write(struct.pack("<i", len(token)) + token + struct.pack("<f", 0.0))
+        for name, tensor_type, n_elements, n_bytes in tensors:
+            encoded = name.encode("utf-8")
+            f.write(struct.pack("<4i", 1, len(encoded), tensor_type, n_elements) + encoded)
+            f.write(b"\0" * (-f.tell() & 31))
+            f.write(b"\0" * n_bytes)
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_legacy_q5_tensor_sizes(tmp_path, version):
+    path = tmp_path / "model.bin"
+    # 64 elements are two blocks, Q5_0 blocks are 22 bytes and Q5_1 blocks 24 bytes
+    write_ggjt(path, version, [
+        ("tok_embeddings.weight", 0, 64, 256),
+        ("layers.0.attention.wq.weight", 6, 64, 44),
+        ("layers.0.attention.wk.weight", 7, 64, 48),
+        ("layers.1.attention.wq.weight", 6, 64, 44),
+        ("output.weight", 7, 64, 48),
+    ])
+
+    meta = read_ggml_metadata(str(path))
+
+    assert (meta.format, meta.version, meta.n_layer) == ("ggjt", version, 2)
+    assert meta.layer_bytes == [92, 44]
+    assert meta.output_bytes == 48
+    assert meta.other_bytes == 256
+
+
+def test_v3_q4_0_tensor_sizes(tmp_path):
+    path = tmp_path / "model.bin"
+    write_ggjt(path, 3, [("layers.0.feed_forward.w1.weight", 2, 64, 36), ("layers.1.feed_forward.w1.weight", 2, 64, 36)], ftype=2)
+
+    assert read_ggml_metadata(str(path)).layer_bytes == [36, 36]
+
+
+def test_truncated_tensor_header_has_no_metadata(tmp_path):
+    path = tmp_path / "model.bin"
+    write_ggjt(path, 3, [("layers.0.feed_forward.w1.weight", 2, 64, 36)], ftype=2)
+    with open(path, "ab") as f:
+        f.write(b"\1\0\0\0\5")
+
+    assert load_metadata(str(path)) is None